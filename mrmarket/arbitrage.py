@@ -0,0 +1,117 @@
+
+
+import pandas as pd
+from numpy import log, abs, zeros, isfinite, lexsort, searchsorted, clip, where, nan
+from exchange import Computus, XSpec
+from finutils import black_price, black_price_bn
+from sabr import _smile_groups
+
+__all__ = ['scan', 'scan_snapshot', 'report', 'BAD_PRINT', 'SPREAD', 'BUTTERFLY', 'CALENDAR']
+
+# bits of the flags returned by scan
+BAD_PRINT = 1	# no vol, non-positive vol or crossed bid / ask vols
+SPREAD = 2		# call price increasing in strike, or falling faster than the strike rises
+BUTTERFLY = 4	# call price not convex in strike
+CALENDAR = 8	# total variance at the same moneyness lower than on the previous expiry
+
+_REASONS = [(BAD_PRINT, 'bad print'), (SPREAD, 'call spread'), (BUTTERFLY, 'butterfly'), \
+	(CALENDAR, 'calendar')]
+
+
+def scan(product, fopt, ffut, tol=1.0e-6):
+	"""Static arbitrage scan over a whole stored history at once. fopt and ffut are frames
+	like MrMarket.opt_settle / fut_settle (or the live ones). Everything is done on flat
+	arrays sorted by (timestamp, month, strike), without looping over timestamps or strikes.
+
+	Price checks use undiscounted call prices from the stored vols with a tolerance of
+	tol * forward, the calendar check compares total variance (vol^2 t) at the same
+	log-moneyness (K - F for normal vol products) with the previous expiry on the same
+	timestamp, interpolated linearly, to within tol. Midcurves are only checked across
+	strikes. Returns a Series of bit flags (see BAD_PRINT etc) aligned with fopt."""
+	xs = XSpec().spec(product)
+	cdr = Computus().make(xs.computus)
+	normal = xs.model == 'normal'
+	pricefn = black_price_bn if normal else black_price
+
+	if 'SETTLE_VOL' in fopt.columns:
+		vol = fopt['SETTLE_VOL'].values
+		crossed = zeros(len(fopt), dtype=bool)
+	else:
+		vol = fopt[['BID_VOL', 'ASK_VOL']].mean(axis=1).values
+		crossed = (fopt['BID_VOL'] > fopt['ASK_VOL']).values
+
+	rows, groups = _smile_groups(xs, cdr, fopt, ffut)
+	fwd, t, gid = rows['fwd'].values, rows['t'].values, rows['gid'].values
+	strike = fopt.index.get_level_values('strike').values.astype(float)
+	good = isfinite(vol) & (vol > 0.0) & isfinite(fwd) & (t > 0.0)
+
+	flags = where(good & ~crossed, 0, BAD_PRINT)
+	call = where(good, pricefn('C', fwd, strike, where(good, t, 1.0), where(good, vol, 1.0)), nan)
+	ptol = tol * abs(where(isfinite(fwd), fwd, 1.0))
+
+	# across strikes: neighbours in (group, strike) order, ignoring bad prints
+	oo = lexsort((strike, gid))
+	oo = oo[good[oo]]
+	gg, kk, cc = gid[oo], strike[oo], call[oo]
+
+	same = (gg[1:] == gg[:-1]) & (kk[1:] > kk[:-1])
+	dk, dc = kk[1:] - kk[:-1], cc[1:] - cc[:-1]
+	bad = same & ((dc > ptol[oo][1:]) | (-dc > dk + ptol[oo][1:]))
+	flags[oo[1:][bad]] |= SPREAD
+	flags[oo[:-1][bad]] |= SPREAD
+
+	mid = same[1:] & same[:-1]
+	fly = cc[:-2]*dk[1:] - cc[1:-1]*(dk[:-1] + dk[1:]) + cc[2:]*dk[:-1]
+	flags[oo[1:-1][mid & (fly < -ptol[oo][1:-1]*(dk[:-1] + dk[1:]))]] |= BUTTERFLY
+
+	# across expiries: each standard month against the one before it on the same timestamp
+	# prevof is indexed by gid, which numbers every group, midcurves included
+	prevof = zeros(len(groups), dtype=int) - 1
+	groups = groups[groups['std'].values].sort(['timestamp', 't'])
+	gs = groups['gid'].values
+	same = groups['timestamp'].values[1:] == groups['timestamp'].values[:-1]
+	prevof[gs[1:][same]] = gs[:-1][same]
+
+	cal = good & rows['std'].values.astype(bool)
+	prev = where(cal, prevof[gid], -1)
+	xx = where(cal, strike - fwd if normal else log(where(cal, strike/fwd, 1.0)), 0.0)
+	ww = where(cal, vol*vol*t, 0.0)
+	if (prev >= 0).any():
+		# one sorted key for all the smiles, so a single searchsorted finds the bracketing
+		# strikes on the previous expiry for every row at once
+		span = 2.0 * abs(xx[cal]).max() + 1.0
+		nodes = where(cal)[0]
+		nodes = nodes[lexsort((xx[nodes], gid[nodes]))]
+		nkey = gid[nodes] * span + xx[nodes]
+
+		qq = where(prev >= 0)[0]
+		qkey = prev[qq] * span + xx[qq]
+		pos = searchsorted(nkey, qkey)
+		lo, hi = clip(pos - 1, 0, len(nodes) - 1), clip(pos, 0, len(nodes) - 1)
+		# the clip makes lo == hi past either end of the nodes, so check the key is between them
+		inside = (gid[nodes[lo]] == prev[qq]) & (gid[nodes[hi]] == prev[qq]) & (nkey[lo] <= qkey) \
+			& (qkey <= nkey[hi])
+		dkey = nkey[hi] - nkey[lo]
+		wprev = ww[nodes[lo]] + where(dkey > 0.0, (qkey - nkey[lo]) / where(dkey > 0.0, dkey, 1.0), \
+			0.0) * (ww[nodes[hi]] - ww[nodes[lo]])
+		flags[qq[inside & (ww[qq] < wprev - tol)]] |= CALENDAR
+
+	return pd.Series(flags, index=fopt.index, name='ARB')
+
+
+def scan_snapshot(product, snap_date, fopt, ffut, tol=1.0e-6):
+	"""scan for a single snap, as returned by snap_by_delta (options indexed by ('month',
+	'strike'), futures by month)"""
+	fopt = pd.concat([fopt], keys=[snap_date], names=['timestamp'])
+	ffut = pd.concat([ffut], keys=[snap_date], names=['timestamp']).swaplevel(0, 1)
+	ffut.index.names = ['mon', 'timestamp']
+
+	return scan(product, fopt, ffut, tol).reset_index(level=0, drop=True)
+
+
+def report(fopt, flags):
+	"""The offending rows of fopt with their flags spelt out"""
+	bad = fopt[flags.values != 0].copy()
+	bad['ARB'] = flags[flags.values != 0].values
+	bad['reasons'] = [', '.join([rr for bit, rr in _REASONS if ff & bit]) for ff in bad['ARB']]
+	return bad
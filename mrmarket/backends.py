@@ -0,0 +1,412 @@
+
+
+import cPickle, gzip, time, sqlite3, threading, atexit
+from abc import ABCMeta, abstractmethod
+from datetime import date, datetime, timedelta
+from numpy.random import RandomState
+
+try:
+	import bloomburger
+except ImportError:
+	bloomburger = None
+
+__all__ = ['BackendError', 'Backend', 'BloombergBackend', 'RecordingBackend', 'ReplayBackend', \
+	'CachingBackend', 'PrefetchBackend', 'connection', 'close_all']
+
+# process wide bloomberg sessions by (server, port), see connection below
+_connections = {}
+
+
+class BackendError(Exception):
+	pass
+
+
+class Backend(object):
+	"""What PandaBurger needs from a data source. Subclasses must implement fetch, which takes 
+	a list of securities and a list of fields and returns raw bloomburger style data, a dict 
+	keyed by security of
+		- [(field, value), ...] for realtime requests (no dates)
+		- [[('date', d), (field, value), ...], ...] for historical requests (d0 and d1)
+		- [[('time', t), (field, value), ...], ...] for intraday requests (interval > 0)
+	with an empty list for a security that has no data. periodicity is 'DAILY' (None),
+	'WEEKLY' etc for historical requests. It's passed with each request rather than kept
+	on the backend, since a backend may be shared by several PandaBurgers.
+	
+	subscribe is optional. A backend that can't stream leaves it raising NotImplementedError, 
+	and one that wraps another backend passes it through, so callers can tell streaming isn't 
+	available and fall back to polling."""
+	__metaclass__ = ABCMeta
+
+	def connect(self, server='localhost', port=8194):
+		pass
+
+	def close(self):
+		pass
+
+	@abstractmethod
+	def fetch(self, securities, fields, d0=None, d1=None, interval=0, periodicity=None):
+		pass
+
+	def subscribe(self, securities, fields, callback):
+		"""Stream realtime updates, calling callback with lists of (security, [(field, value), 
+		...]) ticks. Backends that can't stream raise NotImplementedError."""
+		raise NotImplementedError
+
+
+class BloombergBackend(Backend):
+	"""Bloomburger sessions to one server. Nothing connects until the first request, so code 
+	that only reads the sqlite files never waits on (or needs) a terminal. bloomburger keeps 
+	periodicity etc on the session, so each request has a session to itself: up to 'sessions' 
+	of them are opened as concurrent requests need them and kept for reuse, and a request 
+	waits when they're all busy. If a request fails its session is dropped and it's tried 
+	once more on another before raising BackendError. Use connection() below rather than 
+	making these directly, so a process shares its sessions."""
+
+	def __init__(self, server='localhost', port=8194, sessions=4):
+		self.server = server
+		self.port = port
+		self.sessions = sessions
+		self.idle = []
+		self.streaming = []
+		self.opened = 0
+		# bumped by close, so sessions busy at the time are dropped when they come back
+		self.generation = 0
+		self.cond = threading.Condition()
+
+	def connect(self, server='localhost', port=8194):
+		"""Where to connect. The connection itself is made by the next request."""
+		if (server, port) != (self.server, self.port):
+			self.close()
+			self.server, self.port = server, port
+
+	def close(self):
+		with self.cond:
+			dropped = self.idle + self.streaming
+			self.opened -= len(self.idle) + len(self.streaming)
+			self.idle, self.streaming = [], []
+			self.generation += 1
+			self.cond.notify_all()
+		for bb in dropped:
+			_disconnect(bb)
+
+	def checkout(self):
+		"""A session for this thread's use only, opening one if none is idle and there are 
+		fewer than 'sessions'. Returns (session, generation) for checkin."""
+		with self.cond:
+			while not self.idle and self.opened >= self.sessions:
+				self.cond.wait()
+			if self.idle:
+				return self.idle.pop(), self.generation
+			self.opened += 1
+			generation = self.generation
+		try:
+			if bloomburger is None:
+				raise BackendError('bloomburger is not installed, use a ReplayBackend or ' \
+					'SyntheticBackend to run offline')
+			bb = bloomburger.bb()
+			bb.connect(self.server, self.port)
+			return bb, generation
+		except:
+			with self.cond:
+				self.opened -= 1
+				self.cond.notify()
+			raise
+
+	def checkin(self, bb, generation, ok=True):
+		"""Give a session back, or drop it if it failed or was closed while in use"""
+		with self.cond:
+			keep = ok and generation == self.generation
+			if keep:
+				self.idle.append(bb)
+			else:
+				self.opened -= 1
+			self.cond.notify()
+		if not keep:
+			_disconnect(bb)
+
+	def fetch(self, securities, fields, d0=None, d1=None, interval=0, periodicity=None):
+		for attempt in range(2):
+			bb, generation = self.checkout()
+			try:
+				if (periodicity or 'DAILY') != (getattr(bb, 'periodicity', None) or 'DAILY'):
+					bb.periodicity = periodicity or 'DAILY'
+				if interval:
+					bdata = bb.fetch(securities[0], fields[0], d0, d1, interval)
+				elif d0 or d1:
+					bdata = bb.fetch(securities, fields, d0, d1)
+				else:
+					bdata = bb.fetch(securities, fields)
+			except Exception, e:
+				self.checkin(bb, generation, False)
+				if attempt:
+					raise BackendError('%s:%d failed after reconnecting: %s' % (self.server, self.port, e))
+			else:
+				self.checkin(bb, generation)
+				return bdata
+
+	def subscribe(self, securities, fields, callback):
+		"""Streams on a session of its own, which stays out of the pool until close()"""
+		bb, generation = self.checkout()
+		if not hasattr(bb, 'subscribe'):
+			self.checkin(bb, generation)
+			raise NotImplementedError('this bloomburger has no subscriptions')
+		try:
+			bb.subscribe(securities, fields, lambda sec, values: callback([(sec, values)]))
+		except:
+			self.checkin(bb, generation, False)
+			raise
+		with self.cond:
+			if generation == self.generation:
+				self.streaming.append(bb)
+				return
+			self.opened -= 1
+		_disconnect(bb)
+
+
+def _disconnect(bb):
+	if hasattr(bb, 'disconnect'):
+		try:
+			bb.disconnect()
+		except Exception:
+			pass
+
+
+def connection(server='localhost', port=8194):
+	"""The process wide BloombergBackend for a server, made (but not connected) on first use"""
+	key = (server, port)
+	if key not in _connections:
+		_connections[key] = BloombergBackend(server, port)
+	return _connections[key]
+
+
+def close_all():
+	"""Close every shared session, they reconnect if used again"""
+	for bb in _connections.values():
+		bb.close()
+
+atexit.register(close_all)
+
+
+def _request(fields, interval, periodicity):
+	return (tuple(fields), interval, periodicity)
+
+def _dates(d0, d1):
+	return (d0 or None, d1 or None)
+
+
+class RecordingBackend(Backend):
+	"""Passes requests through to another backend (the shared bloomberg connection by default) and keeps
+	every response, per security, for save() to write out as a gzipped pickle that
+	ReplayBackend can serve back. Recording into an existing file adds to it."""
+
+	def __init__(self, fname, backend=None):
+		self.fname = fname
+		self.backend = connection() if backend is None else backend
+		try:
+			self.responses = _load(fname)
+		except IOError:
+			self.responses = {}
+
+	def connect(self, server='localhost', port=8194):
+		self.backend.connect(server, port)
+
+	def close(self):
+		self.backend.close()
+
+	def subscribe(self, securities, fields, callback):
+		self.backend.subscribe(securities, fields, callback)
+
+	def fetch(self, securities, fields, d0=None, d1=None, interval=0, periodicity=None):
+		bdata = self.backend.fetch(securities, fields, d0, d1, interval, periodicity)
+
+		req = _request(fields, interval, periodicity)
+		for sec in securities:
+			self.responses.setdefault((sec,) + req, {})[_dates(d0, d1)] = bdata.get(sec, [])
+		return bdata
+
+	def save(self):
+		ff = gzip.open(self.fname, 'wb')
+		cPickle.dump(self.responses, ff, cPickle.HIGHEST_PROTOCOL)
+		ff.close()
+
+
+def _load(fname):
+	ff = gzip.open(fname, 'rb')
+	try:
+		return cPickle.load(ff)
+	finally:
+		ff.close()
+
+
+class ReplayBackend(Backend):
+	"""Serves the responses recorded by a RecordingBackend. A request for dates that weren't
+	recorded (e.g. a live snap, whose futures are requested for 'now') gets the latest
+	recording of the same securities and fields. Securities never recorded get no data.
+
+	latency (seconds, plus up to jitter more) is slept on every request, and error_rate is
+	the probability of a request raising BackendError, so the snap pipeline can be timed
+	and its error handling exercised offline. hits and misses count securities served."""
+
+	def __init__(self, fname, latency=0.0, jitter=0.0, error_rate=0.0, seed=None):
+		self.responses = _load(fname)
+		self.latency = latency
+		self.jitter = jitter
+		self.error_rate = error_rate
+		self.rs = RandomState(seed)
+		self.requests = 0
+		self.hits = 0
+		self.misses = 0
+
+	def fetch(self, securities, fields, d0=None, d1=None, interval=0, periodicity=None):
+		self.requests += 1
+		delay = self.latency + self.jitter * self.rs.uniform()
+		if delay > 0.0:
+			time.sleep(delay)
+		if self.error_rate and self.rs.uniform() < self.error_rate:
+			raise BackendError('injected error')
+
+		req = _request(fields, interval, periodicity)
+		dates = _dates(d0, d1)
+		bdata = {}
+		for sec in securities:
+			recs = self.responses.get((sec,) + req)
+			if not recs:
+				self.misses += 1
+				bdata[sec] = []
+				continue
+			self.hits += 1
+			bdata[sec] = recs[dates] if dates in recs else recs[max(recs)]
+		return bdata
+
+
+class CachingBackend(Backend):
+	"""Keeps daily historical data for single dates before today, which never changes, in a 
+	sqlite file keyed by (ticker, field, date), and only asks the backend behind it (a
+	shared bloomberg connection by default) for what isn't there. A missing value (no data 
+	for the security that day, or not for that field) is only believed once it was fetched 
+	'settled' days after the date, since yesterday's settles may not be published yet, and 
+	is asked for again until then. Everything else (realtime, date ranges, other 
+	periodicities, intraday) goes straight through. hits and misses count securities looked 
+	up in the cache."""
+	
+	def __init__(self, fname, backend=None, settled=5):
+		self.backend = connection() if backend is None else backend
+		self.settled = settled
+		self.hits = 0
+		self.misses = 0
+		# requests can come from several pipeline threads at once
+		self.lock = threading.Lock()
+		self.conn = sqlite3.connect(fname, check_same_thread=False)
+		self.conn.execute('CREATE TABLE IF NOT EXISTS history (ticker TEXT, field TEXT, ' \
+			'date TEXT, value, fetched TEXT, PRIMARY KEY (ticker, field, date))')
+		# files from before fetched was kept, whose missing values are all asked for again
+		if 'fetched' not in [rr[1] for rr in self.conn.execute('PRAGMA table_info(history)')]:
+			self.conn.execute('ALTER TABLE history ADD COLUMN fetched TEXT')
+		self.conn.commit()
+		
+	def connect(self, server='localhost', port=8194):
+		self.backend.connect(server, port)
+		
+	def close(self):
+		self.backend.close()
+	
+	def subscribe(self, securities, fields, callback):
+		self.backend.subscribe(securities, fields, callback)
+		
+	def fetch(self, securities, fields, d0=None, d1=None, interval=0, periodicity=None):
+		if interval or not d0 or d0 != d1 or periodicity not in (None, 'DAILY') \
+			or date(d0.year, d0.month, d0.day) >= date.today():
+			return self.backend.fetch(securities, fields, d0, d1, interval, periodicity)
+			
+		day = d0.strftime('%Y-%m-%d')
+		cached = self.lookup(securities, fields, day)
+		missing = [sec for sec in securities if len(cached.get(sec, ())) < len(fields)]
+		self.hits += len(securities) - len(missing)
+		self.misses += len(missing)
+		
+		bdata = {}
+		if missing:
+			bdata = self.backend.fetch(missing, fields, d0, d1)
+			self.store(missing, fields, day, bdata)
+		for sec in securities:
+			if sec in bdata:
+				continue
+			values = [(ff, cached[sec][ff]) for ff in fields if cached.get(sec, {}).get(ff) is not None]
+			bdata[sec] = [[('date', d0)] + values] if values else []
+		return bdata
+		
+	def lookup(self, securities, fields, day):
+		"""{ticker: {field: value}} of whatever is cached for day, leaving out missing values
+		fetched too soon after it to be believed"""
+		settled = (datetime.strptime(day, '%Y-%m-%d') + timedelta(days=self.settled)).strftime('%Y-%m-%d')
+		cached = {}
+		with self.lock:
+			for ii in range(0, len(securities), 500):
+				chunk = securities[ii:ii+500]
+				cur = self.conn.execute('SELECT ticker, field, value, fetched FROM history WHERE ' \
+					'date = ? AND ticker IN (%s)' % ','.join('?' * len(chunk)), [day] + list(chunk))
+				for sec, ff, value, fetched in cur:
+					if ff in fields and (value is not None or (fetched or '') >= settled):
+						cached.setdefault(sec, {})[ff] = value
+		return cached
+		
+	def store(self, securities, fields, day, bdata):
+		fetched = date.today().strftime('%Y-%m-%d')
+		rows = []
+		for sec in securities:
+			values = dict(bdata[sec][0]) if bdata.get(sec) else {}
+			rows += [(sec, ff, day, values.get(ff), fetched) for ff in fields]
+		with self.lock:
+			self.conn.executemany('INSERT OR REPLACE INTO history (ticker, field, date, value, fetched) ' \
+				'VALUES (?, ?, ?, ?, ?)', rows)
+			self.conn.commit()
+
+
+class PrefetchBackend(Backend):
+	"""Answers requests from one response fetched up front (bdata, realtime or for the single 
+	date d0), and only sends the backend the securities that weren't in it. Realtime data also 
+	answers single date requests for today, since FOGrabber asks for live futures as of now. 
+	Everything else goes straight through. hits and misses count securities."""
+	
+	def __init__(self, backend, bdata, d0=None):
+		self.backend = backend
+		self.bdata = bdata
+		self.d0 = d0
+		self.hits = 0
+		self.misses = 0
+		
+	def connect(self, server='localhost', port=8194):
+		self.backend.connect(server, port)
+		
+	def close(self):
+		self.backend.close()
+	
+	def subscribe(self, securities, fields, callback):
+		self.backend.subscribe(securities, fields, callback)
+		
+	def fetch(self, securities, fields, d0=None, d1=None, interval=0, periodicity=None):
+		if not d0:
+			prefetched = self.d0 is None and not d1
+		else:
+			ref = self.d0 or date.today()
+			prefetched = d0 == d1 and date(d0.year, d0.month, d0.day) == date(ref.year, ref.month, ref.day)
+		if interval or periodicity not in (None, 'DAILY') or not prefetched:
+			return self.backend.fetch(securities, fields, d0, d1, interval, periodicity)
+			
+		missing = [sec for sec in securities if sec not in self.bdata]
+		self.hits += len(securities) - len(missing)
+		self.misses += len(missing)
+		bdata = self.backend.fetch(missing, fields, d0, d1) if missing else {}
+		
+		for sec in securities:
+			if sec in bdata:
+				continue
+			row = self.bdata[sec]
+			if self.d0 is not None:
+				row = row[0] if row else []
+			values = [fv for fv in row if fv[0] in fields]
+			if d0:
+				bdata[sec] = [[('date', d0)] + values] if values else []
+			else:
+				bdata[sec] = values
+		return bdata
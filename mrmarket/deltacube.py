@@ -0,0 +1,69 @@
+
+
+import pandas as pd
+from numpy import sqrt, log, isfinite, lexsort, searchsorted, clip, where, nan, arange, \
+	repeat, tile, array
+from collections import OrderedDict
+from scipy.stats import norm
+from exchange import Computus, XSpec
+from sabr import _smile_groups
+
+__all__ = ['DELTAS', 'cube']
+
+# cube columns and the call delta each one sits at, puts being labelled by their own delta
+DELTAS = OrderedDict([('C05', 0.05), ('C10', 0.1), ('C25', 0.25), ('C40', 0.4), ('ATM', 0.5), \
+	('P40', 0.6), ('P25', 0.75), ('P10', 0.9), ('P05', 0.95)])
+
+
+def cube(product, fopt, ffut, deltas=DELTAS):
+	"""Interpolate every (timestamp, month) smile of a stored history onto a fixed grid of
+	deltas. Each quoted strike is given the (undiscounted) call delta at its own vol, and the
+	vols are interpolated linearly in delta, all smiles in a single searchsorted over one
+	sorted (smile, delta) key. Deltas outside the quoted strikes are NaN rather than
+	extrapolated.
+
+	Takes frames like MrMarket.opt_settle / fut_settle and returns a dataframe indexed by
+	('timestamp', 'month') with one vol column per delta. E.g. with h4 = cube.xs('H4', 
+	level='month') the 25 delta risk reversal time series is h4.C25 - h4.P25."""
+	xs = XSpec().spec(product)
+	cdr = Computus().make(xs.computus)
+
+	if 'SETTLE_VOL' in fopt.columns:
+		vol = fopt['SETTLE_VOL'].values
+	else:
+		vol = fopt[['BID_VOL', 'ASK_VOL']].mean(axis=1).values
+
+	rows, groups = _smile_groups(xs, cdr, fopt, ffut)
+	fwd, t, gid = rows['fwd'].values, rows['t'].values, rows['gid'].values
+	strike = fopt.index.get_level_values('strike').values.astype(float)
+	good = isfinite(vol) & (vol > 0.0) & isfinite(fwd) & (t > 0.0)
+
+	vtau = where(good, vol * sqrt(where(good, t, 1.0)), 1.0)
+	if xs.model == 'normal':
+		cdelta = norm.cdf((fwd - strike) / vtau)
+	else:
+		cdelta = norm.cdf(log(where(good, fwd/strike, 1.0)) / vtau + 0.5*vtau)
+
+	# call deltas are in (0, 1), so gid*2 + delta sorts by smile then delta
+	nodes = where(good)[0]
+	nodes = nodes[lexsort((cdelta[nodes], gid[nodes]))]
+	nkey = gid[nodes] * 2.0 + cdelta[nodes]
+
+	grid = array(deltas.values())
+	qg = repeat(arange(len(groups)), len(grid))
+	qd = tile(grid, len(groups))
+	out = nan + qd
+
+	if len(nodes):
+		qkey = qg * 2.0 + qd
+		pos = searchsorted(nkey, qkey)
+		lo, hi = clip(pos - 1, 0, len(nodes) - 1), clip(pos, 0, len(nodes) - 1)
+		# the clip makes lo == hi past either end of the nodes, so check the key is between them
+		inside = (gid[nodes[lo]] == qg) & (gid[nodes[hi]] == qg) & (nkey[lo] <= qkey) & (qkey <= nkey[hi])
+		dkey = nkey[hi] - nkey[lo]
+		frac = where(dkey > 0.0, (qkey - nkey[lo]) / where(dkey > 0.0, dkey, 1.0), 0.0)
+		out = where(inside, vol[nodes[lo]] + frac * (vol[nodes[hi]] - vol[nodes[lo]]), nan)
+
+	return pd.DataFrame(out.reshape(len(groups), len(grid)), columns=deltas.keys(), \
+		index=pd.MultiIndex.from_arrays([groups['timestamp'].values, groups['month'].values], \
+		names=['timestamp', 'month']))
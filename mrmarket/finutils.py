@@ -1,7 +1,8 @@
-from numpy import sqrt, exp
+from numpy import sqrt, exp, log, where, asarray
 from scipy.stats import norm
 
-__all__ = ['svi_var', 'delta_implied_strike', 'delta_implied_strike_bn']
+__all__ = ['svi_var', 'delta_implied_strike', 'delta_implied_strike_bn', 'black_price', \
+	'black_price_bn', 'black_greeks', 'black_greeks_bn']
 
 	
 def delta_implied_strike(fwd, delta, vol, texp, dfac, otype):
@@ -24,3 +25,50 @@ def delta_implied_strike_bn(fwd, delta, vol, texp, dfac, otype):
 def svi_var(p, k):
 	"""Gatheral's SVI variance. 'k' is the log-strike relative to the forward"""
 	return p[0] + p[1]*(p[3]*(k-p[4]) + sqrt((k-p[4])*(k-p[4]) + p[2]*p[2]))
+	
+	
+def black_price(otype, fwd, strike, texp, vol, dfac=1.0):
+	"""Black prices for arrays of options, otype is an array of 'C' / 'P'"""
+	phi = where(asarray(otype) == 'C', 1.0, -1.0)
+	fwd, strike, vtau = asarray(fwd), asarray(strike), asarray(vol) * sqrt(texp)
+	d1 = log(fwd/strike)/vtau + 0.5*vtau
+	return dfac * phi * (fwd*norm.cdf(phi*d1) - strike*norm.cdf(phi*(d1 - vtau)))
+	
+	
+def black_price_bn(otype, fwd, strike, texp, vol, dfac=1.0):
+	"""Black-Normal (Bachelier) version of black_price above"""
+	phi = where(asarray(otype) == 'C', 1.0, -1.0)
+	fwd, strike, vtau = asarray(fwd), asarray(strike), asarray(vol) * sqrt(texp)
+	dd = (fwd - strike) / vtau
+	return dfac * (phi*(fwd - strike)*norm.cdf(phi*dd) + vtau*norm.pdf(dd))
+	
+	
+def black_greeks(otype, fwd, strike, texp, vol, dfac=1.0):
+	"""Black delta, gamma, vega and theta for arrays of options in one go. otype is an array
+	of 'C' / 'P'. Vega is per unit vol and theta is the decay per year."""
+	phi = where(asarray(otype) == 'C', 1.0, -1.0)
+	fwd, strike, texp, vol = asarray(fwd), asarray(strike), asarray(texp), asarray(vol)
+	vtau = vol * sqrt(texp)
+	d1 = log(fwd/strike)/vtau + 0.5*vtau
+	nd1 = norm.pdf(d1)
+	
+	delta = dfac * phi * norm.cdf(phi*d1)
+	gamma = dfac * nd1 / (fwd*vtau)
+	vega = dfac * fwd * nd1 * sqrt(texp)
+	theta = -0.5 * dfac * fwd * nd1 * vol / sqrt(texp)
+	return delta, gamma, vega, theta
+	
+	
+def black_greeks_bn(otype, fwd, strike, texp, vol, dfac=1.0):
+	"""Black-Normal (Bachelier) version of black_greeks above"""
+	phi = where(asarray(otype) == 'C', 1.0, -1.0)
+	fwd, strike, texp, vol = asarray(fwd), asarray(strike), asarray(texp), asarray(vol)
+	vtau = vol * sqrt(texp)
+	dd = (fwd - strike) / vtau
+	nd = norm.pdf(dd)
+	
+	delta = dfac * phi * norm.cdf(phi*dd)
+	gamma = dfac * nd / vtau
+	vega = dfac * nd * sqrt(texp)
+	theta = -0.5 * dfac * nd * vol / sqrt(texp)
+	return delta, gamma, vega, theta
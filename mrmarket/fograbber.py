@@ -7,20 +7,41 @@ from datetime import datetime, date
 from bisect import bisect_left
 from itertools import dropwhile, izip, ifilter
 from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from functools import wraps
 from numpy import sqrt
 import sqlite3
 
 from finutils import *
+from quotebook import QuoteBookBackend, FIELDS
+from backends import PrefetchBackend
+from metrics import tagged, span, timed, event
 
 __all__ = ['FOGrabber']
 
 EXCH_MONTHS = 'FGHJKMNQUVXZ'
 
+# every phase of a snap asks for all of these, so they can share each other's quotes
+LIVE_FIELDS = ['BID', 'ASK', 'VOLUME', 'BID_SIZE', 'ASK_SIZE']
+SETTLE_FIELDS = ['PX_SETTLE', 'VOLUME']
+
 # wrapper for black-scholes implied vol function (so it matches signature of black-normal one and
 # we can use function pointer thingies)
 def _impliedvol(cp, forward, strike, maturity, discount, premium):
 	return arachne.impliedvol(cp, forward, strike, maturity, 0.0, 0.0, premium/discount)
 	
+@contextmanager
+def _unfrozen():
+	yield
+	
+def _consistent(fn):
+	"""Run a snap inside self.frozen(), so all its live quotes are of the same moment"""
+	@wraps(fn)
+	def snap(self, *args, **kwargs):
+		with self.frozen():
+			return fn(self, *args, **kwargs)
+	return snap
+	
 class _OptR(object):
 	__slots__ = 'month', 'undl', 'expiry', 'act365', 'undlpx', 'atmk', 'atmv', 'data'
 	def __init__(self, month, undl, expiry):
@@ -39,20 +60,22 @@ class _OptR(object):
 	
 	
 class FOGrabber(object):
-	"""Retrieves F&O data from Bloomberg and shoves them into a Pandas dataframe"""
-	def __init__(self, specfile=None):
+	"""Retrieves F&O data from Bloomberg and shoves them into a Pandas dataframe. Pass a 
+	PandaBurger as pb to use something other than the shared live session (see backends)."""
+	def __init__(self, specfile=None, pb=None):
 		self.computus = Computus()
 		self.specs = XSpec(specfile)
 		self.date = datetime.now()
 		self.product = None
 		self.livedata = True
 		
-		self.pb = PandaBurger()
-		self.pb.connect('localhost', 8194)
+		self.pb = PandaBurger() if pb is None else pb
 	
 	
 	def reset(self, product, sdate, src=False):
 		self.xs = self.specs.spec(product)
+		self.quotes = {}
+		self.quote_hits = 0
 		self.product = product
 		self.cal = self.computus.make(self.xs.computus)
 		
@@ -60,9 +83,11 @@ class FOGrabber(object):
 		if self.xs.model == 'normal':
 			self.ivolfn = arachne.impliedvolbn
 			self.istrikefn = delta_implied_strike_bn
+			self.greeksfn = black_greeks_bn
 		else:
 			self.ivolfn = _impliedvol
 			self.istrikefn = delta_implied_strike
+			self.greeksfn = black_greeks
 			
 		dtoday = date.today()
 		if date(sdate.year, sdate.month, sdate.day) == date.today():
@@ -205,7 +230,7 @@ class FOGrabber(object):
 		
 		
 		
-	def calc_atm_vols(self, opts, undlpx, _product=None, _re=None):
+	def calc_atm_vols(self, opts, undlpx, _product=None, _re=None, pb=None):
 		tickers = []
 		
 		if _product is None:
@@ -227,11 +252,8 @@ class FOGrabber(object):
 				tickers.append(_product + rr.month + 'C ' + str(rr.atmk) + ' ' + self.suffix)
 				tickers.append(_product + rr.month + 'P ' + str(rr.atmk) + ' ' + self.suffix)
 						
-		if self.livedata:
-			bdata = self.pb.dump(tickers, ['BID','ASK','BID_SIZE','ASK_SIZE'])
-			#	'LAST_UPDATE_BID', 'LAST_UPDATE_ASK'])
-		else:
-			bdata = self.pb.dump(tickers, ['PX_SETTLE'], self.date)
+		with tagged('calc_atm_vols'), span('fetch'):
+			bdata = self.dump(tickers, pb)
 		
 		for tkr0, row0 in bdata.iteritems():
 			mmatch = _re.match(tkr0)
@@ -294,19 +316,39 @@ class FOGrabber(object):
 				else:				
 					opts[mm].atmv = self.ivolfn(otype0, opts[mm].undlpx, strike, opts[mm].act365, 1.0, px)
 					
-				print "(", mm, otype0, opts[mm].undlpx, strike, opts[mm].act365, 1.0, px, ") = ", opts[mm].atmv
+				event('atm_vol', '( %s %s %s %s %s 1.0 %s ) = %s' % (mm, otype0, opts[mm].undlpx, strike, \
+					opts[mm].act365, px, opts[mm].atmv), month=mm, type=otype0, fwd=opts[mm].undlpx, \
+					strike=strike, t=opts[mm].act365, px=px, vol=opts[mm].atmv)
 			except Exception, e:
-				print e
-				print "(", mm, otype0, opts[mm].undlpx, strike, opts[mm].act365, 1.0, px, ")"
+				event('atm_vol_failed', '%s\n( %s %s %s %s %s 1.0 %s )' % (e, mm, otype0, opts[mm].undlpx, \
+					strike, opts[mm].act365, px), month=mm, type=otype0, fwd=opts[mm].undlpx, \
+					strike=strike, t=opts[mm].act365, px=px, error=str(e))
 				del opts[mm]
 		
 	
-	def bulk_fetch(self, tickers, optr, _re=None):
-		if self.livedata:
-			bdata = self.pb.dump(tickers, ['BID','ASK','VOLUME','BID_SIZE','ASK_SIZE'])
-		else:
-			bdata = self.pb.dump(tickers, ['PX_SETTLE','VOLUME'], self.date)
+	def dump(self, tickers, pb=None):
+		"""Raw LIVE_FIELDS or SETTLE_FIELDS data for option tickers, through a cache of the 
+		quotes already fetched for this snap (reset clears it), so e.g. the ATM pairs of 
+		calc_atm_vols aren't fetched again by get_options_by_delta. Only the tickers not seen 
+		yet go to pb.dump (self.pb by default), quote_hits counts the others."""
+		pb = self.pb if pb is None else pb
+		tickers = list(tickers)
+		missing = [tt for tt in tickers if not tt in self.quotes]
+		self.quote_hits += len(tickers) - len(missing)
+		if missing:
+			if self.livedata:
+				self.quotes.update(pb.dump(missing, LIVE_FIELDS))
+			else:
+				self.quotes.update(pb.dump(missing, SETTLE_FIELDS, self.date))
+		return {tt: self.quotes.get(tt, []) for tt in tickers}
+		
+	def bulk_fetch(self, tickers, optr, _re=None, pb=None):
+		with tagged('bulk_fetch'), span('fetch'):
+			bdata = self.dump(tickers, pb)
+		with span('vols'):
+			self._bulk_vols(bdata, optr, _re)
 			
+	def _bulk_vols(self, bdata, optr, _re=None):
 		if _re is None:
 			_re = self.optregex
 			
@@ -318,7 +360,7 @@ class FOGrabber(object):
 				strike = float(mmatch.group('k'))
 				data = {}
 			except:
-				print tkr
+				event('bad_ticker', tkr, ticker=tkr)
 				exit()	
 			
 			if not row:
@@ -339,8 +381,9 @@ class FOGrabber(object):
 					if ask > 0 and onask > 0:
 						avol = self.ivolfn(otype, optr[mm].undlpx, strike, optr[mm].act365, 1.0, ask)
 				except:
-					print "Failed to calculate vol for ", tkr, 
-					print optr[mm].undlpx, strike, optr[mm].act365, "("+str(bid)+"|"+str(ask)+")"
+					event('vol_failed', 'Failed to calculate vol for %s %s %s %s (%s|%s)' % (tkr, \
+						optr[mm].undlpx, strike, optr[mm].act365, bid, ask), ticker=tkr, \
+						fwd=optr[mm].undlpx, strike=strike, t=optr[mm].act365, bid=bid, ask=ask)
 		
 				optr[mm].data.append((strike, otype, bid, bvol, ask, avol, volume))
 			else:
@@ -354,7 +397,7 @@ class FOGrabber(object):
 				optr[mm].data.append((strike, otype, px, ivol, volume))
 	
 	
-	def get_options_by_delta(self, optr, deltas, _product=None, _re=None):
+	def get_options_by_delta(self, optr, deltas, _product=None, _re=None, pb=None):
 		"""tada"""
 		if _product is None:
 			_product = self.product
@@ -363,34 +406,36 @@ class FOGrabber(object):
 		kstep = self.xs.strikeStep
 		tickers = set()
 		
-		for rr in optr.values():
-			kcall = rr.atmk if rr.atmk > rr.undlpx else rr.atmk + kstep
-			kput = kcall - kstep
-			tickers.add(_product+rr.month+'P '+str(kput)+' '+ self.suffix)
-			tickers.add(_product+rr.month+'C '+str(kcall)+' '+ self.suffix)
-			
-			for da in deltas:
-				try:
-					kput = kstep*int(self.istrikefn(rr.undlpx,-da,rr.atmv,rr.act365,1.0,'P')/kstep)
-					kcall = kstep*int(1.0+self.istrikefn(rr.undlpx,da,rr.atmv,rr.act365,1.0,'C')/kstep)
-				except:
-					print rr.month, 
-					print "failed with ", rr.undlpx, da, rr.atmv, rr.act365
-					continue
-			
+		with span('strikes'):
+			for rr in optr.values():
+				kcall = rr.atmk if rr.atmk > rr.undlpx else rr.atmk + kstep
+				kput = kcall - kstep
 				tickers.add(_product+rr.month+'P '+str(kput)+' '+ self.suffix)
 				tickers.add(_product+rr.month+'C '+str(kcall)+' '+ self.suffix)
+			
+				for da in deltas:
+					try:
+						kput = kstep*int(self.istrikefn(rr.undlpx,-da,rr.atmv,rr.act365,1.0,'P')/kstep)
+						kcall = kstep*int(1.0+self.istrikefn(rr.undlpx,da,rr.atmv,rr.act365,1.0,'C')/kstep)
+					except:
+						event('strike_failed', '%s failed with  %s %s %s %s' % (rr.month, rr.undlpx, da, \
+							rr.atmv, rr.act365), month=rr.month, fwd=rr.undlpx, delta=da, vol=rr.atmv, \
+							t=rr.act365)
+						continue
+			
+					tickers.add(_product+rr.month+'P '+str(kput)+' '+ self.suffix)
+					tickers.add(_product+rr.month+'C '+str(kcall)+' '+ self.suffix)
 				
-				rr.data = []
+					rr.data = []
 			
 		#for tt in tickers:
 		#	if tt[:4] == 'TYM3':
 		#		print tt
 			
-		self.bulk_fetch(tickers, optr, _re)
+		self.bulk_fetch(tickers, optr, _re, pb)
 		for rr in optr.values():
 			rr.data.sort(lambda x,y: (x[0]>y[0]) - (x[0]<y[0]))
-		
+			
 		
 	def get_options_by_volume(self, optr, nn=10, mindelta=0.05, _product=None, _re=None):
 		"""Gets price data for the n most traded strikes by volume for the given expiry.
@@ -403,16 +448,17 @@ class FOGrabber(object):
 		kstep = self.xs.strikeStep
 		tickers = []
 		
-		for rr in optr.values():
-			klo = kstep*int(self.istrikefn(rr.undlpx,-mindelta,rr.atmv,rr.act365,1.0,'P')/kstep)
-			khi = kstep*int(1+self.istrikefn(rr.undlpx,mindelta,rr.atmv,rr.act365,1.0,'C')/kstep)
-			
-			while klo <= khi:
-				tickers.append(_product + rr.month + 'PC'[klo>rr.undlpx] + ' ' \
-				+ str(klo) + ' ' + self.suffix)
-				klo += kstep
+		with span('strikes'):
+			for rr in optr.values():
+				klo = kstep*int(self.istrikefn(rr.undlpx,-mindelta,rr.atmv,rr.act365,1.0,'P')/kstep)
+				khi = kstep*int(1+self.istrikefn(rr.undlpx,mindelta,rr.atmv,rr.act365,1.0,'C')/kstep)
 				
-			rr.data = []
+				while klo <= khi:
+					tickers.append(_product + rr.month + 'PC'[klo>rr.undlpx] + ' ' \
+					+ str(klo) + ' ' + self.suffix)
+					klo += kstep
+					
+				rr.data = []
 				
 		self.bulk_fetch(tickers, optr, _re)
 		# keep the top n by volume (sorted by strike)
@@ -422,10 +468,37 @@ class FOGrabber(object):
 			rr.data.sort(lambda x,y: (x[0]>y[0]) - (x[0]<y[0]))
 		
 	
-	def snap_largest_volume(self, product, sdate, nn=10, midcurves=True):
+	def options_frame(self, optr, mcoptr, columns, greeks=True):
+		"""Assemble the option records of a snap into a dataframe indexed by (month, strike).
+		With greeks=True also adds DELTA, GAMMA, VEGA and THETA columns, calculated for the
+		whole grid at once from each row's forward, expiry and (mid) vol."""
+		rows = [(rr, x) for opts in (optr, mcoptr) for mm in sorted(opts) \
+			for rr in [opts[mm]] for x in rr.data]
+		
+		idx = pd.MultiIndex.from_tuples([(rr.month, x[0]) for rr, x in rows], \
+			names=['month', 'strike'])	
+		odata = pd.DataFrame([list(x[2:]) for rr, x in rows], columns = columns, index = idx)
+		
+		if greeks and rows:
+			if 'SETTLE_VOL' in odata:
+				vol = odata['SETTLE_VOL'].values
+			else:
+				vol = odata[['BID_VOL', 'ASK_VOL']].mean(axis=1).values
+			
+			odata['DELTA'], odata['GAMMA'], odata['VEGA'], odata['THETA'] = self.greeksfn( \
+				[x[1] for rr, x in rows], [rr.undlpx for rr, x in rows], \
+				[x[0] for rr, x in rows], [rr.act365 for rr, x in rows], vol)
+		
+		return odata
+		
+	
+	@timed('snap_largest_volume')
+	@_consistent
+	def snap_largest_volume(self, product, sdate, nn=10, midcurves=True, greeks=True):
 		"""Snap options grid and get the 10 most traded by volume for each month.
 		"""
-		self.reset(product, sdate)
+		with span('reset'):
+			self.reset(product, sdate)
 		
 		if self.livedata:
 			ffields = ['BID', 'ASK', 'VOLUME']
@@ -435,60 +508,88 @@ class FOGrabber(object):
 			ffields = ['PX_SETTLE', 'VOLUME']
 			_columns = ['SETTLE', 'SETTLE_VOL', 'VOLUME']
 		
-		fdata = pd.DataFrame.from_records(self.futures_chain(), columns=['mon', 'last_trade'], index='mon')
-		fdata.insert(0, 'ticker', [self.product+mm+' '+self.suffix for mm in fdata.index])
-		fdata = pd.merge(fdata, self.pb.fetch(fdata.ticker, ffields, self.date), left_on='ticker', \
-			right_index=True, how='outer')
+		with span('chains'):
+			futures, optr = self.futures_chain(), self.options_chain()
+		with span('futures'):
+			fdata = pd.DataFrame.from_records(futures, columns=['mon', 'last_trade'], index='mon')
+			fdata.insert(0, 'ticker', [self.product+mm+' '+self.suffix for mm in fdata.index])
+			fdata = pd.merge(fdata, self.pb.fetch(fdata.ticker, ffields, self.date), left_on='ticker', \
+				right_index=True, how='outer')
 			
 		if not 'VOLUME' in fdata:
 			raise Exception("No futures volume on " + sdate.strftime("%Y-%m-%d"))
-			
-		optr = self.options_chain()
 		
 		# discard months with no volume
 		optr = {k:v for k,v in optr.iteritems() if pd.notnull(fdata.VOLUME[v.undl])}
 		
-		if self.livedata:
-			self.calc_atm_vols(optr, 0.5*(fdata.BID+fdata.ASK))
-		else:
-			self.calc_atm_vols(optr, fdata.PX_SETTLE)
+		with span('atm_vols'):
+			if self.livedata:
+				self.calc_atm_vols(optr, 0.5*(fdata.BID+fdata.ASK))
+			else:
+				self.calc_atm_vols(optr, fdata.PX_SETTLE)
 		
 		self.get_options_by_volume(optr, nn)
 		
 		if pd.notnull(self.xs.midcurves) and midcurves:
-			mcoptr = self.midcurves_chain()
+			with span('chains'):
+				mcoptr = self.midcurves_chain()
 			mcre = re.compile('^(?P<mm>\d' + self.xs.midcurves[1] + \
 				'[FGHJKMNQUVXZ]\d{1})(?P<type>[PC])\s(?P<k>\d+(\.\d+)?) ' + self.suffix + '$')
-			if self.livedata:
-				mcoptr = {k:v for k,v in mcoptr.iteritems() if pd.notnull(fdata.BID[v.undl])
-					and pd.notnull(fdata.ASK[v.undl])}
-				self.calc_atm_vols(mcoptr, 0.5*(fdata.BID+fdata.ASK), '', mcre)
-			else:
-				mcoptr = {k:v for k,v in mcoptr.iteritems() if pd.notnull(fdata.VOLUME[v.undl])}
-				self.calc_atm_vols(mcoptr, fdata.PX_SETTLE, '', mcre)
+			with span('atm_vols'):
+				if self.livedata:
+					mcoptr = {k:v for k,v in mcoptr.iteritems() if pd.notnull(fdata.BID[v.undl])
+						and pd.notnull(fdata.ASK[v.undl])}
+					self.calc_atm_vols(mcoptr, 0.5*(fdata.BID+fdata.ASK), '', mcre)
+				else:
+					mcoptr = {k:v for k,v in mcoptr.iteritems() if pd.notnull(fdata.VOLUME[v.undl])}
+					self.calc_atm_vols(mcoptr, fdata.PX_SETTLE, '', mcre)
 				
 			self.get_options_by_volume(mcoptr, nn, 0.05, '', mcre)
 		else:
 			mcoptr = []
 		
-		idx = pd.MultiIndex.from_tuples( \
-			[(mm,kk[0]) for mm in sorted(optr) for kk in optr[mm].data] \
-				+ [(mc,kk[0]) for mc in sorted(mcoptr) for kk in mcoptr[mc].data], \
-			names=['month', 'strike'])	
-		odata = pd.DataFrame( \
-			[list(x[2:]) for mm in sorted(optr) for x in optr[mm].data]
-				+ [list(x[2:]) for mc in sorted(mcoptr) for x in mcoptr[mc].data], \
-			columns = _columns, \
-			index = idx)
-			
-		return fdata, odata
+		event('quotes', 'Fetched %d option quotes, reused %d' % (len(self.quotes), self.quote_hits), \
+			every=0, fetched=len(self.quotes), reused=self.quote_hits)
+		with span('frame'):
+			return fdata, self.options_frame(optr, mcoptr, _columns, greeks)
 		
 	
-	def snap_by_delta(self, product, sdate, deltas=[0.05,0.1,0.25,0.4], midcurves=True):
+	@timed('snap_by_delta')
+	@_consistent
+	def snap_by_delta(self, product, sdate, deltas=[0.05,0.1,0.25,0.4], midcurves=True, greeks=True, \
+		prev=None, band=2):
 		"""Snap live or settlement options prices by a list of deltas, whose implied
-		strikes are determined using the ATM vol for simplicity."""
-		self.reset(product, sdate)
+		strikes are determined using the ATM vol for simplicity.
 		
+		If prev is a {month: (forward, ATM vol)} of the last snapshot, the futures and options 
+		the snap will want are guessed from it (see predict_tickers) and fetched in one request. 
+		The usual steps then run against that, and only strikes outside the guess (the forward 
+		having moved more than 'band' strikes) go to Bloomberg in a second, small request."""
+		with span('reset'):
+			self.reset(product, sdate)
+		
+		if prev is None:
+			return self._snap_by_delta(deltas, midcurves, greeks, self.pb)
+			
+		with span('prefetch'):
+			if self.livedata:
+				bdata = self.pb.dump(self.predict_tickers(prev, deltas, band, midcurves), LIVE_FIELDS)
+				prefetch = PrefetchBackend(self.pb.backend, bdata)
+			else:
+				bdata = self.pb.dump(self.predict_tickers(prev, deltas, band, midcurves), \
+					SETTLE_FIELDS, self.date)
+				prefetch = PrefetchBackend(self.pb.backend, bdata, self.date)
+		# the prefetch wraps self.pb's backend (and so its cache), and records into its metrics
+		pb = PandaBurger(prefetch, metrics=self.pb.metrics)
+		pb.periodicity = self.pb.periodicity
+		try:
+			return self._snap_by_delta(deltas, midcurves, greeks, pb)
+		finally:
+			event('prefetch', 'Prefetched %d corrected %d' % (prefetch.hits, prefetch.misses), \
+				every=0, hits=prefetch.hits, misses=prefetch.misses)
+			
+	def _snap_by_delta(self, deltas, midcurves, greeks, pb):
+		"""The body of snap_by_delta, after reset, with all requests going to pb"""
 		if self.livedata:
 			ffields = ['BID', 'ASK', 'VOLUME']
 			_columns = ['BID', 'BID_VOL', 'ASK', 'ASK_VOL', 'VOLUME']
@@ -496,58 +597,128 @@ class FOGrabber(object):
 			ffields = ['PX_SETTLE', 'VOLUME']
 			_columns = ['SETTLE', 'SETTLE_VOL', 'VOLUME']
 		
-		fdata = pd.DataFrame.from_records(self.futures_chain(), columns=['mon', 'last_trade'], index='mon')
-		fdata.insert(0, 'ticker', [self.product+mm+' '+self.suffix for mm in fdata.index])
-		fdata = pd.merge(fdata, self.pb.fetch(fdata.ticker, ffields, self.date), left_on='ticker', \
-			right_index=True, how='outer')
+		with span('chains'):
+			futures, optr = self.futures_chain(), self.options_chain()
+		with span('futures'):
+			fdata = pd.DataFrame.from_records(futures, columns=['mon', 'last_trade'], index='mon')
+			fdata.insert(0, 'ticker', [self.product+mm+' '+self.suffix for mm in fdata.index])
+			fdata = pd.merge(fdata, pb.fetch(fdata.ticker, ffields, self.date), left_on='ticker', \
+				right_index=True, how='outer')
 			
 		if not 'VOLUME' in fdata:
-			raise Exception("No futures volume on " + sdate.strftime("%Y-%m-%d"))
-		
-	
-		optr = self.options_chain()
+			raise Exception("No futures volume on " + self.date.strftime("%Y-%m-%d"))
 		
 		# Calc ATM vols and ignore options whose futures are dead
-		if self.livedata:
-			optr = {k:v for k,v in optr.iteritems() if pd.notnull(fdata.BID[v.undl])
-				and pd.notnull(fdata.ASK[v.undl])}
-			self.calc_atm_vols(optr, 0.5*(fdata.BID+fdata.ASK))
-		else:
-			optr = {k:v for k,v in optr.iteritems() if pd.notnull(fdata.VOLUME[v.undl])} # what if no volume field ???
-			self.calc_atm_vols(optr, fdata.PX_SETTLE)
+		with span('atm_vols'):
+			if self.livedata:
+				optr = {k:v for k,v in optr.iteritems() if pd.notnull(fdata.BID[v.undl])
+					and pd.notnull(fdata.ASK[v.undl])}
+				self.calc_atm_vols(optr, 0.5*(fdata.BID+fdata.ASK), pb=pb)
+			else:
+				optr = {k:v for k,v in optr.iteritems() if pd.notnull(fdata.VOLUME[v.undl])} # what if no volume field ???
+				self.calc_atm_vols(optr, fdata.PX_SETTLE, pb=pb)
 			
-		self.get_options_by_delta(optr, deltas)
+		self.get_options_by_delta(optr, deltas, pb=pb)
 
 		
 		if pd.notnull(self.xs.midcurves) and midcurves:
-			mcoptr = self.midcurves_chain()
+			with span('chains'):
+				mcoptr = self.midcurves_chain()
 			#print '^(?P<mm>\d' + self.xs.midcurves[1] + \
 			#	'[FGHJKMNQUVXZ]\d{1})(?P<type>[PC])\s(?P<k>\d+(\.\d+)?) ' + self.xs.suffix + '$'
 			mcre = re.compile('^(?P<mm>\d' + self.xs.midcurves[1] + \
 				'[FGHJKMNQUVXZ]\d{1})(?P<type>[PC])\s(?P<k>\d+(\.\d+)?) ' + self.suffix + '$')
-			if self.livedata:
-				mcoptr = {k:v for k,v in mcoptr.iteritems() if pd.notnull(fdata.BID[v.undl])
-					and pd.notnull(fdata.ASK[v.undl])}
-				self.calc_atm_vols(mcoptr, 0.5*(fdata.BID+fdata.ASK), '', mcre)
-			else:
-				mcoptr = {k:v for k,v in mcoptr.iteritems() if pd.notnull(fdata.VOLUME[v.undl])}
-				self.calc_atm_vols(mcoptr, fdata.PX_SETTLE, '', mcre)
+			with span('atm_vols'):
+				if self.livedata:
+					mcoptr = {k:v for k,v in mcoptr.iteritems() if pd.notnull(fdata.BID[v.undl])
+						and pd.notnull(fdata.ASK[v.undl])}
+					self.calc_atm_vols(mcoptr, 0.5*(fdata.BID+fdata.ASK), '', mcre, pb)
+				else:
+					mcoptr = {k:v for k,v in mcoptr.iteritems() if pd.notnull(fdata.VOLUME[v.undl])}
+					self.calc_atm_vols(mcoptr, fdata.PX_SETTLE, '', mcre, pb)
 				
-			self.get_options_by_delta(mcoptr, deltas, '', mcre)
+			self.get_options_by_delta(mcoptr, deltas, '', mcre, pb)
 		else:
 			mcoptr = []
 				
-		idx = pd.MultiIndex.from_tuples( \
-			[(mm,kk[0]) for mm in sorted(optr) for kk in optr[mm].data] \
-				+ [(mc,kk[0]) for mc in sorted(mcoptr) for kk in mcoptr[mc].data], \
-			names=['month', 'strike'])	
-		odata = pd.DataFrame( \
-			[list(x[2:]) for mm in sorted(optr) for x in optr[mm].data]
-				+ [list(x[2:]) for mc in sorted(mcoptr) for x in mcoptr[mc].data], \
-			columns = _columns, \
-			index = idx)
+		event('quotes', 'Fetched %d option quotes, reused %d' % (len(self.quotes), self.quote_hits), \
+			every=0, fetched=len(self.quotes), reused=self.quote_hits)
+		with span('frame'):
+			return fdata, self.options_frame(optr, mcoptr, _columns, greeks)
+		
+	def stream(self, product, width=20, poll=1.0):
+		"""Keep live quotes for product's futures and options within 'width' strike steps of 
+		the ATM of each expiry in an in-memory book (see quotebook), so live snaps read memory 
+		rather than polling Bloomberg. Calling it again re-centres the band on the current 
+		forwards and drops the strikes outside it. Snaps add any other strikes they need as 
+		they go, until the next call."""
+		if not isinstance(self.pb.backend, QuoteBookBackend):
+			self.pb.backend = QuoteBookBackend(self.pb.backend, poll)
+		book = self.pb.backend
+		self.reset(product, datetime.now())
+		
+		futures = [self.product+mm+' '+self.suffix for mm, lt in self.futures_chain()]
+		fdata = self.pb.fetch(futures, FIELDS)
+		if not 'BID' in fdata or not 'ASK' in fdata:
+			raise Exception("No live futures quotes for " + product)
+		fdata.index = [tt[len(self.product):tt.index(' ')] for tt in fdata.index]
+		fwd = 0.5*(fdata.BID + fdata.ASK)
+		
+		kstep = self.xs.strikeStep
+		tickers = list(futures)
+		for rr in self.options_chain().values():
+			if not rr.undl in fwd or pd.isnull(fwd[rr.undl]):
+				continue
+			atmk = kstep * int(0.5 + fwd[rr.undl]/kstep)
+			for ii in range(-width, width + 1):
+				for otype in 'CP':
+					tickers.append(self.product + rr.month + otype + ' ' + str(atmk + ii*kstep) + \
+						' ' + self.suffix)
+		keep = set(tickers)
+		with book.book.lock:
+			stale = [tt for tt in book.book.rows if tt not in keep]
+		book.drop(stale)
+		book.watch(tickers)
+		
+	def frozen(self):
+		"""Context in which all reads of the quote book (if streaming), including those of 
+		the pipeline's workers, see one moment, so a live snap is consistent across its requests"""
+		if isinstance(self.pb.backend, QuoteBookBackend):
+			return self.pb.backend.book.frozen()
+		return _unfrozen()
+		
+	def predict_tickers(self, prev, deltas, band=2, midcurves=True):
+		"""The futures and option tickers snap_by_delta should ask for, given prev, a {month: 
+		(forward, ATM vol)} of the last snapshot. Each predicted strike comes with 'band' more 
+		either side of it, in case the forward has moved. Call after reset."""
+		tickers = set([self.product+mm+' '+self.suffix for mm, lt in self.futures_chain()])
+		chains = [(self.product, self.options_chain())]
+		if midcurves and self.has_midcurves():
+			chains.append(('', self.midcurves_chain()))
 		
-		return fdata, odata
+		kstep = self.xs.strikeStep
+		for _product, optr in chains:
+			for rr in optr.values():
+				if not rr.month in prev:
+					continue
+				fwd, atmv = prev[rr.month]
+				act365 = (rr.expiry - self.date).days / 365.0 + (rr.expiry - self.date).seconds / 31536000.0
+				if act365 < 1.0e-6 or not atmv > 0.0:
+					continue
+				
+				# strike numbers, as in calc_atm_vols and get_options_by_delta
+				nn = set([int(0.5 + fwd/kstep)])
+				for da in deltas:
+					try:
+						nn.add(int(self.istrikefn(fwd,-da,atmv,act365,1.0,'P')/kstep))
+						nn.add(int(1.0+self.istrikefn(fwd,da,atmv,act365,1.0,'C')/kstep))
+					except:
+						continue
+				for kk in set([n0 + ii for n0 in nn for ii in range(-band, band + 1)]):
+					tickers.add(_product+rr.month+'C '+str(kstep*kk)+' '+self.suffix)
+					tickers.add(_product+rr.month+'P '+str(kstep*kk)+' '+self.suffix)
+		
+		return list(tickers)
 		
 	def has_midcurves(self):
 		return pd.notnull(self.xs.midcurves)
@@ -0,0 +1,254 @@
+
+
+import threading, time, json
+import pandas as pd
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from bisect import bisect_left
+from functools import wraps
+
+__all__ = ['Call', 'Metrics', 'METRICS', 'tagged', 'current_tag', 'BUCKETS', 'Profile', 'PROFILE', \
+	'span', 'timed', 'event']
+
+# one backend request. rows is the number of securities (realtime) or date / time rows
+# (historical, intraday) that came back, retries the attempts after the first, errors the
+# attempts that failed and error the last failure's message
+Call = namedtuple('Call', 'time op tag securities fields rows seconds retries errors error')
+
+_local = threading.local()
+
+
+@contextmanager
+def tagged(tag):
+	"""Label the Bloomberg traffic of a block of code, e.g.
+		with tagged('calc_atm_vols'):
+			bdata = self.pb.dump(tickers, fields)
+	Tags nest, so traffic from calc_atm_vols during a save_settle_data is tagged
+	'save_settle_data/calc_atm_vols'."""
+	stack = getattr(_local, 'tags', [])
+	_local.tags = stack + [tag]
+	try:
+		yield
+	finally:
+		_local.tags = stack
+
+
+def current_tag():
+	return '/'.join(getattr(_local, 'tags', []))
+
+
+# running totals kept per (op, tag), for export as counters
+_TOTALS = ['calls', 'securities', 'rows', 'seconds', 'retries', 'errors']
+
+
+class Metrics(object):
+	"""Ring buffer of the last 'size' Calls, plus running totals by op and tag that don't 
+	forget. Safe to record into from several threads."""
+
+	def __init__(self, size=10000):
+		self.calls = deque(maxlen=size)
+		self.totals = {}
+		self.lock = threading.Lock()
+
+	def record(self, op, tag, securities, fields, rows, seconds, retries=0, errors=0, error=''):
+		with self.lock:
+			self.calls.append(Call(time.time(), op, tag, securities, fields, rows, seconds, \
+				retries, errors, str(error)))
+			tt = self.totals.setdefault((op, tag), [0] * len(_TOTALS))
+			for ii, vv in enumerate((1, securities, rows, seconds, retries, errors)):
+				tt[ii] += vv
+
+	def clear(self):
+		with self.lock:
+			self.calls.clear()
+			self.totals.clear()
+
+	def frame(self, op=None, tag=None, since=None):
+		"""The recorded calls as a dataframe, optionally only those of one op or tag, or since
+		a time.time()"""
+		with self.lock:
+			calls = list(self.calls)
+		calls = [cc for cc in calls if (op is None or cc.op == op) and (tag is None or cc.tag == tag) \
+			and (since is None or cc.time >= since)]
+		return pd.DataFrame.from_records(calls, columns=Call._fields)
+
+	def summary(self):
+		"""Calls, securities, rows, seconds (total and worst), retries and errors by op and tag,
+		over the calls still in the buffer"""
+		df = self.frame()
+		grouped = df.groupby(['op', 'tag'])
+		out = grouped[['securities', 'rows', 'seconds', 'retries', 'errors']].sum()
+		out.insert(0, 'calls', grouped.size())
+		out['max_seconds'] = grouped['seconds'].max()
+		return out
+
+	def to_csv(self, fname):
+		self.frame().to_csv(fname, index=False)
+
+	def to_json(self, fname):
+		with self.lock:
+			calls = [cc._asdict() for cc in self.calls]
+		ff = open(fname, 'w')
+		json.dump(calls, ff)
+		ff.close()
+
+	def to_prometheus(self, fname, prefix='mrmarket_bloomberg'):
+		"""Write the running totals as Prometheus counters, in the text format read by the 
+		node exporter's textfile collector"""
+		names = ['requests_total', 'securities_total', 'rows_total', 'request_seconds_total', \
+			'retries_total', 'errors_total']
+		with self.lock:
+			totals = sorted((key, list(tt)) for key, tt in self.totals.iteritems())
+
+		lines = []
+		for ii, name in enumerate(names):
+			lines.append('# TYPE %s_%s counter' % (prefix, name))
+			for (op, tag), tt in totals:
+				lines.append('%s_%s{op="%s",tag="%s"} %s' % (prefix, name, op, tag, repr(float(tt[ii]))))
+
+		ff = open(fname, 'w')
+		ff.write('\n'.join(lines) + '\n')
+		ff.close()
+
+
+# what PandaBurgers record into unless given their own
+METRICS = Metrics()
+
+
+# upper bounds, in seconds, of the span latency histogram buckets (the last is unbounded)
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+
+class Profile(object):
+	"""Where the time in a snap goes. span(name) times a block into a latency histogram for 
+	its stage, kept across runs until clear(). Spans nest like tags, so e.g. the vol solve of 
+	the settle save in MrMarket.snap is 'snap/settle/snap_by_delta/vols'. Spans cost nothing 
+	until enabled is set.
+	
+	event(name, message, **fields) is for progress and diagnostics. Events are kept (the 
+	last 'size' of them), with their fields, and the message printed, but no more than one 
+	per name every 'every' seconds, so a bad expiry doesn't fill the screen with failed 
+	solves. The next one printed says how many were held back. Progress lines pass every=0 
+	so none of them are held back."""
+	
+	def __init__(self, enabled=False, size=1000, every=1.0):
+		self.enabled = enabled
+		self.every = every
+		self.events = deque(maxlen=size)
+		self.stages = {}
+		self.printed = {}
+		self.held = {}
+		self.lock = threading.Lock()
+		self._local = threading.local()
+		
+	def clear(self):
+		with self.lock:
+			self.events.clear()
+			self.stages.clear()
+			self.printed.clear()
+			self.held.clear()
+		
+	@contextmanager
+	def span(self, name):
+		if not self.enabled:
+			yield
+			return
+		stack = getattr(self._local, 'spans', [])
+		self._local.spans = stack + [name]
+		t0 = time.time()
+		try:
+			yield
+		finally:
+			self._local.spans = stack
+			self.observe('/'.join(stack + [name]), time.time() - t0)
+			
+	def observe(self, stage, seconds):
+		with self.lock:
+			st = self.stages.get(stage)
+			if st is None:
+				st = self.stages[stage] = {'count': 0, 'seconds': 0.0, 'max': 0.0, \
+					'buckets': [0] * (len(BUCKETS) + 1)}
+			st['count'] += 1
+			st['seconds'] += seconds
+			st['max'] = max(st['max'], seconds)
+			st['buckets'][bisect_left(BUCKETS, seconds)] += 1
+			
+	def event(self, name, message, every=None, **fields):
+		now = time.time()
+		with self.lock:
+			self.events.append({'time': now, 'name': name, 'message': message, 'fields': fields})
+			if now - self.printed.get(name, 0.0) < (self.every if every is None else every):
+				self.held[name] = self.held.get(name, 0) + 1
+				return
+			self.printed[name] = now
+			held = self.held.pop(name, 0)
+		if held:
+			message += ' (%d more %s held back)' % (held, name)
+		print message
+		
+	def summary(self, leaf=False):
+		"""count, total, mean and worst seconds and the median / 90% / 99% bucket bounds per 
+		stage. With leaf=True stages are grouped by their last name (all the 'vols' spans 
+		together, say) rather than by where they were called from."""
+		with self.lock:
+			stages = [(kk.split('/')[-1] if leaf else kk, dict(st, buckets=list(st['buckets']))) \
+				for kk, st in self.stages.iteritems()]
+		merged = {}
+		for kk, st in stages:
+			mm = merged.setdefault(kk, {'count': 0, 'seconds': 0.0, 'max': 0.0, \
+				'buckets': [0] * (len(BUCKETS) + 1)})
+			mm['count'] += st['count']
+			mm['seconds'] += st['seconds']
+			mm['max'] = max(mm['max'], st['max'])
+			mm['buckets'] = [aa + bb for aa, bb in zip(mm['buckets'], st['buckets'])]
+			
+		rows = []
+		for kk in sorted(merged):
+			mm = merged[kk]
+			rows.append([kk, mm['count'], mm['seconds'], mm['seconds'] / mm['count'], mm['max']] + \
+				[_quantile(mm['buckets'], qq, mm['max']) for qq in (0.5, 0.9, 0.99)])
+		return pd.DataFrame.from_records(rows, columns=['stage', 'count', 'seconds', 'mean', \
+			'max', 'p50', 'p90', 'p99'], index='stage')
+			
+	def to_json(self, fname):
+		"""The stage histograms (as counts per bucket upper bound) and the events kept"""
+		with self.lock:
+			profile = {'buckets': BUCKETS + ['inf'], 'stages': dict((kk, dict(st, \
+				buckets=list(st['buckets']))) for kk, st in self.stages.iteritems()), \
+				'events': list(self.events)}
+		ff = open(fname, 'w')
+		json.dump(profile, ff, default=str)
+		ff.close()
+		
+		
+def _quantile(buckets, qq, worst):
+	"""Upper bound of the bucket the qq quantile falls in (the worst seen, past the last)"""
+	need, seen = qq * sum(buckets), 0
+	for ii, nn in enumerate(buckets):
+		seen += nn
+		if nn and seen >= need:
+			return BUCKETS[ii] if ii < len(BUCKETS) else worst
+	return worst
+	
+
+# what the snaps time into and report through. Set PROFILE.enabled to time them.
+PROFILE = Profile()
+
+
+def span(name):
+	return PROFILE.span(name)
+	
+	
+def timed(name):
+	"""Decorator putting a whole function in a span"""
+	def wrap(fn):
+		@wraps(fn)
+		def spanned(*args, **kwargs):
+			with PROFILE.span(name):
+				return fn(*args, **kwargs)
+		return spanned
+	return wrap
+	
+	
+def event(name, message, every=None, **fields):
+	PROFILE.event(name, message, every, **fields)
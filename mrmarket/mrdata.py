@@ -4,6 +4,7 @@ from pandas.io import sql
 from pandas.lib import Timestamp
 import pandas as pd
 from utils import bbget
+from metrics import tagged
 import dateutil.parser as parser
 #from pandas.tseries.frequencies import infer_freq
 
@@ -16,8 +17,9 @@ class MrData(object):
 	and fields are required (e.g. OHLC) then each ticker will be given its own table.
 	
 	"""
-	def __init__(self, datadir):
+	def __init__(self, datadir, pb=None):
 		self.DATA = datadir
+		self.pb = pb
 		self.suffix_re = re.compile('(_)(Comdty|Index|Equity|Curncy)$')
 		
 		self.intraday_re = re.compile('^(\d+)([HT])$')
@@ -35,12 +37,13 @@ class MrData(object):
 		except IOError:
 			pass
 		
-		if type(period) is int:df
+		if type(period) is int:
 			fields = ['TRADE']
 			
 		# Note if period is an integer (minutes) fields needs to be ['TRADE'] or something
 		dnow = datetime.now()
-		df = bbget(tickers, fields, start, period=period)
+		with tagged('MrData.create'):
+			df = bbget(tickers, fields, start, period=period, pb=self.pb)
 		dims = df.shape
 		
 		conn = sqlite3.connect(self.DATA + datafile)
@@ -116,7 +119,8 @@ class MrData(object):
 				secs = [self.suffix_re.sub(' \\2', c) for c in cols]
 				secs.remove('timestamp')
 	
-			df = bbget(secs, fields, t0, period=period)
+			with tagged('MrData.update'):
+				df = bbget(secs, fields, t0, period=period, pb=self.pb)
 			dims = df.shape
 			
 			if len(dims) == 3:
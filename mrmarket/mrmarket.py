@@ -1,22 +1,38 @@
 
 
 from fograbber import *
-import sqlite3, datetime
+from pandaburger import PandaBurger
+from sabr import fit_history, _expiry_and_undl, _undl_month
+from arbitrage import scan_snapshot
+from deltacube import cube
+from metrics import tagged, span, timed, event
+from snapstore import SnapWriter, append, connect, to_epoch, from_epoch, from_epochs
+from numpy import isfinite, concatenate, flatnonzero, diff
+import pandas as pd
+import sqlite3, datetime, os
 from exchange.computus import business_day
 from dateutil.relativedelta import relativedelta
 from pandas.io import sql
-from pandas.lib import Timestamp
 
 __all__ = ['MrMarket']
 
+# how load and friends index the stored options and futures
+OPTION_INDEX = ['timestamp', 'month', 'strike']
+FUTURE_INDEX = ['mon', 'timestamp']
+
 class MrMarket(FOGrabber):
 
-	def __init__(self, datadir):
-		super(MrMarket, self).__init__()
+	def __init__(self, datadir, pb=None):
+		if pb is None:
+			# past settles never change, so backfills only go to bloomberg for new ones
+			pb = PandaBurger(cache=datadir + 'history.sql')
+		super(MrMarket, self).__init__(pb=pb)
 		self.DATA = datadir
 		dnow = datetime.datetime.now()
 		self._today = datetime.datetime(dnow.year, dnow.month, dnow.day)
 		self.product = None
+		# what load_recent has read, by product (see _load_recent)
+		self.recent = {}
 		
 	@staticmethod
 	def valid_database(db, cur):
@@ -26,148 +42,432 @@ class MrMarket(FOGrabber):
 		
 	@staticmethod
 	def last_update(cur, table):
-		cur.execute('SELECT MAX(timestamp) as "[timestamp]" FROM %s' % table)
+		cur.execute('SELECT MAX(timestamp) FROM %s' % table)
 		return cur.fetchone()
 		
 	
-	def snap(self, product):
-		"""Snap live data and bring settlement data up to date"""
+	@staticmethod
+	def append_frame(frame, table, conn):
+		"""Append to a table and commit, first adding any columns the table doesn't have yet 
+		(see snapstore.append, and SnapWriter for writing several frames in one transaction)"""
+		append(conn, table, frame)
+		conn.commit()
+		
+	@timed('snap')
+	def snap(self, product, calibrate=False, cubes=False, speculative=False):
+		"""Snap live data and bring settlement data up to date. Each option row is stored with 
+		its arbitrage.scan flags in ARB. With calibrate=True also fits SABR to the new snap 
+		and with cubes=True adds the new settles and snap to the delta cubes (see calibrate 
+		and update_cube below). With speculative=True the snap fetches everything it expects
+		to need in one go, guessed from the last live snap (see snap_by_delta). Set 
+		metrics.PROFILE.enabled to see where the time goes."""
 		self.save_settle_data(product)	# settlement data up-to-date. N.B. also calls reset()
 		
 		dnow = datetime.datetime.now()
 		flive = self.DATA + 'live/' + product.lower() + '.sql'
-		conn = sqlite3.connect(flive)
-		cur = conn.cursor()
 		
-		futf, optf = self.snap_by_delta(product, dnow)
+		with span('previous'):
+			prev = self.previous_atm(product) if speculative else None
+		futf, optf = self.snap_by_delta(product, dnow, prev=prev)
+		with span('arbitrage'):
+			optf['ARB'] = scan_snapshot(product, dnow, optf, futf).values
 		del futf['ticker']
 		del futf['last_trade']
 		optf['timestamp'] = dnow
 		futf['timestamp'] = dnow
 		optf.reset_index(inplace=True)
 		futf.reset_index(inplace=True)
-		sql.write_frame(optf, name='options', con=conn, if_exists='append') 
-		sql.write_frame(futf, name='futures', con=conn, if_exists='append')
+		with span('store'), SnapWriter(flive) as writer, writer.snapshot():
+			writer.append('options', optf)
+			writer.append('futures', futf)
+		
+		if calibrate:
+			with span('calibrate'):
+				self.calibrate(product, 'live')
+		if cubes:
+			with span('cubes'):
+				self.update_cube(product, 'settle')
+				self.update_cube(product, 'live')
 			
+	def previous_atm(self, product):
+		"""{month: (forward, ATM vol)} from the latest live snapshot, or None if there isn't 
+		one. The ATM vol is the mid vol of the strike closest to the forward."""
+		flive = self.DATA + 'live/' + product.lower() + '.sql'
+		if not os.path.exists(flive):
+			return None
+		conn = connect(flive)
+		cur = conn.cursor()
+		if not self.valid_database('sqlite_master', cur):
+			conn.close()
+			return None
+			
+		last = self.last_update(cur, 'options')[0]
+		if last is None:
+			conn.close()
+			return None
+		fopt = sql.read_frame('SELECT month, strike, BID_VOL, ASK_VOL FROM options WHERE ' \
+			'timestamp = ?', conn, params=(last,))
+		ffut = sql.read_frame('SELECT mon, BID, ASK FROM futures WHERE timestamp = ?', conn, \
+			params=(last,))
+		conn.close()
+		
+		self.reset(product, self._today)
+		ts = from_epoch(last)
+		fwd = dict(zip(ffut['mon'], 0.5*(ffut['BID'] + ffut['ASK'])))
+		fopt['vol'] = fopt[['BID_VOL', 'ASK_VOL']].mean(axis=1)
+		
+		prev = {}
+		for month, smile in fopt.dropna(subset=['vol']).groupby('month'):
+			expiry, umon = _expiry_and_undl(self.xs, self.cal, str(month), ts)
+			if umon in fwd and isfinite(fwd[umon]):
+				atm = (smile['strike'] - fwd[umon]).abs().idxmin()
+				prev[str(month)] = (fwd[umon], smile['vol'][atm])
+		return prev
+		
+	def calibrate(self, product, source='live', beta=None, processes=None):
+		"""Fit SABR to every snapshot in the 'settle' or 'live' database that doesn't have 
+		stored parameters yet, warm started from the latest stored parameters for each month.
+		Parameters are kept in DATA/sabr/<product>.sql, one table per source, with the
+		columns of sabr.fit_history. Returns the newly fitted parameters (or None)."""
+		fopt, ffut, stamps = self._new_snapshots(product, source, 'sabr')
+		if not len(fopt):
+			return None
+		
+		conn = connect(self._store_file(product, 'sabr'))
+		cur = conn.cursor()
+		cur.execute('SELECT name FROM sqlite_master WHERE type="table" AND name=?', (source,))
+		x0 = None
+		if cur.fetchone():
+			cur.execute('SELECT s.month, s.alpha, s.rho, s.nu FROM %s AS s INNER JOIN ' \
+				'(SELECT month, MAX(timestamp) AS ts FROM %s WHERE success = 1 GROUP BY month) ' \
+				'AS m ON s.month = m.month AND s.timestamp = m.ts' % (source, source))
+			x0 = {str(rr[0]): list(rr[1:]) for rr in cur.fetchall()}
+		conn.close()
+		
+		# a single new snap isn't worth starting a process pool for
+		if processes is None and len(stamps) == 1:
+			processes = 1
+		params = fit_history(product, fopt, ffut, beta, x0, processes)
+		
+		rows = params.reset_index()
+		rows['success'] = rows['success'].astype(int)
+		self._store(rows, stamps, product, 'sabr', source)
+		
+		return params
+		
+	def update_cube(self, product, source='settle'):
+		"""Add any new snapshots in the 'settle' or 'live' database to the constant delta vol 
+		cube (see deltacube.cube) in DATA/cube/<product>.sql, one table per source. Returns 
+		the new rows (or None)."""
+		fopt, ffut, stamps = self._new_snapshots(product, source, 'cube')
+		if not len(fopt):
+			return None
+		
+		vols = cube(product, fopt, ffut)
+		self._store(vols.reset_index(), stamps, product, 'cube', source)
+		return vols
+		
+	def load_cube(self, product, source='settle', start=None):
+		"""The stored constant delta vol cube indexed by ('timestamp', 'month')"""
+		conn = connect(self._store_file(product, 'cube'))
+		query = 'SELECT * FROM %s' % source
+		if start is not None:
+			query += ' WHERE timestamp >= %d' % to_epoch(start)
+		vols = self._read(query, conn, ['timestamp', 'month'])
 		conn.close()
+		return vols
+		
+	def _store_file(self, product, store):
+		"""Derived data (SABR parameters, delta cubes) live in DATA/<store>/<product>.sql"""
+		if not os.path.isdir(self.DATA + store):
+			os.makedirs(self.DATA + store)
+		return self.DATA + store + '/' + product.lower() + '.sql'
+		
+	def _new_snapshots(self, product, source, store):
+		"""Options and futures of the snapshots in the settle or live database that aren't in 
+		the 'source' table of the given store yet, indexed as in load. Also returns a dict 
+		mapping their Timestamps back to the timestamps exactly as stored, so the results 
+		can be written back with matching keys. All empty if the database has no snapshots."""
+		# bring both files up to date before comparing their timestamps
+		connect(self._store_file(product, store)).close()
+		conn = connect(self.DATA + source + '/' + product.lower() + '.sql')
+		cur = conn.cursor()
+		if not self.valid_database('sqlite_master', cur):
+			# nothing snapped yet, e.g. a fresh live file
+			conn.close()
+			return pd.DataFrame(), pd.DataFrame(), {}
+		cur.execute('ATTACH \"%s\" AS store' % (self._store_file(product, store)))
+		cur.execute('SELECT name FROM store.sqlite_master WHERE type="table" AND name=?', (source,))
+		
+		query = 'SELECT * FROM %s'
+		if cur.fetchone():
+			query += ' WHERE timestamp NOT IN (SELECT timestamp FROM store.' + source + ')'
+		fopt = self._read(query % 'options', conn, OPTION_INDEX)
+		ffut = self._read(query % 'futures', conn, FUTURE_INDEX)
+		conn.close()
+		
+		raw = fopt.index.levels[0]
+		stamps = dict(zip(raw, (raw.asi8 // 1000000000).tolist()))
+		return fopt, ffut, stamps
+		
+	@staticmethod
+	def _read(query, conn, index, params=None):
+		"""Read a query into a frame indexed by 'index'. The query is ordered by the index, 
+		which the schema's indexes make cheap, so the frame comes back sorted, and timestamps 
+		are decoded a column at a time."""
+		frame = sql.read_frame(query + ' ORDER BY ' + ', '.join(index), conn, params=params)
+		frame['timestamp'] = from_epochs(frame['timestamp'].values)
+		return frame.set_index(index)
+		
+	def _store(self, rows, stamps, product, store, source):
+		rows['timestamp'] = rows['timestamp'].map(stamps)
+		with SnapWriter(self._store_file(product, store)) as writer, writer.snapshot():
+			writer.append(source, rows)
 
 	def load_recent(self, product, **kwargs):
 		"""Wrapper to load below that takes some simple keywords like bdays=3 and traslates it for
-		load() below. Also understands days, weeks, months or combinations of the three."""
-		self.reset(product, self._today)
-		itbegins = self._today
+		load() below. Also understands days, weeks, months or combinations of the three.
+		The frames are kept between calls, so calling it again (as a dashboard does every few 
+		minutes) only reads the snapshots stored since, see _load_recent."""
+		dnow = datetime.datetime.now()
+		itbegins = datetime.datetime(dnow.year, dnow.month, dnow.day)
+		self.reset(product, itbegins)
 		
 		if 'bdays' in kwargs:
 			itbegins = business_day(itbegins, -int(kwargs.get('bdays')), self.cal.holidays)
-			self.load(product, start=itbegins)
+			self._load_recent(product, itbegins)
 			return
 		
 		if 'days' in kwargs:
-			itbegins -= timdelta(days=int(kwargs.get('days')))
+			itbegins -= datetime.timedelta(days=int(kwargs.get('days')))
 		if 'weeks' in kwargs:
-			itbegins -= timdelta(days=7*int(kwargs.get('weeks')))
+			itbegins -= datetime.timedelta(days=7*int(kwargs.get('weeks')))
 		if 'months' in kwargs:
 			itbegins -= relativedelta(months=int(kwargs.get('months')))
 		
 		itbegins = business_day(itbegins, 0, self.cal.holidays)
-		self.load(product, start=itbegins)
+		self._load_recent(product, itbegins)
+		
+	def _load_recent(self, product, start):
+		"""load(product, start=start) from the frames kept in self.recent, reading only the rows 
+		after each table's high water mark and dropping those now before start. A table's kept 
+		frame is read again from scratch if the rows up to its mark have changed, and everything 
+		kept for the product if either file has been replaced or its schema changed (e.g. by a 
+		migration). New futures rows are merged into their months (see _merge). opt_settle etc 
+		are copies of the kept frames, so they can be modified in place."""
+		start = to_epoch(start)
+		fsettle = self.DATA + 'settle/' + product.lower() + '.sql'
+		flive = self.DATA + 'live/' + product.lower() + '.sql'
+		
+		connect(flive).close()
+		conn = connect(fsettle)
+		cur = conn.cursor()
+		cur.execute('ATTACH \"%s\" AS live' % (flive))
+		
+		tables = []
+		for db in ('', 'live.'):
+			if self.valid_database(db + 'sqlite_master', cur):
+				tables += [(db + 'options', OPTION_INDEX), (db + 'futures', FUTURE_INDEX)]
+		files = [(os.stat(ff).st_dev, os.stat(ff).st_ino) for ff in (fsettle, flive)]
+		schema = [cur.execute('PRAGMA %sschema_version' % db).fetchone()[0] for db in ('', 'live.')]
+		
+		kept = self.recent.get(product)
+		if kept is None or kept['files'] != files or kept['schema'] != schema:
+			kept = self.recent[product] = {'files': files, 'schema': schema, 'frames': {}, 'marks': {}}
+		
+		for table, index in tables:
+			frame, mark = kept['frames'].get(table), kept['marks'].get(table, start - 1)
+			if frame is not None:
+				stamps = frame.index.get_level_values('timestamp')
+				if len(frame) and stamps.min() < from_epoch(start):
+					frame = frame[stamps >= from_epoch(start)]
+				# a count on the timestamp index, to catch rows deleted or rewritten under the mark
+				cur.execute('SELECT COUNT(*) FROM %s WHERE timestamp BETWEEN ? AND ?' % table, (start, mark))
+				if cur.fetchone()[0] != len(frame):
+					frame, mark = None, start - 1
+			
+			new = self._read('SELECT * FROM %s WHERE timestamp > ?' % table, conn, index, \
+				[max(mark, start - 1)])
+			if frame is None:
+				frame = new
+			elif len(new):
+				frame = _merge(frame, new, index[0])
+			if len(new):
+				mark = int(new.index.get_level_values('timestamp').asi8.max() // 1000000000)
+			kept['frames'][table], kept['marks'][table] = frame, mark
+		conn.close()
+		
+		frames = dict((table, kept['frames'][table].copy()) for table, index in tables)
+		self.opt_settle, self.fut_settle = frames.get('options'), frames.get('futures')
+		self.opt_live, self.fut_live = frames.get('live.options'), frames.get('live.futures')
 		
 	
-	def load(self, product, **kwargs):
-		dnow = datetime.datetime.now()
+	def load(self, product, start=None, end=None, source=None, months=None, strikes=None, \
+		deltas=None, moneyness=None, columns=None):
+		"""Load the stored snapshots of a product into opt_settle, fut_settle, opt_live and 
+		fut_live (None for a file with no snapshots yet). All the filtering is done by sqlite, so only 
+		the rows wanted are read:
+			start, end	snapshots from start up to (not including) end
+			source		'settle' or 'live' to load only that one
+			months		option month codes, e.g. ['Z4', '2EZ4'], and only their futures
+			strikes		(lo, hi) strikes, inclusive, either end can be None
+			deltas		(lo, hi) absolute DELTA, e.g. (0.1, 0.5) for both OTM wings
+			moneyness	(lo, hi) strike - forward, or strike / forward for lognormal products
+			columns		only these columns (of whichever table has them) besides the index
+		E.g. the Z4 smile over the last month is
+			mm.load('ER', start=datetime.date.today() - relativedelta(months=1), months=['Z4'])"""
 		fsettle = self.DATA + 'settle/' + product.lower() + '.sql'
 		flive = self.DATA + 'live/' + product.lower() + '.sql'
 		
-		conn = sqlite3.connect(fsettle, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+		connect(flive).close()
+		conn = connect(fsettle)
 		cur = conn.cursor()
 		cur.execute('ATTACH \"%s\" AS live' % (flive))
 		
-		# build the basic query
-		#query = 'SELECT timestamp as "[timestamp]" FROM %s'
-		query = 'SELECT * FROM %s'
-		conj = ' WHERE '
-		if 'start' in kwargs:
-			query += (conj + 'timestamp >= "%s"' % kwargs.get('start'))
-			conj = ' AND '
-		if 'end' in kwargs:
-			query += (conj + 'timestamp < "%s"' % kwargs.get('end'))
-			conj = ' AND '
-		query += ' ORDER BY timestamp'
-		
-		self.opt_settle = sql.read_frame(query % 'options', conn)
-		self.opt_settle['timestamp'] = self.opt_settle['timestamp'].apply(Timestamp)
-		self.opt_settle['month'] = self.opt_settle['month'].apply(str)
-		self.opt_settle.set_index(['timestamp', 'month', 'strike'], inplace=True)
-		
-		self.fut_settle = sql.read_frame(query % 'futures', conn)
-		self.fut_settle['timestamp'] = self.fut_settle['timestamp'].apply(Timestamp)
+		filters = dict(start=start, end=end, months=months, strikes=strikes, deltas=deltas, \
+			moneyness=moneyness, columns=columns)
+		dbs = [db for db in ('', 'live.') if self.valid_database(db + 'sqlite_master', cur)]
+		xs = self.specs.spec(product) if months is not None or moneyness is not None else None
+		if moneyness is not None:
+			# the futures month of every option month, for the forward of each row
+			if months is None:
+				months = [rr[0] for db in dbs for rr in \
+					cur.execute('SELECT DISTINCT month FROM %soptions' % db)]
+			cur.execute('CREATE TEMP TABLE undl (month TEXT PRIMARY KEY, mon TEXT)')
+			cur.executemany('INSERT INTO undl VALUES (?, ?)', [(mm, _undl_month(xs, mm)) \
+				for mm in set(months)])
+		
 		# how you multi-index depends on how you are going to use it. For a timeseries of ERM4 you want
 		# to index by ['mon', 'timestamp'], while for looking at the evolution of the curve it would be
-		# timestamp month. Note the need-for-sortedness too. 
-		self.fut_settle.set_index(['mon', 'timestamp'], inplace=True)	
-		self.fut_settle.sortlevel(0, inplace=True) # Do we need this? would have been better to do it when snapping. 
+		# timestamp month. Either way _read has sqlite return the rows already sorted.
+		self.opt_settle = self.fut_settle = self.opt_live = self.fut_live = None
+		if source != 'live' and '' in dbs:
+			self.opt_settle, self.fut_settle = self._filtered(conn, '', xs, **filters)
+		if source != 'settle' and 'live.' in dbs:
+			self.opt_live, self.fut_live = self._filtered(conn, 'live.', xs, **filters)
 		
-		if not self.valid_database('live.sqlite_master', cur):
-			self.opt_live = None
-			self.fut_live = None
-			return
+		conn.close()
 		
-		self.fut_live = sql.read_frame(query % 'live.futures', conn)
-		self.fut_live['timestamp'] = self.fut_live['timestamp'].apply(Timestamp)
-		self.fut_live.set_index(['mon', 'timestamp'], inplace=True)	
-		self.fut_live.sortlevel(0, inplace=True) 
+	def _filtered(self, conn, db, xs, start, end, months, strikes, deltas, moneyness, columns):
+		"""The options and futures of one database (db is '' or 'live.') filtered as in load, 
+		the filters going into the queries as parameters"""
+		ocols = [rr[1] for rr in conn.execute('PRAGMA %stable_info(options)' % db)]
+		fcols = [rr[1] for rr in conn.execute('PRAGMA %stable_info(futures)' % db)]
+		owhere, oparams, fwhere, fparams = [], [], [], []
+		for where, params in ((owhere, oparams), (fwhere, fparams)):
+			if start is not None:
+				where.append('timestamp >= ?')
+				params.append(to_epoch(start))
+			if end is not None:
+				where.append('timestamp < ?')
+				params.append(to_epoch(end))
 		
-		self.opt_live = sql.read_frame(query % 'live.options', conn)
-		self.opt_live['timestamp'] = self.opt_live['timestamp'].apply(Timestamp)
-		self.opt_live['month'] = self.opt_live['month'].apply(str)
-		self.opt_live.set_index(['timestamp', 'month', 'strike'], inplace=True)
+		if months is not None:
+			months = list(months)
+			mons = sorted(set(_undl_month(xs, mm) for mm in months))
+			owhere.append('month IN (%s)' % ', '.join('?' * len(months)))
+			oparams += months
+			fwhere.append('mon IN (%s)' % ', '.join('?' * len(mons)))
+			fparams += mons
+		if strikes is not None:
+			_band('strike', strikes, owhere, oparams)
+		if deltas is not None:
+			if 'DELTA' not in ocols:
+				raise ValueError('%soptions has no DELTA column' % db)
+			_band('ABS(DELTA)', deltas, owhere, oparams)
+		if moneyness is not None:
+			fwd = 'f.PX_SETTLE' if 'PX_SETTLE' in fcols else '(f.BID + f.ASK) / 2.0'
+			fwd = '(SELECT %s FROM %sfutures AS f WHERE f.mon = (SELECT mon FROM temp.undl AS u WHERE ' \
+				'u.month = o.month) AND f.timestamp = o.timestamp)' % (fwd, db)
+			_band('strike %s %s' % ('-' if xs.model == 'normal' else '/', fwd), moneyness, owhere, oparams)
 		
-		conn.close()
+		if columns is not None:
+			ocols = OPTION_INDEX + [cc for cc in columns if cc in ocols and cc not in OPTION_INDEX]
+			fcols = FUTURE_INDEX + [cc for cc in columns if cc in fcols and cc not in FUTURE_INDEX]
+		opt = self._read('SELECT %s FROM %soptions AS o%s' % (', '.join('[%s]' % cc for cc in ocols), db, \
+			_where(owhere)), conn, OPTION_INDEX, oparams)
+		fut = self._read('SELECT %s FROM %sfutures%s' % (', '.join('[%s]' % cc for cc in fcols), db, \
+			_where(fwhere)), conn, FUTURE_INDEX, fparams)
+		return opt, fut
 		
-	def save_settle_data(self, product, start=None):
+	@timed('settle')
+	def save_settle_data(self, product, start=None, batch=20):
 		"""Like it says. If the datafile already exists it will bring it up to date, otherwise it will 
-		begin from 'start' which defaults to 6 months."""
+		begin from 'start' which defaults to 6 months. Days are committed 'batch' at a time (see 
+		snapstore.SnapWriter), so an interrupted backfill may redo up to that many."""
 		self.product = product
 		self.reset(product, self._today)
 		
 		fsettle = self.DATA + 'settle/' + product.lower() + '.sql'
-		conn = sqlite3.connect(fsettle, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
-		cur = conn.cursor()
-		
-		try:
-			cur.execute('SELECT timestamp FROM options AS "[timestamp]" GROUP BY timestamp ' \
-				'ORDER BY timestamp')
-			rows = cur.fetchall()
-		except:
-			rows = []
-		
-		if not rows:
-			if start is None:
-				start = self._today + relativedelta(months=-6)
-		else:
-			start = business_day(rows[-1][0], 1, self.cal.holidays)
+		# closed however the backfill ends, committing the days written so far
+		with SnapWriter(fsettle, batch) as writer:
+			cur = writer.conn.cursor()
+			
+			# a lookup on the timestamp index rather than a scan
+			try:
+				cur.execute('SELECT MAX(timestamp) FROM options')
+				last = cur.fetchone()[0]
+			except sqlite3.OperationalError:
+				last = None
 			
-		while start < self._today:
-			if not start in rows:
-				print "Saving settle data for " + str(start)
+			if last is None:
+				if start is None:
+					start = self._today + relativedelta(months=-6)
+			else:
+				start = business_day(from_epoch(last).to_pydatetime(), 1, self.cal.holidays)
+				
+			while start < self._today:
+				event('settle', "Saving settle data for " + str(start), every=0, product=product, date=start)
 				try:
-					futf, optf = self.snap_by_delta(product, start)
+					with tagged('save_settle_data'):
+						futf, optf = self.snap_by_delta(product, start)
+					with span('arbitrage'):
+						optf['ARB'] = scan_snapshot(product, start, optf, futf).values
 					del futf['ticker']
 					del futf['last_trade']
 					optf['timestamp'] = start
 					futf['timestamp'] = start
 					optf.reset_index(inplace=True)
 					futf.reset_index(inplace=True)
-					sql.write_frame(optf, name='options', con=conn, if_exists='append') 
-					sql.write_frame(futf, name='futures', con=conn, if_exists='append')
+					with span('store'), writer.snapshot():
+						writer.append('options', optf)
+						writer.append('futures', futf)
 				except Exception as e:
-					print e
-	
-			start = business_day(start, 1, self.cal.holidays)
-			
-		conn.close()
-			
-				
-
+					event('settle_failed', str(e), product=product, date=start, error=str(e))
+		
+				start = business_day(start, 1, self.cal.holidays)
 
 
+def _band(expr, band, where, params):
+	"""Add (lo, hi) bounds, inclusive and either of them None, on an SQL expression"""
+	lo, hi = band
+	if lo is not None and hi is not None:
+		where.append('%s BETWEEN ? AND ?' % expr)
+		params += [lo, hi]
+	elif lo is not None:
+		where.append('%s >= ?' % expr)
+		params.append(lo)
+	elif hi is not None:
+		where.append('%s <= ?' % expr)
+		params.append(hi)
+		
+		
+def _where(conditions):
+	return ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+	
+	
+def _merge(frame, new, level):
+	"""Add rows read after a frame's to it, both sorted by their index. New snapshots sort 
+	last by timestamp, so a frame indexed by timestamp first is just appended to, while the 
+	new rows of each futures month go in after that month's, rather than sorting it all again."""
+	if level == 'timestamp':
+		return pd.concat([frame, new])
+	cuts = frame.index.get_level_values(level).values.searchsorted( \
+		new.index.get_level_values(level).values, side='right')
+	starts = concatenate([[0], flatnonzero(diff(cuts)) + 1])
+	ends = concatenate([starts[1:], [len(new)]])
+	pieces, done = [], 0
+	for j0, j1 in zip(starts, ends):
+		pieces += [frame.iloc[done:cuts[j0]], new.iloc[j0:j1]]
+		done = cuts[j0]
+	return pd.concat(pieces + [frame.iloc[done:]])
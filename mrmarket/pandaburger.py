@@ -1,22 +1,64 @@
 
 
-import pandas as pd
-import bloomburger
+import pandas as pd, time
+from numpy import array, nan, isnan, repeat
+from numpy.random import RandomState
+from backends import CachingBackend, connection
+from metrics import METRICS, current_tag, event
 from datetime import datetime, timedelta
+from numbers import Number
+from multiprocessing.pool import ThreadPool
 
 # recall that if you want weekly / month historical data then use periodicity property
 
-class PandaBurger(bloomburger.bb):
-	def __init__(self):
-		super(PandaBurger, self).__init__()
+# dump sends at most MAX_CHUNK securities per request, and doesn't split below MIN_CHUNK
+MAX_CHUNK = 500
+MIN_CHUNK = 50
+
+class PandaBurger(object):
+	"""Pandas front end to a data source, by default the process wide bloomberg sessions 
+	(see backends.connection), which connect as requests need them. See backends for 
+	recording responses and replaying them offline. If cache is a filename then historical 
+	settles etc are kept there (see backends.CachingBackend). Every request is recorded in 
+	metrics (the process wide metrics.METRICS by default), tagged with the caller's 
+	metrics.tagged label."""
+	def __init__(self, backend=None, cache=None, metrics=None):
+		self.shared = backend is None
+		self.cache = cache
+		self.periodicity = None
+		self.timings = []
+		self.metrics = METRICS if metrics is None else metrics
+		self._use(connection() if backend is None else backend)
+		
+	def _use(self, backend):
+		self.backend = backend if self.cache is None else CachingBackend(self.cache, backend)
 		
 	def connect(self, server='localhost', port=8194):
-		super(PandaBurger, self).connect(server, port)
+		"""Use the shared sessions of another server (or point a private backend at it).
+		Nothing actually connects until the first request."""
+		if self.shared:
+			self._use(connection(server, port))
+		else:
+			self.backend.connect(server, port)
+			
+	def close(self):
+		self.backend.close()
 	
-	def fetch(self, securities, fields, d0=False, d1=False, interval=0):
+	def fetch(self, securities, fields, d0=False, d1=False, interval=0, workers=8, timeout=None, \
+		retries=2, layout='panel'):
 		"""Fetch realtime, historical, or historical intraday Bloomberg data.
 		Returns pandas data structure.
-		Attempts to provide some flexiblity, but possibly to the point of ambiguity."""
+		Attempts to provide some flexiblity, but possibly to the point of ambiguity.
+		
+		Historical data for a date range comes back as a panel of security by date by field, or
+		with layout='long' as one frame with security, date and field columns, or with 
+		layout='wide' as a date indexed frame with (field, security) columns. The long and wide 
+		layouts are built a column at a time (see _columns below) rather than a frame per 
+		security.
+		
+		Realtime and single date requests are split up by dump below. Intraday requests are 
+		one per security, so up to 'workers' of them are kept in flight at once (see pipeline 
+		below for timeout and retries)."""
 		
 		#if type(securities) == str:
 		#	securities = [securities]
@@ -30,22 +72,32 @@ class PandaBurger(bloomburger.bb):
 		#elif type(fields) != list:
 		#	fields = [ff for ff in fields]
 		
+		securities = list(securities)
+		if isinstance(fields, basestring):
+			fields = [fields]
 		if interval == 0:
 			if not d0 and not d1:
-				bdata = super(PandaBurger, self).fetch(securities, fields)
-				pdata = [dict(bdata[s]) for s in securities]
-				return pd.DataFrame(pdata, index=securities) #, columns=fields)
+				bdata = self.dump(securities, fields, workers=workers, timeout=timeout, retries=retries)
+				return _columns([bdata[s] for s in securities], fields, index=securities)
 			elif not d1:
 				# better to just return a dataframe for the single date?
 				# (really wish i'd had bloomburger do the same)
-				bdata = super(PandaBurger, self).fetch(securities, fields, d0, d0)
+				bdata = self.dump(securities, fields, d0, workers=workers, timeout=timeout, retries=retries)
 				securities = [s for s in securities if s in bdata and bdata[s]]
-				pdata = [dict([fi for fi in bdata[s][0] if fi[0]!='date']) for s in securities]
-				return pd.DataFrame(pdata, index=securities) #, columns=fields)
+				return _columns([bdata[s][0] for s in securities], fields, index=securities)
 				
-			bdata = super(PandaBurger, self).fetch(securities, fields, d0, d1)
-			return pd.Panel({sec: pd.DataFrame([dict(rr) for rr in bdata[sec]]).set_index('date') \
-				for sec in bdata if bdata[sec]})
+			t0 = time.time()
+			try:
+				bdata = self.backend.fetch(securities, fields, d0, d1, periodicity=self.periodicity)
+			except Exception, e:
+				self.metrics.record('history', current_tag(), len(securities), len(fields), 0, \
+					time.time() - t0, errors=1, error=e)
+				raise
+			self.metrics.record('history', current_tag(), len(securities), len(fields), \
+				sum(len(rr) for rr in bdata.itervalues()), time.time() - t0)
+			if layout == 'panel':
+				return _panel(bdata)
+			return history_frame(bdata, securities, fields, layout == 'wide')
 			
 		
 		else:
@@ -56,22 +108,169 @@ class PandaBurger(bloomburger.bb):
 			if not d0:
 				d0 = datetime(d1.year, d1.month, d1.day)
 				
-			prepanel = {}			
-			for sec in securities:
-				bdata = super(PandaBurger, self).fetch(sec, fields[0], d0, d1, interval)
-				if bdata[sec]:
-					prepanel[sec] = [dict(rr) for rr in bdata[sec]]
+			bdata = self.pipeline([(sec, ([sec], [fields[0]], d0, d1, interval)) for sec in securities], \
+				workers, timeout, retries, 'intraday')
+			prepanel = {sec: [dict(rr) for rr in bdata[sec][sec]] for sec in bdata if bdata[sec][sec]}
 					
 			# if there were no events for a particular security in any of the intervals, then
 			# it will not appear at all in the panel. Prefer all NaN, not sure how to do it. 
 			return pd.Panel({kk: pd.DataFrame(prepanel[kk]).set_index('time') for kk in prepanel})
 			
 			
-	def dump(self, securities, fields, d0=None):
-		if not d0:
-			return bloomburger.bb.fetch(self, securities, fields)
-		else:
-			return bloomburger.bb.fetch(self, securities, fields, d0, d0)
+	def dump(self, securities, fields, d0=None, chunk=None, workers=8, timeout=None, retries=2):
+		"""Raw realtime (or single date historical) data for any number of securities. They are 
+		split into chunks by plan below and the chunks sent pipelined, so a big snap neither hits 
+		request size limits nor waits on one huge reply. Securities in a chunk that failed 
+		every retry get no data. self.timings has (chunk number, seconds, attempts) per chunk."""
+		securities = list(securities)
+		args = (fields, d0, d0, 0, self.periodicity) if d0 else (fields,)
+		chunks = self.plan(securities, chunk, workers)
+		
+		bdata = {}
+		for res in self.pipeline([(ii, (cc,) + args) for ii, cc in enumerate(chunks)], workers, \
+			timeout, retries, 'history' if d0 else 'realtime').itervalues():
+			bdata.update(res)
+		for sec in securities:
+			bdata.setdefault(sec, [])
+		return bdata
+		
+	@staticmethod
+	def plan(securities, chunk=None, workers=8):
+		"""Split a list of securities into chunks of 'chunk', by default spreading them evenly 
+		over the workers in chunks of MIN_CHUNK to MAX_CHUNK"""
+		if chunk is None:
+			chunk = min(MAX_CHUNK, max(MIN_CHUNK, -(-len(securities) // workers)))
+		return [securities[ii:ii+chunk] for ii in range(0, len(securities), chunk)]
+			
+	def pipeline(self, requests, workers=8, timeout=None, retries=2, op='pipeline'):
+		"""Run a list of (key, backend.fetch args) requests on a pool of worker threads, so 
+		the wall clock time is close to that of the slowest request rather than the sum. A 
+		request that raises, or has been running for more than timeout seconds, is resent up 
+		to 'retries' times. Returns a dict of key: response for the ones that succeeded, 
+		filled in as they complete. self.timings gets a (key, seconds, attempts) per request, 
+		and self.metrics a Call for each one that succeeded or was given up on.
+		
+		N.B. a timed out request can't be cancelled, it keeps its worker until it returns."""
+		pool = ThreadPool(max(1, min(workers, len(requests))))
+		started, first = {}, {}
+		
+		def run(key, args):
+			started[key] = time.time()
+			first.setdefault(key, started[key])
+			return self.backend.fetch(*args)
 			
+		args = dict(requests)
+		attempts = dict.fromkeys(args, 1)
+		errors = dict.fromkeys(args, 0)
+		pending = {key: pool.apply_async(run, (key, args[key])) for key in args}
+		results = {}
+		self.timings = []
+		# the workers don't see this thread's tags
+		tag = current_tag()
 		
+		def record(key, rows, error=''):
+			self.metrics.record(op, tag, len(args[key][0]), len(args[key][1]), rows, \
+				time.time() - first.get(key, time.time()), attempts[key] - 1, errors[key], error)
+		
+		while pending:
+			for key, res in pending.items():
+				if res.ready():
+					del pending[key]
+					try:
+						results[key] = res.get()
+					except Exception, e:
+						error = e
+					else:
+						self.timings.append((key, time.time() - started[key], attempts[key]))
+						record(key, _rows(results[key], args[key]))
+						continue
+				elif timeout and key in started and time.time() - started[key] > timeout:
+					del pending[key]
+					error = 'timed out after %gs' % timeout
+				else:
+					continue
+				
+				errors[key] += 1
+				if attempts[key] > retries:
+					event('gave_up', 'Giving up on %s after %d attempts: %s' % (key, attempts[key], error), \
+						key=key, attempts=attempts[key], error=str(error))
+					record(key, 0, error)
+				else:
+					attempts[key] += 1
+					del started[key]
+					pending[key] = pool.apply_async(run, (key, args[key]))
+			
+			if pending:
+				time.sleep(0.001)
+				
+		pool.terminate()
+		return results
+
 
+def _rows(bdata, args):
+	"""Rows in a response: securities with data for realtime requests, date or time rows 
+	otherwise"""
+	if len(args) > 2 and any(args[2:5]):
+		return sum(len(rr) for rr in bdata.itervalues())
+	return sum(1 for rr in bdata.itervalues() if rr)
+	
+	
+def _columns(rows, fields, key=None, index=None):
+	"""Turn a list of bloomburger [(field, value), ...] rows into a frame with one column per 
+	field, each built by one list comprehension with an explicit dtype: float (NaN where a row 
+	has no value) if every value is a number, else object with the values as they came, so 
+	numeric looking strings stay strings. key ('date' or 'time') is an object column first. 
+	Fields with no values at all are left out, as they would be from a DataFrame of dicts."""
+	rows = [dict(rr) for rr in rows]
+	names = ([key] if key is not None else []) + [ff for ff in fields if ff != key]
+	cols = {}
+	for ff in names:
+		vals = [rr.get(ff) for rr in rows]
+		if ff != key and all(vv is None or _number(vv) for vv in vals):
+			col = array([nan if vv is None else vv for vv in vals], dtype=float)
+			if not isnan(col).all():
+				cols[ff] = col
+		elif ff == key or any(vv is not None for vv in vals):
+			cols[ff] = array(vals, dtype=object)
+	names = [ff for ff in names if ff in cols]
+	return pd.DataFrame(cols, columns=names, index=index)
+	
+	
+def _number(vv):
+	return isinstance(vv, Number) and not isinstance(vv, bool)
+	
+	
+def history_frame(bdata, securities, fields, wide=False):
+	"""Historical data for a date range as one long frame with security, date and field 
+	columns, or with wide=True a date indexed frame with (field, security) columns"""
+	secs = [sec for sec in securities if bdata.get(sec)]
+	frame = _columns([rr for sec in secs for rr in bdata[sec]], fields, 'date')
+	frame.insert(0, 'security', repeat(secs, [len(bdata[sec]) for sec in secs]))
+	if wide:
+		return frame.set_index(['date', 'security']).unstack('security')
+	return frame
+	
+	
+def _panel(bdata):
+	return pd.Panel({sec: pd.DataFrame([dict(rr) for rr in bdata[sec]]).set_index('date') \
+		for sec in bdata if bdata[sec]})
+		
+		
+def benchmark(nsec=500, ndays=500, nfields=4, seed=0):
+	"""Time assembling the same made up date range response as a panel, long frame and wide 
+	frame. Returns a dataframe of seconds for each."""
+	rs = RandomState(seed)
+	fields = ['F%d' % ii for ii in range(nfields)]
+	dates = [datetime(2010, 1, 1) + timedelta(days=ii) for ii in range(ndays)]
+	bdata = {'S%d' % ss: [[('date', dd)] + zip(fields, rs.uniform(size=nfields)) for dd in dates] \
+		for ss in range(nsec)}
+	securities = sorted(bdata)
+	
+	seconds = []
+	for fn in (lambda: _panel(bdata), lambda: history_frame(bdata, securities, fields), \
+		lambda: history_frame(bdata, securities, fields, True)):
+		t0 = time.time()
+		fn()
+		seconds.append(time.time() - t0)
+		
+	return pd.DataFrame({'seconds': seconds}, index=['panel', 'long', 'wide'])
@@ -0,0 +1,204 @@
+
+
+import threading
+from contextlib import contextmanager
+from numpy import zeros, nan, isnan, vstack
+from backends import Backend, BackendError
+from metrics import event
+
+__all__ = ['QuoteBook', 'QuoteBookBackend', 'FIELDS']
+
+# everything a live snap asks for
+FIELDS = ['BID', 'ASK', 'BID_SIZE', 'ASK_SIZE', 'VOLUME', 'LAST_PRICE']
+
+
+class QuoteBook(object):
+	"""Latest realtime quotes for a set of tickers, one row of FIELDS per ticker in a numpy
+	array (NaN where there's no quote), updated from ticks and read as a consistent
+	snapshot under a lock. While a frozen() block is open every read of the book, from any 
+	thread (e.g. PandaBurger.pipeline's workers), sees it as it was when the block was 
+	entered, so all the reads of a snap see the same moment."""
+
+	def __init__(self, fields=FIELDS):
+		self.fields = list(fields)
+		self.column = {ff: ii for ii, ff in enumerate(self.fields)}
+		self.rows = {}
+		self.data = zeros((64, len(self.fields))) + nan
+		self.lock = threading.RLock()
+		self.ticks = 0
+		# what frozen() took, and how many frozen blocks are open on it
+		self.view = None
+		self.frozen_count = 0
+
+	def __contains__(self, ticker):
+		return ticker in self.rows
+
+	def add(self, tickers):
+		"""Rows for any tickers not in the book yet. Returns the new ones."""
+		with self.lock:
+			new = [tt for tt in tickers if tt not in self.rows]
+			while len(self.rows) + len(new) > len(self.data):
+				self.data = vstack([self.data, zeros(self.data.shape) + nan])
+			for tt in new:
+				self.rows[tt] = len(self.rows)
+			return new
+
+	def remove(self, tickers):
+		"""Drop tickers from the book, packing the rows left"""
+		tickers = set(tickers)
+		with self.lock:
+			keep = [tt for tt in sorted(self.rows, key=self.rows.get) if tt not in tickers]
+			if len(keep) == len(self.rows):
+				return
+			data = zeros(self.data.shape) + nan
+			data[:len(keep)] = self.data[[self.rows[tt] for tt in keep]]
+			self.rows = dict((tt, ii) for ii, tt in enumerate(keep))
+			self.data = data
+
+	def update(self, ticks):
+		"""Apply a list of (ticker, [(field, value), ...]) ticks. Unknown tickers and fields
+		are ignored."""
+		with self.lock:
+			for ticker, values in ticks:
+				row = self.rows.get(ticker)
+				if row is None:
+					continue
+				for ff, vv in values:
+					if ff in self.column:
+						self.data[row, self.column[ff]] = vv
+			self.ticks += len(ticks)
+
+	@contextmanager
+	def frozen(self):
+		"""All reads of the book in the block see it as it was on entry. Tickers added since 
+		are read as they are now. Blocks that overlap (nested, or concurrent snaps) share the 
+		view taken by the first of them, until the last one exits."""
+		with self.lock:
+			if self.view is None:
+				self.view = (dict(self.rows), self.data.copy())
+			self.frozen_count += 1
+		try:
+			yield
+		finally:
+			with self.lock:
+				self.frozen_count -= 1
+				if not self.frozen_count:
+					self.view = None
+
+	def snapshot(self, tickers, fields):
+		"""bloomburger style realtime data for the tickers, all as of the same moment"""
+		cols = [(ff, self.column[ff]) for ff in fields if ff in self.column]
+		with self.lock:
+			view = self.view
+			rows = []
+			for tt in tickers:
+				if view is not None and tt in view[0]:
+					rows.append((tt, view[1][view[0][tt]]))
+				elif tt in self.rows:
+					rows.append((tt, self.data[self.rows[tt]].copy()))
+		return dict((tt, [(ff, vals[cc]) for ff, cc in cols if not isnan(vals[cc])]) for tt, vals in rows)
+
+
+class QuoteBookBackend(Backend):
+	"""Serves realtime requests from a QuoteBook kept up to date in the background, so a live
+	snap reads memory instead of going to the wire. Any ticker a request asks for that isn't
+	in the book yet is fetched from the backend behind it once and watched from then on,
+	so the book follows the strikes the snaps want as the forward moves (see also
+	FOGrabber.stream, which watches a band of strikes up front and drops those that leave it).
+
+	Ticks come from the backend's subscribe if it has one, otherwise the book is refreshed
+	by polling every 'poll' seconds. Its own subscribe passes the ticks on to a callback as 
+	well. Historical and intraday requests go straight through."""
+
+	def __init__(self, backend, poll=1.0, chunk=500):
+		self.backend = backend
+		self.book = QuoteBook()
+		self.poll = poll
+		self.chunk = chunk
+		self.streaming = False
+		# tickers the backend streams (even once dropped, as there's no unsubscribe) or we poll
+		self.streamed = set()
+		self.polled = []
+		self.listeners = []
+		self.thread = None
+		self.stopping = threading.Event()
+		self.lock = threading.RLock()
+
+	def connect(self, server='localhost', port=8194):
+		self.backend.connect(server, port)
+
+	def close(self):
+		self.stop()
+		self.backend.close()
+
+	def fetch(self, securities, fields, d0=None, d1=None, interval=0, periodicity=None):
+		if d0 or d1 or interval:
+			return self.backend.fetch(securities, fields, d0, d1, interval, periodicity)
+		self.watch(securities)
+		return self.book.snapshot(securities, fields)
+
+	def subscribe(self, securities, fields, callback):
+		"""Watch the securities, and call callback with their ticks (as for Backend.subscribe)"""
+		with self.lock:
+			self.listeners.append((set(securities), list(fields), callback))
+		self.watch(securities)
+
+	def watch(self, tickers):
+		"""Add tickers to the book, with their current quotes, and keep them updated"""
+		# held while seeding, so a concurrent request can't see the rows before their quotes
+		with self.lock:
+			new = self.book.add(tickers)
+			for ii in range(0, len(new), self.chunk):
+				bdata = self.backend.fetch(new[ii:ii+self.chunk], self.book.fields)
+				self.book.update(bdata.items())
+			new = [tt for tt in new if tt not in self.streamed]
+		if not new:
+			return
+
+		try:
+			self.backend.subscribe(new, self.book.fields, self._ticks)
+			self.streaming = True
+			with self.lock:
+				self.streamed.update(new)
+		except (NotImplementedError, BackendError):
+			with self.lock:
+				self.polled += new
+				if self.thread is None:
+					self.thread = threading.Thread(target=self._refresh)
+					self.thread.daemon = True
+					self.thread.start()
+
+	def drop(self, tickers):
+		"""Stop keeping tickers in the book. Polling stops for them, streamed ones' ticks are 
+		ignored, and a later request or watch brings them back."""
+		tickers = set(tickers)
+		with self.lock:
+			self.book.remove(tickers)
+			self.polled = [tt for tt in self.polled if tt not in tickers]
+
+	def _ticks(self, ticks):
+		self.book.update(ticks)
+		for securities, fields, callback in list(self.listeners):
+			mine = [(tt, [fv for fv in values if fv[0] in fields]) for tt, values in ticks \
+				if tt in securities]
+			if mine:
+				callback(mine)
+
+	def stop(self):
+		"""Stop polling (a subscribe starts it again)"""
+		self.stopping.set()
+		if self.thread is not None:
+			self.thread.join()
+			self.thread = None
+		self.stopping.clear()
+
+	def _refresh(self):
+		while not self.stopping.wait(self.poll):
+			tickers = list(self.polled)
+			for ii in range(0, len(tickers), self.chunk):
+				try:
+					bdata = self.backend.fetch(tickers[ii:ii+self.chunk], self.book.fields)
+				except Exception, e:
+					event('refresh_failed', 'Quote book refresh failed: %s' % e, error=str(e))
+					continue
+				self._ticks(bdata.items())
@@ -2,16 +2,23 @@
 
 import pandas as pd
 from bisect import bisect_left
-from numpy import sqrt, log, exp, power
+from numpy import sqrt, log, exp, power, array, where, clip, tanh, arctanh, column_stack, interp, \
+	argsort, mean, isfinite, nan, arange
+from multiprocessing import Pool, cpu_count
+from collections import namedtuple
 from exchange import Computus, XSpec
 from arachne import impliedvol, impliedvolbn
 from scipy import optimize
 
 
-__all__ = ['SABR', 'fit']
+__all__ = ['SABR', 'SABRFit', 'fit', 'fit_history']
 
 EXCH_MONTHS = 'FGHJKMNQUVXZ'
 
+# result of a single calibration. residual is the rms vol error, iterations the number of
+# jacobian evaluations, and ier / message are straight from MINPACK
+SABRFit = namedtuple('SABRFit', 'alpha rho nu residual iterations success ier message')
+
 def _impliedvol(cp, forward, strike, maturity, discount, premium):
 	return impliedvol(cp, forward, strike, maturity, 0.0, 0.0, premium/discount)
 
@@ -65,44 +72,97 @@ class SABR_Fitter(object):
 		self.rho = 0.0
 		self.nu = 0.0
 		
-	def _vol(self, K):
-		K = K * 1.0
-		x = log(self.fwd/K)
-            
-		sigma1 = power(self.fwd*K,self.beta-1.0)*self.alpha*self.alpha*(self.beta-1.0)*(self.beta-1.0)/24.0 \
-            + pow(self.fwd*K,0.5*(self.beta-1.0))*self.alpha*self.beta*self.nu*self.rho/4.0 \
-            + self.nu*self.nu*(2.0-3.0*self.rho*self.rho)/24.0
-            
-		if abs(x)<1.0e-15:
-			sigma0 = self.alpha * power(K, self.beta-1)
-			return sigma0*(1.0 + sigma1*self.tau)
-            
-		if self.beta == 1.0:
-			z = self.nu * x / self.alpha
-		else:
-			z = self.nu * (power(self.fwd,1-self.beta)-power(K,1-self.beta)) / self.alpha / (1-self.beta)
-			 
-		if self.nu == 0.0:
-			sigma0 = x*self.alpha*(1-self.beta) / (power(self.fwd,1-self.beta) - power(K,1-self.beta))
+		# everything that only depends on the strikes is computed once here, so each
+		# leastsq iteration is a handful of numpy ops over the whole smile
+		self.strikes = array([o[0] for o in opts], dtype=float)
+		self.vols = array([o[1] for o in opts], dtype=float)
+		
+		K = self.strikes
+		self._x = log(fwd/K)
+		self._atm = abs(self._x) < 1.0e-15
+		self._fkb = power(fwd*K, beta-1.0)
+		self._fkh = power(fwd*K, 0.5*(beta-1.0))
+		if beta == 1.0:
+			self._q = self._x
 		else:
-			sigma0 = self.nu * x  / log((sqrt(1.0-2*self.rho*z+z*z)+z-self.rho)/(1-self.rho))
-
-		return sigma0*(1.0 + sigma1*self.tau)
+			self._q = (power(fwd,1-beta) - power(K,1-beta)) / (1-beta)
+		self._xq = where(self._atm, power(K, beta-1), self._x / where(self._atm, 1.0, self._q))
 		
+	def _smile(self, jac=False):
+		"""Hagan vols for all strikes. Writing sigma0 = alpha * x/q * g(z) with g(z) = z/chi(z)
+		gives one expression for the ATM, nu = 0 and general cases, and makes the derivatives
+		easy. With jac=True also returns d(vol)/d(alpha, rho, nu) as an (n, 3) array."""
+		a, rho, nu, b, T = self.alpha, self.rho, self.nu, self.beta, self.tau
+		q, xq = self._q, self._xq
+		
+		sigma1 = self._fkb*a*a*(b-1.0)*(b-1.0)/24.0 + self._fkh*a*b*nu*rho/4.0 \
+			+ nu*nu*(2.0-3.0*rho*rho)/24.0
+		
+		z = nu * q / a
+		small = abs(z) < 1.0e-6
+		zs = where(small, 1.0, z)
+		S = sqrt(1.0 - 2.0*rho*zs + zs*zs)
+		# S + z - rho cancels badly for large negative z, use (1 - rho^2)/(S - z + rho) there
+		zr = zs - rho
+		szr = where(zr < 0.0, (1.0 - rho*rho) / (S + abs(zr)), S + zr)
+		chi = log(szr / (1.0 - rho))
+		
+		# series expansion near z = 0, where z/chi is 0/0
+		g = where(small, 1.0 - 0.5*rho*z, zs/chi)
+		sigma0 = a * xq * g
+		vol = sigma0 * (1.0 + sigma1*T)
+		if not jac:
+			return vol
+		
+		dg_dz = where(small, -0.5*rho, (chi - zs/S) / (chi*chi))
+		dchi_drho = 1.0/(1.0 - rho) - (zs + S) / (S*szr)
+		dg_drho = where(small, -0.5*z, -zs*dchi_drho / (chi*chi))
+		
+		ds0 = [xq*(g - z*dg_dz), a*xq*dg_drho, xq*q*dg_dz]
+		ds1 = [self._fkb*a*(b-1.0)*(b-1.0)/12.0 + self._fkh*b*nu*rho/4.0,
+			self._fkh*a*b*nu/4.0 - nu*nu*rho/4.0,
+			self._fkh*a*b*rho/4.0 + nu*(2.0-3.0*rho*rho)/12.0]
+		
+		J = column_stack([d0*(1.0 + sigma1*T) + sigma0*T*d1 for d0, d1 in zip(ds0, ds1)])
+		return vol, J
+		
+	def _vol(self, K):
+		"""Hagan vol at a single strike for the current parameters"""
+		return SABR(self.fwd, self.alpha, self.beta, self.rho, self.nu)(K, self.tau)
 		
 	def target(self, xval):
 		self.alpha = xval[0]
 		self.rho = xval[1]
 		self.nu = xval[2]
 		
-		err = []
+		return self._smile() - self.vols
 		
-		for opt in self.opts:
-			kvol = self._vol(opt[0])
-			err.append(kvol-opt[1])
+	def jacobian(self, xval):
+		"""Analytic jacobian of target() with respect to (alpha, rho, nu)"""
+		self.alpha = xval[0]
+		self.rho = xval[1]
+		self.nu = xval[2]
 		
-		return err
-
+		return self._smile(jac=True)[1]
+		
+	# leastsq is unconstrained, so fit in u = (log alpha, arctanh rho, log nu) which keeps 
+	# alpha > 0, nu > 0 and -1 < rho < 1 without any penalty terms
+	@staticmethod
+	def to_unbounded(xval):
+		return array([log(max(xval[0], 1.0e-8)), arctanh(clip(xval[1], -0.999, 0.999)), \
+			log(max(xval[2], 1.0e-8))])
+		
+	@staticmethod
+	def from_unbounded(uval):
+		# tanh rounds to +/-1 for large u, which would blow up chi
+		return array([exp(uval[0]), clip(tanh(uval[1]), -0.999999, 0.999999), exp(uval[2])])
+		
+	def utarget(self, uval):
+		return self.target(self.from_unbounded(uval))
+		
+	def ujacobian(self, uval):
+		xval = self.from_unbounded(uval)
+		return self.jacobian(xval) * array([xval[0], 1.0 - xval[1]*xval[1], xval[2]])
 
 		
 def fit(product, snap_date, fopt, ffut, beta=None, x0=None):
@@ -115,8 +175,9 @@ def fit(product, snap_date, fopt, ffut, beta=None, x0=None):
 	ffut -- dataframe of futures prices (single) indexed by month, columns
 			as per the options. 
 	
-	'month' here refers to an exchange month code like 'Z3'. 
-	Returns a dataframe of SABR parameters indexed by month
+	'month' here refers to an exchange month code like 'Z3' (or '2EZ3' for a 
+	midcurve). Returns a dataframe of SABR parameters indexed by month, with the
+	same columns as fit_history
 	"""
 	_computus = Computus()
 	_spec = XSpec()
@@ -136,60 +197,201 @@ def fit(product, snap_date, fopt, ffut, beta=None, x0=None):
 	
 	if not 'month' in fopt.index.names:
 		raise Exception('Unable to index fopts by month')
-		
-	snap_base =  10*(snap_date.year/10)
 	
 	if 'BID' in fopt.columns and 'ASK' in fopt.columns:
-		to_tuples = lambda x: x[['BID', 'ASK']].to_records()
+		opx = (fopt['BID'] + fopt['ASK']) / 2.0
+	elif 'SETTLE' in fopt.columns:
+		opx = fopt['SETTLE']
 	else:
-		to_tuples = lambda x: x.to_records()
+		opx = fopt[fopt.columns[0]]
+	fpx = _futures_mid(ffut)
 		
-	df = pd.DataFrame(index = fopt.index.levels[fopt.index.names.index('month')], \
-			columns = ['fwd', 't', 'beta', 'alpha', 'rho', 'nu'], \
-			dtype = float)
-	
-	for month in ['U3']: #fopt.index.levels[fopt.index.names.index('month')]:
-		if len(month) == 4:	# ie midcurve TODO
-			continue 
-			
-		mm,yy = EXCH_MONTHS.index(month[0]) + 1, + snap_base + int(month[1])
-		umon = xs.undlMonths[bisect_left(xs.undlMonths, month[0])]
-		if umon < EXCH_MONTHS[mm-1]:
-			umon += str((yy+1)%10)
-		else:
-			umon += str(yy%10)
-			
-		fwd = (ffut.ix[umon]['BID'] + ffut.ix[umon]['ASK']) / 2.0
-		expiry = cdr.opt_expiry(mm, yy)
+	results = []
+	for month in fopt.index.levels[fopt.index.names.index('month')]:
+		expiry, umon = _expiry_and_undl(xs, cdr, month, snap_date)
+		fwd = fpx.get(umon, nan)
 		act365 = (expiry - snap_date).days / 365.0 \
 			+ (expiry - snap_date).seconds / 31536000.0	
 		if act365 < 0.0:
 			continue
 			
-		mopts = fopt.ix[month]
+		mopx = opx.xs(month, level='month')
 		tuples = []
-		for k in mopts.index:
-			mid = (mopts['BID'][k] + mopts['ASK'][k]) / 2.0
-			#print 'CP'[k<fwd], fwd, k, act365, 1.0, mid
-			tuples.append((k, ivolfn('CP'[k<fwd], fwd, k, act365, 1.0, mid)))
-			
-		pp = _fit(fwd, act365, beta, tuples, x0)
+		for k, mid in mopx.iteritems():
+			try:
+				vol = ivolfn('CP'[k<fwd], fwd, k, act365, 1.0, mid)
+			except Exception:
+				continue
+			if isfinite(vol):
+				tuples.append((k, vol))
+				
+		results.append(_fit_task((month, fwd, act365, beta, tuples, x0)))
 		
-		print tuples
-		print pp[0], [fwd, act365, beta]
+	return _results_frame(results, ['month'])
+	
+
+def fit_history(product, fopt, ffut, beta=None, x0=None, processes=None, prefilter=False):
+	"""Fit SABR parameters to every (timestamp, month) smile of a stored history, e.g. 
+	the opt_settle / fut_settle or opt_live / fut_live frames loaded by MrMarket.load.
+	The implied vols are already stored, so each smile is just a least squares fit and
+	they're farmed out to a pool of 'processes' worker processes (defaults to the number
+	of cores, 1 fits in this process).
+	
+	Arguments:
+	fopt -- options multi-indexed by ('timestamp', 'month', 'strike') with either a
+			SETTLE_VOL column or BID_VOL and ASK_VOL columns (mid vol is fitted)
+	ffut -- futures multi-indexed by ('mon', 'timestamp') with PX_SETTLE or BID / ASK
+	
+	x0 is either a single starting point for every fit or a dict of month -> [alpha, 
+	rho, nu], e.g. the last stored parameters, to warm start each month separately.
+	With prefilter=True any rows flagged by arbitrage.scan are left out of the fits.
+	
+	Returns a dataframe indexed by ('timestamp', 'month') with columns fwd, t, beta, 
+	alpha, rho, nu, residual, iterations, success, message. A fit that fails still gets
+	a row, with success False and the reason in message. N.B. on Windows the calling 
+	script needs the usual if __name__ == '__main__' guard for multiprocessing.
+	"""
+	xs = XSpec().spec(product)
+	cdr = Computus().make(xs.computus)
+	if beta is None:
+		beta = 0.0 if xs.model == 'normal' else 1.0
+		
+	if prefilter:
+		# imported here since arbitrage imports from this module
+		from arbitrage import scan
+		fopt = fopt[scan(product, fopt, ffut).values == 0]
+		
+	tasks = _history_tasks(xs, cdr, fopt, ffut, beta, x0)
+	
+	if processes is None:
+		processes = cpu_count()
+	if processes == 1 or len(tasks) < 2:
+		results = map(_fit_task, tasks)
+	else:
+		pool = Pool(processes)
+		try:
+			results = pool.map(_fit_task, tasks, max(1, len(tasks) // (4*processes)))
+		finally:
+			pool.close()
+			pool.join()
+	
+	return _results_frame(results, ['timestamp', 'month'])
+	
+
+def _expiry_and_undl(xs, cdr, month, snap_date):
+	"""Option expiry and underlying futures month for an option month code as of 
+	snap_date. Handles midcurve codes like '2EZ3' the same way as midcurves_chain"""
+	mm = EXCH_MONTHS.index(month[-2]) + 1
+	yy = snap_date.year + (int(month[-1]) - snap_date.year%10 + 10) % 10
+	
+	if len(month) == 4:
+		expiry = cdr.mc_expiry(mm, yy)
+	else:
+		expiry = cdr.opt_expiry(mm, yy)
+		
+	return expiry, _undl_month(xs, month)
+	
+	
+def _undl_month(xs, month):
+	"""Underlying futures month code of an option month code, which (unlike the expiry) 
+	doesn't depend on the date"""
+	umon = xs.undlMonths[bisect_left(xs.undlMonths, month[-2]) % len(xs.undlMonths)]
+	uyy = int(month[-1]) + (umon < month[-2])
+	if len(month) == 4:
+		uyy += int(month[0]) + (month[0] == '0')
+	return umon + str(uyy%10)
+	
+
+def _futures_mid(ffut):
+	"""Series of futures prices from settlement or bid / ask columns"""
+	if 'PX_SETTLE' in ffut.columns:
+		return ffut['PX_SETTLE']
+	return (ffut['BID'] + ffut['ASK']) / 2.0
+	
+
+def _history_tasks(xs, cdr, fopt, ffut, beta, x0):
+	"""One (key, fwd, t, beta, strip, x0) task per (timestamp, month) smile"""
+	if 'SETTLE_VOL' in fopt.columns:
+		vols = fopt['SETTLE_VOL']
+	else:
+		vols = (fopt['BID_VOL'] + fopt['ASK_VOL']) / 2.0
+	vols = vols[isfinite(vols.values)]
+	fpx = _futures_mid(ffut).to_dict()
+	
+	tasks = []
+	for (ts, month), smile in vols.groupby(level=['timestamp', 'month']):
+		expiry, umon = _expiry_and_undl(xs, cdr, month, ts)
+		act365 = (expiry - ts).days / 365.0 + (expiry - ts).seconds / 31536000.0
+		strikes = smile.index.get_level_values('strike')
+		tasks.append(((ts, month), fpx.get((umon, ts), nan), act365, beta, \
+			zip(strikes, smile.values), x0.get(month) if isinstance(x0, dict) else x0))
 		
-		df.ix[month] = [fwd, act365, beta, pp[0][0], pp[0][1], pp[0][2]]
+	return tasks
+	
+
+def _smile_groups(xs, cdr, fopt, ffut):
+	"""Forward, time to expiry, whether it's a standard (not midcurve) month and a group 
+	number for each (timestamp, month) of fopt. Returns them per group, and merged back 
+	onto the rows of fopt (in the same order)."""
+	rows = pd.DataFrame({'timestamp': fopt.index.get_level_values('timestamp'), \
+		'month': fopt.index.get_level_values('month'), 'row': arange(len(fopt))})
+	groups = rows[['timestamp', 'month']].drop_duplicates()
+	fpx = _futures_mid(ffut).to_dict()
+	
+	info = []
+	for ts, month in groups.values:
+		expiry, umon = _expiry_and_undl(xs, cdr, month, ts)
+		info.append((fpx.get((umon, ts), nan), (expiry - ts).days / 365.0 \
+			+ (expiry - ts).seconds / 31536000.0, len(month) == 2))
+	groups['fwd'], groups['t'], groups['std'] = zip(*info) if info else ([], [], [])
+	groups['gid'] = arange(len(groups))
+	
+	rows = pd.merge(rows, groups, on=['timestamp', 'month'], how='left').sort('row')
+	return rows, groups
+	
+
+def _fit_task(task):
+	"""Run a single calibration, turning any failure into a result rather than an 
+	exception so one bad smile doesn't take down a whole pool.map"""
+	key, fwd, act365, beta, strip, x0 = task
+	if not isinstance(key, tuple):
+		key = (key,)
+	
+	try:
+		if not isfinite(fwd):
+			raise ValueError('no forward')
+		if act365 <= 0.0:
+			raise ValueError('expired')
+		if len(strip) < 3:
+			raise ValueError('only %d strikes' % len(strip))
+		pp = _fit(fwd, act365, beta, strip, x0)
+	except Exception as e:
+		return key + (fwd, act365, beta, nan, nan, nan, nan, 0, False, str(e))
 		
-	return df
+	return key + (fwd, act365, beta, pp.alpha, pp.rho, pp.nu, pp.residual, pp.iterations, \
+		pp.success, '' if pp.success else pp.message)
+	
+
+def _results_frame(results, keys):
+	return pd.DataFrame.from_records(results, columns = keys + ['fwd', 't', 'beta', \
+		'alpha', 'rho', 'nu', 'residual', 'iterations', 'success', 'message'], index=keys)
 	
 
 def _fit(fwd, act365, beta, strip, x0=None):
+	"""Least squares fit of (alpha, rho, nu) to a strip of (strike, vol) tuples using the 
+	analytic jacobian. Returns a SABRFit."""
 	sf = SABR_Fitter(fwd, beta, act365, strip)
 	
-	tfunc = sf.target
 	if x0 is None:
-		x0 = [0.2, 0.1, 0.05]
+		# start alpha from the ATM vol rather than a fixed guess
+		ii = argsort(sf.strikes)
+		atmv = interp(fwd, sf.strikes[ii], sf.vols[ii])
+		x0 = [atmv * power(fwd, 1.0-beta), 0.1, 0.05]
 	
-	return optimize.leastsq(tfunc, x0)
+	uval, cov, info, mesg, ier = optimize.leastsq(sf.utarget, sf.to_unbounded(x0), \
+		Dfun=sf.ujacobian, full_output=True)
+	
+	alpha, rho, nu = sf.from_unbounded(uval)
+	return SABRFit(alpha, rho, nu, sqrt(mean(info['fvec']**2)), info.get('njev', info['nfev']), \
+		ier in (1, 2, 3, 4), ier, mesg)
 	
-
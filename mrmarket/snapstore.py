@@ -0,0 +1,274 @@
+
+
+import sqlite3, time, os, sys
+from numpy import asarray
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+from pandas.lib import Timestamp
+from metrics import event
+
+__all__ = ['SCHEMA', 'INDEXES', 'connect', 'migrate', 'migrate_all', 'to_epoch', 'from_epoch', \
+	'from_epochs', 'append', 'SnapWriter']
+
+# Timestamps are stored as INTEGER seconds since 1970-01-01 of the (naive, local) snap time,
+# so they compare, sort and index as numbers. Key columns of the tables we know, which come
+# first, and the indexes load() and the snaps' lookups need. Any other table with a timestamp
+# column gets an index on it.
+SCHEMA = {
+	'options': [('timestamp', 'INTEGER NOT NULL'), ('month', 'TEXT NOT NULL'), ('strike', 'REAL NOT NULL')],
+	'futures': [('timestamp', 'INTEGER NOT NULL'), ('mon', 'TEXT NOT NULL')]}
+INDEXES = {
+	'options': [('timestamp', 'month', 'strike')],
+	'futures': [('mon', 'timestamp'), ('timestamp',)]}
+EPOCH = datetime(1970, 1, 1)
+
+# applied to every connection we write through. WAL lets a snap write while load() reads,
+# and with WAL synchronous=NORMAL is still safe against a crash (only a power cut can lose
+# the last commits). page_size only takes for a new file.
+PRAGMAS = [('page_size', 8192), ('journal_mode', 'WAL'), ('synchronous', 'NORMAL'), \
+	('cache_size', -16000), ('temp_store', 'MEMORY')]
+
+
+def connect(fname, **kwargs):
+	"""sqlite3.connect with PRAGMAS applied and the file migrated to SCHEMA if need be (see
+	migrate). Transactions are left to the caller (see SnapWriter), rather than the sqlite3
+	module starting and committing them behind our back. Text comes back as str, not unicode,
+	so month codes etc need no converting."""
+	conn = _open(fname, **kwargs)
+	t0 = time.time()
+	migrated = migrate(conn)
+	if migrated:
+		event('migrated', _migrated(fname, migrated, time.time() - t0), every=0, fname=fname, \
+			tables=migrated)
+	return conn
+	
+	
+def _open(fname, **kwargs):
+	conn = sqlite3.connect(fname, **kwargs)
+	conn.isolation_level = None
+	conn.text_factory = str
+	for name, value in PRAGMAS:
+		conn.execute('PRAGMA %s = %s' % (name, value))
+	return conn
+	
+	
+def _migrated(fname, migrated, seconds):
+	return 'Migrated %s (%s) in %.2fs' % (fname, ', '.join('%s %d rows' % tn for tn in migrated), seconds)
+	
+	
+def to_epoch(dt):
+	"""Stored form of a datetime, date, Timestamp or date string"""
+	if isinstance(dt, basestring):
+		dt = Timestamp(dt)
+	if not isinstance(dt, datetime):
+		dt = datetime(dt.year, dt.month, dt.day)
+	delta = dt - EPOCH
+	return delta.days * 86400 + delta.seconds
+	
+	
+def from_epoch(secs):
+	return Timestamp(EPOCH + timedelta(seconds=int(secs)))
+	
+	
+def from_epochs(secs):
+	"""A whole column of stored timestamps as a datetime64 array, in one numpy cast"""
+	return asarray(secs, dtype='int64').astype('datetime64[s]').astype('datetime64[ns]')
+	
+	
+def _indexes(table, cols):
+	if table in INDEXES:
+		return INDEXES[table]
+	return [('timestamp',)] if 'timestamp' in cols else []
+	
+	
+def _create(conn, table, cols, types):
+	"""Create a table with the key columns of SCHEMA first, and its indexes"""
+	keys = SCHEMA.get(table, [])
+	cols = [cc for cc, tt in keys] + [cc for cc in cols if cc not in dict(keys)]
+	types = dict(types, **dict(keys))
+	if 'timestamp' in cols and not table in SCHEMA:
+		types['timestamp'] = 'INTEGER'
+	conn.execute('CREATE TABLE %s (%s)' % (table, ', '.join('[%s] %s' % (cc, types[cc]) for cc in cols)))
+	for idx in _indexes(table, cols):
+		conn.execute('CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)' % (table, '_'.join(idx), table, \
+			', '.join('[%s]' % cc for cc in idx)))
+	return cols
+	
+	
+def migrate(conn):
+	"""Bring the tables of a file written before the schema above up to date: timestamps stored 
+	as text (as write_frame left them) are converted to epoch seconds, which means copying the 
+	table, and missing indexes are added. Tables already up to date are left alone, so this is 
+	cheap to call on every connect. Returns the (table, rows) copied."""
+	migrated = []
+	tables = [rr[0] for rr in conn.execute('SELECT name FROM sqlite_master WHERE type = "table"')]
+	for table in tables:
+		info = conn.execute('PRAGMA table_info(%s)' % table).fetchall()
+		cols = [rr[1] for rr in info]
+		types = dict((rr[1], rr[2] or 'REAL') for rr in info)
+		if 'timestamp' not in cols:
+			continue
+		if types['timestamp'].upper().startswith('INTEGER'):
+			for idx in _indexes(table, cols):
+				conn.execute('CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)' % (table, '_'.join(idx), \
+					table, ', '.join('[%s]' % cc for cc in idx)))
+			continue
+		
+		conn.execute('BEGIN')
+		try:
+			conn.execute('ALTER TABLE %s RENAME TO _old_%s' % (table, table))
+			new = _create(conn, table, cols, types)
+			# a TIMESTAMP column can have had integers written into it as well as text
+			exprs = ['CASE WHEN typeof([timestamp]) = "integer" THEN [timestamp] ELSE ' \
+				'CAST(strftime("%s", [timestamp]) AS INTEGER) END' if cc == 'timestamp' else \
+				'[%s]' % cc for cc in new]
+			conn.execute('INSERT INTO %s (%s) SELECT %s FROM _old_%s' % (table, ', '.join('[%s]' % cc \
+				for cc in new), ', '.join(exprs), table))
+			conn.execute('DROP TABLE _old_%s' % table)
+		except:
+			conn.execute('ROLLBACK')
+			raise
+		conn.execute('COMMIT')
+		migrated.append((table, conn.execute('SELECT COUNT(*) FROM %s' % table).fetchone()[0]))
+	return migrated
+		
+		
+def migrate_all(datadir, stores=('settle', 'live', 'sabr', 'cube')):
+	"""Migrate every DATA/<store>/*.sql, e.g. from the command line
+		python snapstore.py /path/to/DATA/
+	Returns {filename: [(table, rows), ...]} of what was migrated."""
+	done = {}
+	for store in stores:
+		path = os.path.join(datadir, store)
+		if not os.path.isdir(path):
+			continue
+		for fname in sorted(os.listdir(path)):
+			if not fname.endswith('.sql'):
+				continue
+			fname = os.path.join(path, fname)
+			t0 = time.time()
+			conn = _open(fname)
+			migrated = migrate(conn)
+			conn.close()
+			if migrated:
+				print _migrated(fname, migrated, time.time() - t0)
+				done[fname] = migrated
+	return done
+
+
+def _sqltype(dtype):
+	if dtype.kind == 'f':
+		return 'REAL'
+	elif dtype.kind in 'iubM':
+		return 'INTEGER'
+	return 'TEXT'
+
+
+def _values(col):
+	"""A column as python objects sqlite3 can bind, without going through a row at a time"""
+	if col.dtype.kind == 'M':
+		secs = col.values.astype('datetime64[s]').astype('int64')
+		return [None if nat else ss for ss, nat in zip(secs.tolist(), col.isnull().values)]
+	return col.values.tolist()
+
+
+def append(conn, table, frame):
+	"""Append a dataframe's columns to a table in one executemany, creating the table (see 
+	SCHEMA) with typed columns or adding any columns it doesn't have yet (e.g. the greeks, for 
+	files created before they were snapped). Datetime columns are written as epoch seconds.
+	Doesn't commit. Returns the number of rows."""
+	cols = [str(cc) for cc in frame.columns]
+	types = dict((str(cc), _sqltype(frame[cc].dtype)) for cc in frame.columns)
+	existing = [rr[1] for rr in conn.execute('PRAGMA table_info(%s)' % table)]
+	if not existing:
+		_create(conn, table, cols, types)
+	else:
+		for cc in cols:
+			if cc not in existing:
+				conn.execute('ALTER TABLE %s ADD COLUMN [%s] %s' % (table, cc, types[cc]))
+
+	if not len(frame):
+		return 0
+	rows = zip(*[_values(frame[cc]) for cc in frame.columns])
+	conn.executemany('INSERT INTO %s (%s) VALUES (%s)' % (table, ', '.join('[%s]' % cc \
+		for cc in cols), ', '.join('?' * len(cols))), rows)
+	return len(rows)
+
+
+class SnapWriter(object):
+	"""Writes snapshots (an options and a futures frame, say) to a sqlite file. Each snapshot
+	goes in all or nothing, and snapshots are committed 'batch' at a time, so a backfill of
+	many days costs one fsync per batch rather than two per day.
+
+		with SnapWriter(fname, batch=20) as writer:
+			for ...:
+				with writer.snapshot():
+					writer.append('options', optf)
+					writer.append('futures', futf)
+
+	Leaving the with block (or close()) commits the snapshots written so far, even if it's 
+	left by an exception, so a failure doesn't lose the batch before it or leave the file's 
+	write lock held by an open transaction. rows counts what's been written and seconds the 
+	time spent appending and committing it, and close() reports the throughput."""
+
+	def __init__(self, fname, batch=1, **kwargs):
+		self.fname = fname
+		self.batch = batch
+		self.conn = connect(fname, **kwargs)
+		self.begun = False
+		self.pending = 0
+		self.rows = 0
+		self.seconds = 0.0
+
+	@contextmanager
+	def snapshot(self):
+		"""Everything appended in the block is written, or (if it raises) none of it is"""
+		if not self.begun:
+			self.conn.execute('BEGIN')
+			self.begun = True
+		self.conn.execute('SAVEPOINT snapshot')
+		rows = self.rows
+		try:
+			yield self
+		except:
+			self.conn.execute('ROLLBACK TO snapshot')
+			self.conn.execute('RELEASE snapshot')
+			self.rows = rows
+			raise
+		self.conn.execute('RELEASE snapshot')
+		self.pending += 1
+		if self.pending >= self.batch:
+			self.commit()
+
+	def append(self, table, frame):
+		t0 = time.time()
+		self.rows += append(self.conn, table, frame)
+		self.seconds += time.time() - t0
+
+	def commit(self):
+		if self.begun:
+			t0 = time.time()
+			self.conn.execute('COMMIT')
+			self.seconds += time.time() - t0
+			self.begun = False
+			self.pending = 0
+
+	def __enter__(self):
+		return self
+		
+	def __exit__(self, *exc_info):
+		self.close()
+		
+	def close(self):
+		try:
+			self.commit()
+		finally:
+			self.conn.close()
+		if self.rows:
+			event('store', 'Wrote %d rows to %s in %.2fs (%.0f rows/s)' % (self.rows, self.fname, \
+				self.seconds, self.rows / max(self.seconds, 1e-6)), every=0, fname=self.fname, \
+				rows=self.rows, seconds=self.seconds)
+
+
+if __name__ == '__main__':
+	migrate_all(sys.argv[1])
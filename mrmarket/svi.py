@@ -0,0 +1,199 @@
+
+
+import pandas as pd
+import time
+from numpy import sqrt, log, exp, linspace, where, inf, maximum, minimum, clip, arange, \
+	repeat, tile, zeros, ones, isfinite, nan, array, mean, eye
+from numpy.linalg import solve
+from numpy.random import RandomState
+from exchange import Computus, XSpec
+from finutils import svi_var
+from sabr import SABR, _fit, _history_tasks
+from arbitrage import scan
+
+
+__all__ = ['fit', 'fit_history', 'fit_smiles', 'benchmark']
+
+# smiles are fitted in batches of this many to keep the (smile, grid, strike) arrays small
+BATCH = 256
+
+
+def fit(product, snap_date, fopt, ffut, batch=BATCH):
+	"""Fit SVI to each month of a single snapshot, as returned by snap_by_delta or
+	snap_largest_volume (options indexed by ('month', 'strike') with SETTLE_VOL or
+	BID_VOL / ASK_VOL, futures indexed by month). Returns a dataframe indexed by month,
+	see fit_history for the columns."""
+	fopt = pd.concat([fopt], keys=[snap_date], names=['timestamp'])
+	ffut = pd.concat([ffut], keys=[snap_date], names=['timestamp']).swaplevel(0, 1)
+	ffut.index.names = ['mon', 'timestamp']
+
+	return fit_history(product, fopt, ffut, batch).reset_index(level=0, drop=True)
+
+
+def fit_history(product, fopt, ffut, batch=BATCH, prefilter=False):
+	"""Fit SVI to every (timestamp, month) smile of a stored history, taking the same
+	frames as sabr.fit_history. Returns a dataframe indexed by ('timestamp', 'month') with
+	columns fwd, t, a, b, sigma, rho, m, residual, success, message where (a, b, sigma,
+	rho, m) is the parameter vector of finutils.svi_var and residual is the rms vol error,
+	so it lines up with the SABR output. With prefilter=True rows flagged by arbitrage.scan
+	are left out."""
+	xs = XSpec().spec(product)
+	cdr = Computus().make(xs.computus)
+	if prefilter:
+		fopt = fopt[scan(product, fopt, ffut).values == 0]
+
+	tasks = _history_tasks(xs, cdr, fopt, ffut, None, None)
+	params, resid = fit_smiles([(tt[1], tt[2], tt[4]) for tt in tasks], xs.model == 'normal', batch)
+
+	rows = []
+	for tt, pp, rr in zip(tasks, params, resid):
+		if not isfinite(tt[1]):
+			msg = 'no forward'
+		elif tt[2] <= 0.0:
+			msg = 'expired'
+		elif not isfinite(rr):
+			msg = 'only %d strikes' % len(tt[4])
+		else:
+			msg = ''
+		rows.append(tt[0] + (tt[1], tt[2]) + tuple(pp) + (rr, msg == '', msg))
+
+	return pd.DataFrame.from_records(rows, columns = ['timestamp', 'month', 'fwd', 't', \
+		'a', 'b', 'sigma', 'rho', 'm', 'residual', 'success', 'message'], \
+		index=['timestamp', 'month'])
+
+
+def fit_smiles(smiles, normal=False, batch=BATCH):
+	"""Fit SVI total variance to a list of (fwd, t, [(strike, vol), ...]) smiles. The
+	moneyness is log(K/F), or K - F for Bachelier vols (normal=True). Returns an (n, 5)
+	array of svi_var parameters and an array of rms vol errors (NaN where a smile has
+	fewer than 3 usable points)."""
+	nn = max([len(ss[2]) for ss in smiles] + [1])
+	k = zeros((len(smiles), nn))
+	v = zeros((len(smiles), nn))
+	ok = zeros((len(smiles), nn), dtype=bool)
+	t = array([ss[1] for ss in smiles], dtype=float)
+
+	for ii, (fwd, tau, strip) in enumerate(smiles):
+		if not strip or not isfinite(fwd) or not tau > 0.0:
+			continue
+		kk, vv = array(strip, dtype=float).T
+		k[ii,:len(kk)] = kk - fwd if normal else log(kk/fwd)
+		v[ii,:len(vv)] = vv
+		ok[ii,:len(vv)] = isfinite(vv) & isfinite(k[ii,:len(kk)])
+
+	params = zeros((len(smiles), 5)) + nan
+	resid = zeros(len(smiles)) + nan
+	tt = where(t > 0.0, t, 1.0)
+
+	for i0 in range(0, len(smiles), batch):
+		sl = slice(i0, i0 + batch)
+		good = ok[sl].sum(1) >= 3
+		if not good.any():
+			continue
+		bk, bv, bok = k[sl][good], v[sl][good], ok[sl][good]
+		bt = tt[sl][good]
+
+		pp = _qe_fit(bk, bv*bv*bt[:,None], bok)
+		mvol = sqrt(maximum(svi_var([pp[:,ii,None] for ii in range(5)], bk), 0.0) / bt[:,None])
+
+		params[i0 + where(good)[0]] = pp
+		resid[i0 + where(good)[0]] = sqrt((bok*(mvol - bv)**2).sum(1) / bok.sum(1))
+
+	return params, resid
+
+
+def _qe_fit(k, w, ok, levels=6, ngrid=12):
+	"""Quasi-explicit SVI calibration (Zeliade, 2009) for a batch of smiles at once. k, w
+	and ok are (n, N) arrays of moneyness, total variance and valid point mask.
+
+	For fixed (m, sigma) and y = (k - m)/sigma the slice is linear, w = a + d*y + c*sqrt(y*y+1),
+	so (a, d, c) comes from a 3x3 least squares solve, clipped to 0 <= c <= 4*sigma and
+	|d| <= min(c, 4*sigma - c). The outer (m, sigma) search is a grid which is zoomed in
+	around the best point 'levels' times, all smiles in the batch in the same numpy ops."""
+	n = k.shape[0]
+	wt = ok.astype(float)
+	k = where(ok, k, 0.0)
+	w = where(ok, w, 0.0)
+
+	kmin = where(ok, k, inf).min(1)
+	kmax = where(ok, k, -inf).max(1)
+	span = maximum(kmax - kmin, 1.0e-8)
+
+	# m searched over the strike range, sigma (in logs) over 1e-3 to 10 times the range
+	mc, mh = 0.5*(kmin + kmax), span
+	sc, sh = log(0.1*span), log(100.0) * ones(n)
+	grid = linspace(-1.0, 1.0, ngrid)
+	rows = arange(n)
+
+	for level in range(levels):
+		M = repeat(mc[:,None] + mh[:,None]*grid, ngrid, axis=1)
+		S = exp(tile(sc[:,None] + sh[:,None]*grid, (1, ngrid)))
+
+		abc, sse = _inner(k, w, wt, M, S)
+		best = sse.argmin(1)
+		mc, sc = M[rows,best], log(S[rows,best])
+		mh, sh = 2.0*mh/(ngrid - 1), 2.0*sh/(ngrid - 1)
+
+	a, d, c = abc[rows,best].T
+	sigma = S[rows,best]
+	b = c / sigma
+	rho = where(c > 0.0, d / where(c > 0.0, c, 1.0), 0.0)
+
+	return array([a, b, sigma, rho, mc]).T
+
+
+def _inner(k, w, wt, M, S):
+	"""Constrained linear solve for (a, d, c) at every grid point. k, w, wt are (n, N),
+	M and S are (n, G). Returns (n, G, 3) parameters and (n, G) sum of squared errors."""
+	y = (k[:,None,:] - M[:,:,None]) / S[:,:,None]
+	z = sqrt(y*y + 1.0)
+	wt = wt[:,None,:]
+	w = w[:,None,:]
+
+	s1, sw = [ss.repeat(M.shape[1], 1) for ss in (wt.sum(2), (wt*w).sum(2))]
+	sy, sz = (wt*y).sum(2), (wt*z).sum(2)
+	syy, syz, szz = (wt*y*y).sum(2), (wt*y*z).sum(2), (wt*z*z).sum(2)
+	swy, swz, sww = (wt*w*y).sum(2), (wt*w*z).sum(2), (wt*w*w).sum(2)
+
+	A = array([[s1, sy, sz], [sy, syy, syz], [sz, syz, szz]]).transpose(2, 3, 0, 1)
+	A += 1.0e-12 * (s1 + syy + szz)[:,:,None,None] * eye(3)
+	rhs = array([sw, swy, swz]).transpose(1, 2, 0)
+	a, d, c = solve(A, rhs[...,None])[...,0].transpose(2, 0, 1)
+
+	# project onto the no-arbitrage domain and re-solve the level for the clipped slope
+	c = clip(c, 0.0, 4.0*S)
+	dmax = minimum(c, 4.0*S - c)
+	d = clip(d, -dmax, dmax)
+	a = (sw - d*sy - c*sz) / s1
+
+	sse = sww - 2.0*(a*sw + d*swy + c*swz) + a*a*s1 + d*d*syy + c*c*szz \
+		+ 2.0*(a*d*sy + a*c*sz + d*c*syz)
+
+	return array([a, d, c]).transpose(1, 2, 0), sse
+
+
+def benchmark(nsmiles=500, nstrikes=15, seed=0):
+	"""Time SVI against the SABR fit on the same random SABR smiles. Returns a dataframe
+	with total seconds, milliseconds per smile and mean rms vol error for each."""
+	rs = RandomState(seed)
+	smiles = []
+	for ii in range(nsmiles):
+		fwd, t = 100.0, rs.uniform(0.1, 2.0)
+		model = SABR(fwd, rs.uniform(0.1, 0.4), 1.0, rs.uniform(-0.7, 0.3), rs.uniform(0.2, 1.0))
+		strikes = fwd * exp(linspace(-2.0, 2.0, nstrikes) * 0.25 * sqrt(t))
+		smiles.append((fwd, t, [(kk, model(kk, t)) for kk in strikes]))
+
+	t0 = time.time()
+	resid = [_fit(fwd, t, 1.0, strip).residual for fwd, t, strip in smiles]
+	tsabr = time.time() - t0
+
+	t0 = time.time()
+	params, sresid = fit_smiles(smiles)
+	tsvi = time.time() - t0
+
+	return pd.DataFrame({'seconds': [tsabr, tsvi], 'ms_per_smile': [1e3*tsabr/nsmiles, \
+		1e3*tsvi/nsmiles], 'rms_vol_error': [mean(resid), mean(sresid)]}, index=['sabr', 'svi'])
+
+
+if __name__ == '__main__':
+	print benchmark()
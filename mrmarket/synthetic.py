@@ -0,0 +1,223 @@
+
+
+import re, zlib, time
+import pandas as pd
+from datetime import datetime, timedelta
+from numpy import sqrt, exp, log, array, where, maximum, floor, nan, isfinite, zeros
+from scipy.stats import norm
+from exchange import Computus, XSpec
+from finutils import black_price, black_price_bn
+from sabr import SABR_Fitter, _expiry_and_undl, EXCH_MONTHS
+from backends import Backend
+from pandaburger import PandaBurger
+from snapstore import SnapWriter
+
+__all__ = ['SyntheticBackend', 'benchmark']
+
+_TICKER = re.compile('^(?P<name>\w+?)(?P<mm>[FGHJKMNQUVXZ]\d)((?P<type>[PC])\s(?P<k>\d+(\.\d+)?))? ' \
+	'(?P<src>\w+) (?P<yk>\w+)$')
+# midcurve options like '2EZ3C 98.5 Comdty', with the product's midcurve code as in FOGrabber
+_MIDCURVE = '^(?P<mm>\d%s[FGHJKMNQUVXZ]\d{1})(?P<type>[PC])\s(?P<k>\d+(\.\d+)?) (?P<src>\w+) (?P<yk>\w+)$'
+
+
+def _uniform(key):
+	"""Cheap deterministic uniform in (0, 1) for a string key"""
+	return ((zlib.crc32(key) & 0xffffffff) + 0.5) / 4294967296.0
+
+
+class SyntheticBackend(Backend):
+	"""Made up but self-consistent market data for the futures, options and midcurves of the
+	given products, for load testing at sizes that have never been recorded. Expiries and
+	underlyings come from the XSpec / Computus definitions, futures from a smooth curve and
+	options from a SABR smile on each expiry (lognormal vols, converted to Bachelier vols
+	for normal model products). Everything, including sizes and volumes, is a function of
+	the seed, the ticker and the date, so the same request always gets the same answer.
+
+	Realtime requests are priced as of asof (now by default). Historical requests get one
+	row per weekday and intraday requests get no data. levels maps product to a front
+	futures price, defaulting to 98 for normal model products and 200 strike steps
+	otherwise."""
+
+	def __init__(self, products, seed=0, asof=None, levels=None, specfile=None):
+		self.seed = seed
+		self.asof = asof
+		self.levels = levels or {}
+		self.computus = Computus()
+		self.specs = {}
+		self.calendars = {}
+		self.midcurves = {}
+
+		specs = XSpec(specfile)
+		for pp in products:
+			xs = specs.spec(pp)
+			self.specs[pp] = xs
+			self.calendars[pp] = self.computus.make(xs.computus)
+			if pd.notnull(xs.midcurves):
+				self.midcurves[pp] = re.compile(_MIDCURVE % xs.midcurves[1])
+
+	def fetch(self, securities, fields, d0=None, d1=None, interval=0, periodicity=None):
+		if interval:
+			return {sec: [] for sec in securities}
+		if not d0 and not d1:
+			snap = self.asof or datetime.now()
+			return {sec: row for sec, row in zip(securities, self.quotes(securities, fields, snap))}
+
+		dd, d1 = d0 or d1, d1 or d0
+		bdata = {sec: [] for sec in securities}
+		while dd <= d1:
+			if dd.weekday() < 5:
+				for sec, row in zip(securities, self.quotes(securities, fields, dd)):
+					if row:
+						bdata[sec].append([('date', dd)] + row)
+			dd += timedelta(days=1)
+		return bdata
+
+	def quotes(self, securities, fields, snap):
+		"""[(field, value), ...] for each security as of snap, [] for ones that don't parse,
+		aren't one of our products or have expired"""
+		day = snap.strftime('%Y%m%d')
+		fut, opt = [], []
+		for ii, sec in enumerate(securities):
+			mt = _TICKER.match(sec)
+			if mt is not None and mt.group('name') in self.specs:
+				product = mt.group('name')
+			else:
+				for product, mcre in self.midcurves.iteritems():
+					mt = mcre.match(sec)
+					if mt is not None:
+						break
+				else:
+					continue
+			mm = mt.group('mm')
+			if mt.group('type') is None:
+				fut.append((ii, product, mm))
+			else:
+				opt.append((ii, product, mm, mt.group('type'), float(mt.group('k'))))
+
+		rows = [[] for sec in securities]
+		for ii, product, mm in fut:
+			fwd, tau = self.future(product, mm, snap)
+			if tau < 0.0:
+				continue
+			tick = 0.005 * self.specs[product].strikeStep
+			spread = tick * (1.0 + floor(4.0*_uniform('%d|spread|%s|%s' % (self.seed, securities[ii], day))))
+			volume = 100000.0 * exp(-2.0*tau) * (0.5 + _uniform('%d|vol|%s|%s' % (self.seed, securities[ii], day)))
+			rows[ii] = self._row(fields, securities[ii], day, tick*round(fwd/tick), spread, int(volume))
+
+		if not opt:
+			return rows
+
+		# price the options a smile at a time
+		smiles = {}
+		for oo in opt:
+			smiles.setdefault(oo[1:3], []).append(oo)
+		for (product, mm), oo in smiles.iteritems():
+			xs = self.specs[product]
+			expiry, umon = _expiry_and_undl(xs, self.calendars[product], mm, snap)
+			tau = (expiry - snap).days / 365.0 + (expiry - snap).seconds / 31536000.0
+			fwd, ftau = self.future(product, umon, snap)
+			if tau <= 0.0 or ftau < 0.0:
+				continue
+
+			strikes = array([o[4] for o in oo])
+			otype = array([o[3] for o in oo])
+			ok = strikes > 0.0
+			vol = self.smile(product, mm, snap, fwd, tau, where(ok, strikes, fwd))
+			if xs.model == 'normal':
+				vol = vol * sqrt(fwd * where(ok, strikes, fwd))
+				px = black_price_bn(otype, fwd, strikes, tau, vol)
+				sd = (strikes - fwd) / (vol * sqrt(tau))
+			else:
+				px = black_price(otype, fwd, where(ok, strikes, fwd), tau, vol)
+				sd = log(where(ok, strikes, fwd) / fwd) / (vol * sqrt(tau))
+
+			tick = 0.005 * xs.strikeStep
+			mid = tick * floor(px / tick + 0.5)
+			for jj, o in enumerate(oo):
+				if not ok[jj] or not isfinite(mid[jj]):
+					continue
+				sec = securities[o[0]]
+				spread = tick * (1.0 + floor(4.0*_uniform('%d|spread|%s|%s' % (self.seed, sec, day))))
+				volume = 5000.0 * exp(-0.5*sd[jj]*sd[jj]) * (0.5 + _uniform('%d|vol|%s|%s' % (self.seed, sec, day)))
+				rows[o[0]] = self._row(fields, sec, day, mid[jj], spread, int(volume))
+
+		return rows
+
+	def future(self, product, mm, snap):
+		"""Futures price and years to last trade for a month code like 'M4' as of snap"""
+		xs = self.specs[product]
+		mon = EXCH_MONTHS.index(mm[0]) + 1
+		yy = snap.year + (int(mm[1]) - snap.year%10 + 10) % 10
+		last = self.calendars[product].fut_last_trade(mon, yy)
+		tau = (last - snap).days / 365.0 + (last - snap).seconds / 31536000.0
+
+		day = snap.strftime('%Y%m%d')
+		shock = norm.ppf(_uniform('%d|level|%s|%s' % (self.seed, product, day)))
+		wiggle = norm.ppf(_uniform('%d|curve|%s|%s|%s' % (self.seed, product, mm, day)))
+		if xs.model == 'normal':
+			# price = 100 - rate, with rates rising along the curve
+			level = self.levels.get(product, 98.0)
+			return level + 0.1*shock - 0.6*tau*(1.0 - exp(-0.5*tau)) + 0.01*wiggle, tau
+		level = self.levels.get(product, 200.0 * xs.strikeStep)
+		return level * exp(0.01*shock + 0.02*tau + 0.002*wiggle), tau
+
+	def smile(self, product, mm, snap, fwd, tau, strikes):
+		"""Lognormal SABR (beta = 1) vols for one expiry. The parameters follow a simple
+		term structure with a little noise per (product, month, date)."""
+		day = snap.strftime('%Y%m%d')
+		zz = [norm.ppf(_uniform('%d|%s|%s|%s|%s' % (self.seed, pp, product, mm, day))) \
+			for pp in ('alpha', 'rho', 'nu')]
+		base = 0.005 if self.specs[product].model == 'normal' else 0.25
+
+		sf = SABR_Fitter(fwd, 1.0, tau, [(kk, 0.0) for kk in strikes])
+		sf.alpha = base * (1.0 + 0.3*exp(-tau)) * exp(0.05*zz[0])
+		sf.rho = max(-0.9, min(0.9, -0.3 + 0.1*zz[1]))
+		sf.nu = 0.8 * exp(0.1*zz[2]) / sqrt(1.0 + tau)
+		return sf._smile()
+
+	def _row(self, fields, sec, day, mid, spread, volume):
+		bsize = 1 + int(500 * _uniform('%d|bsize|%s|%s' % (self.seed, sec, day)))
+		asize = 1 + int(500 * _uniform('%d|asize|%s|%s' % (self.seed, sec, day)))
+		bid = mid - 0.5*spread
+		if bid <= 0.0:
+			bid, bsize = 0.0, 0
+		values = {'BID': bid, 'ASK': mid + 0.5*spread, 'BID_SIZE': bsize, 'ASK_SIZE': asize, \
+			'VOLUME': volume, 'PX_SETTLE': mid, 'PX_LAST': mid, 'PX_MID': mid}
+		return [(ff, values[ff]) for ff in fields if ff in values]
+
+
+def benchmark(datadir, products, sdate=None, seed=0, nn=10, deltas=[0.05,0.1,0.25,0.4]):
+	"""Time snap_by_delta, snap_largest_volume (the nn most traded strikes per expiry, so
+	a large nn snaps every strike) and storing the results, for each product against a
+	SyntheticBackend. Snaps are live if sdate is today (the default) and settles otherwise.
+	Returns a dataframe of seconds and options per product. Tables are written to
+	DATA/synthetic.sql, which is recreated each time."""
+	from mrmarket import MrMarket
+
+	sdate = sdate or datetime.now()
+	mrmkt = MrMarket(datadir, pb=PandaBurger(SyntheticBackend(products, seed, sdate)))
+	with SnapWriter(datadir + 'synthetic.sql') as writer:
+		for table in ('options', 'futures'):
+			writer.conn.execute('DROP TABLE IF EXISTS %s' % table)
+
+		rows = []
+		for product in products:
+			t0 = time.time()
+			futf, optd = mrmkt.snap_by_delta(product, sdate, deltas)
+			t1 = time.time()
+			futf, optv = mrmkt.snap_largest_volume(product, sdate, nn)
+			t2 = time.time()
+
+			optv['timestamp'] = sdate
+			futf['timestamp'] = sdate
+			del futf['ticker']
+			del futf['last_trade']
+			with writer.snapshot():
+				writer.append('options', optv.reset_index())
+				writer.append('futures', futf.reset_index())
+			t3 = time.time()
+
+			rows.append((product, t1 - t0, len(optd), t2 - t1, len(optv), t3 - t2))
+
+	return pd.DataFrame.from_records(rows, columns=['product', 'by_delta', 'n_by_delta', \
+		'by_volume', 'n_by_volume', 'store'], index='product')
@@ -4,6 +4,7 @@ from exchange import XSpec
 from exchange.computus import Computus, business_day
 from mrmarket import MrMarket
 from pandaburger import PandaBurger
+from metrics import tagged
 from pandas.io import sql
 from pandas.lib import Timestamp
 import datetime
@@ -120,7 +121,7 @@ def futures_curve(mrmkt, **kwargs):
 	#print fsettle
 	
 	
-def bbget(tickers, fields="PX_LAST", start=None, end=None, period=None, dates=None):
+def bbget(tickers, fields="PX_LAST", start=None, end=None, period=None, dates=None, pb=None):
 	"""Convenience function for downloading Bloomberg data.
 	
 	Args:
@@ -134,21 +135,24 @@ def bbget(tickers, fields="PX_LAST", start=None, end=None, period=None, dates=No
 			end: End date for historical data, defaults to now. 
 		OR
 			dates: Array of dates 
+		pb: PandaBurger to use, defaults to the shared live session
 		
 	Returns a pandas panel for multiple fields, a dataframe for a single field.
 	"""
 	
-	pb = PandaBurger()
-	pb.connect('localhost', 8194)
+	if pb is None:
+		pb = PandaBurger()
 	interval = 0
 	
 	if start is None and end is None and dates is None:
-		data = pb.fetch(tickers, fields))
+		with tagged('bbget'):
+			return pb.fetch(tickers, fields)
 	
 	if not dates is None:
 		data = {} # have no idea why you cant' assign directly to a panel
 		for di in dates:
-			datum = pb.fetch(tickers, fields, di, di)
+			with tagged('bbget'):
+				datum = pb.fetch(tickers, fields, di, di)
 			if di in datum.major_axis:
 				data[di] = datum.major_xs(di)	
 		return pd.Panel(data) 
@@ -175,7 +179,8 @@ def bbget(tickers, fields="PX_LAST", start=None, end=None, period=None, dates=No
 		start = _start
 			
 	
-	data = pb.fetch(tickers, fields, start, end, interval)
+	with tagged('bbget'):
+		data = pb.fetch(tickers, fields, start, end, interval)
 	
 	# force timestamp?
 	
@@ -184,8 +189,6 @@ def bbget(tickers, fields="PX_LAST", start=None, end=None, period=None, dates=No
 	else:
 		return data
 	
-	# really need a pandaburger.disconnect (or want, probably don't need it)
-	
 	
 def stir_conditional_curve(mrmkt, **kwargs):
 	pass
@@ -0,0 +1,147 @@
+
+
+from numpy import sqrt, log, array, asarray, argsort, interp, isfinite, searchsorted, clip, \
+	where, maximum, broadcast_arrays, empty, unique, linspace, exp
+from collections import OrderedDict
+from exchange import Computus, XSpec
+from finutils import svi_var
+from sabr import SABR_Fitter, _history_tasks
+
+__all__ = ['VolSurface', 'surface']
+
+# number of surfaces kept by surface() below
+CACHE_SIZE = 64
+_cache = OrderedDict()
+
+
+class VolSurface(object):
+	"""Implied vol surface for one snapshot. Each expiry is held as sorted total variance
+	nodes against log-moneyness (K - F for normal vol products), so a query is linear in
+	total variance across strikes (flat vol outside the quoted strikes) and across expiries
+	(flat vol before the first and after the last). Queries take whole arrays of (strike, t).
+	Midcurves have their own underlyings so aren't part of the surface."""
+
+	def __init__(self, smiles, normal=False):
+		"""smiles is a list of (month, fwd, t, [(strike, vol), ...])"""
+		self.normal = normal
+		smiles = sorted([ss for ss in smiles if len(ss[0]) == 2 and isfinite(ss[1]) and ss[2] > 0.0 \
+			and len(ss[3])], key=lambda ss: ss[2])
+
+		self.months = [ss[0] for ss in smiles]
+		self.fwd = array([ss[1] for ss in smiles], dtype=float)
+		self.t = array([ss[2] for ss in smiles], dtype=float)
+		self._k = []
+		self._w = []
+
+		for month, fwd, t, strip in smiles:
+			kk, vv = array(strip, dtype=float).T
+			ok = isfinite(vv)
+			xx = self.moneyness(kk[ok], fwd)
+			ii = argsort(xx)
+			self._k.append(xx[ii])
+			self._w.append(vv[ok][ii]**2 * t)
+
+	@classmethod
+	def from_snapshot(cls, product, fopt, ffut, timestamp=None):
+		"""Build from the stored vols of one timestamp (the last by default) of frames
+		like MrMarket.opt_settle / fut_settle or opt_live / fut_live"""
+		xs = XSpec().spec(product)
+		cdr = Computus().make(xs.computus)
+		if timestamp is None:
+			timestamp = fopt.index.get_level_values('timestamp').max()
+
+		fopt = fopt[fopt.index.get_level_values('timestamp') == timestamp]
+		ffut = ffut[ffut.index.get_level_values('timestamp') == timestamp]
+		tasks = _history_tasks(xs, cdr, fopt, ffut, None, None)
+
+		return cls([(tt[0][1], tt[1], tt[2], tt[4]) for tt in tasks], xs.model == 'normal')
+
+	@classmethod
+	def from_params(cls, params, model='sabr', normal=False, npts=41):
+		"""Build from a month indexed frame of sabr.fit or svi.fit parameters, sampling each
+		expiry at npts points out to 4 standard deviations either side of the forward"""
+		smiles = []
+		for month, pp in params.iterrows():
+			if not pp['t'] > 0.0 or not isfinite(pp['fwd']):
+				continue
+			if model == 'sabr':
+				sf = SABR_Fitter(pp['fwd'], pp['beta'], pp['t'], [(pp['fwd'], 0.0)])
+				sf.alpha, sf.rho, sf.nu = pp['alpha'], pp['rho'], pp['nu']
+				atmv = sf._smile()[0]
+			else:
+				svi = [pp['a'], pp['b'], pp['sigma'], pp['rho'], pp['m']]
+				atmv = sqrt(svi_var(svi, 0.0) / pp['t'])
+
+			xx = linspace(-4.0, 4.0, npts) * atmv * sqrt(pp['t'])
+			strikes = pp['fwd'] + xx if normal else pp['fwd'] * exp(xx)
+			if model == 'sabr':
+				sf = SABR_Fitter(pp['fwd'], pp['beta'], pp['t'], [(kk, 0.0) for kk in strikes])
+				sf.alpha, sf.rho, sf.nu = pp['alpha'], pp['rho'], pp['nu']
+				vols = sf._smile()
+			else:
+				vols = sqrt(maximum(svi_var(svi, xx), 0.0) / pp['t'])
+			smiles.append((month, pp['fwd'], pp['t'], zip(strikes, vols)))
+
+		return cls(smiles, normal)
+
+	def moneyness(self, strike, fwd):
+		return strike - fwd if self.normal else log(strike / fwd)
+
+	def __call__(self, strike, t):
+		"""Vols for arrays (or scalars) of strikes and times to expiry, broadcast together.
+		t = 0 gives the first expiry's vol, the limit of the flat vol before it."""
+		strike, t = broadcast_arrays(asarray(strike, dtype=float), asarray(t, dtype=float))
+		shape = strike.shape
+		strike, t = strike.ravel(), t.ravel()
+
+		nn = len(self.t)
+		if not nn:
+			raise ValueError('empty vol surface, no expiries with a forward and quoted vols')
+		if (t < 0.0).any():
+			raise ValueError('negative time to expiry')
+		jj = searchsorted(self.t, t)
+		lo, hi = clip(jj - 1, 0, nn - 1), clip(jj, 0, nn - 1)
+		wlo, whi = self._total_var(lo, strike), self._total_var(hi, strike)
+
+		frac = where(hi > lo, (t - self.t[lo]) / where(hi > lo, self.t[hi] - self.t[lo], 1.0), 0.0)
+		w = wlo + frac * (whi - wlo)
+		# variance rate, flat before the first and after the last expiry
+		var = where(t < self.t[0], wlo / self.t[0], w / where(t > 0.0, t, 1.0))
+		var = where(t > self.t[-1], whi / self.t[-1], var)
+
+		return sqrt(maximum(var, 0.0)).reshape(shape)
+
+	def smile(self, month, strike):
+		"""Vols for an array of strikes on a single expiry"""
+		ii = self.months.index(month)
+		strike = asarray(strike, dtype=float)
+		return sqrt(interp(self.moneyness(strike, self.fwd[ii]), self._k[ii], self._w[ii]) / self.t[ii])
+
+	def _total_var(self, expiry, strike):
+		"""Total variance of each strike on the expiry with the matching index. Loops over
+		the (few) expiries, never over the strikes"""
+		out = empty(len(strike))
+		for ee in unique(expiry):
+			mm = expiry == ee
+			out[mm] = interp(self.moneyness(strike[mm], self.fwd[ee]), self._k[ee], self._w[ee])
+		return out
+
+
+def surface(mrmkt, product, timestamp=None, live=False):
+	"""VolSurface of one snapshot (the latest by default) of the settle or live data loaded
+	into a MrMarket. Surfaces are kept in an LRU cache keyed by (product, timestamp), since
+	a stored snapshot never changes."""
+	fopt, ffut = (mrmkt.opt_live, mrmkt.fut_live) if live else (mrmkt.opt_settle, mrmkt.fut_settle)
+	if timestamp is None:
+		timestamp = fopt.index.get_level_values('timestamp').max()
+
+	key = (product, live, timestamp)
+	if key in _cache:
+		_cache[key] = _cache.pop(key)
+		return _cache[key]
+
+	vs = VolSurface.from_snapshot(product, fopt, ffut, timestamp)
+	_cache[key] = vs
+	while len(_cache) > CACHE_SIZE:
+		_cache.popitem(last=False)
+	return vs
@@ -0,0 +1,84 @@
+
+
+import os, sys, unittest
+from datetime import datetime
+from collections import namedtuple
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mrmarket'))
+import arbitrage
+
+# a quarterly product with midcurves, so the test needs no xspec file or exchange calendar
+Spec = namedtuple('Spec', 'model computus undlMonths')
+
+
+class Calendar(object):
+	def opt_expiry(self, mm, yy):
+		return datetime(yy, mm, 15, 16)
+		
+	def mc_expiry(self, mm, yy):
+		return datetime(yy, mm, 10, 16)
+		
+		
+class Specs(object):
+	def spec(self, product):
+		return Spec('lognormal', 'test', 'HMUZ')
+		
+		
+class Computus(object):
+	def make(self, computus):
+		return Calendar()
+
+
+def history(months, vol=0.2, days=2):
+	"""Flat vol snapshots of (month, underlying, forward)s, indexed like MrMarket.opt_settle"""
+	opts, futs = [], []
+	for dd in range(days):
+		ts = datetime(2013, 6, 3 + dd, 16)
+		for month, undl, fwd in months:
+			opts += [(ts, month, kk, vol) for kk in range(90, 111, 5)]
+		futs += [(undl, ts, fwd) for undl, fwd in set((uu, ff) for mm, uu, ff in months)]
+	fopt = pd.DataFrame(opts, columns=['timestamp', 'month', 'strike', 'SETTLE_VOL'])
+	ffut = pd.DataFrame(futs, columns=['mon', 'timestamp', 'PX_SETTLE'])
+	return fopt.set_index(['timestamp', 'month', 'strike']), ffut.set_index(['mon', 'timestamp'])
+
+
+class ScanTest(unittest.TestCase):
+	
+	def setUp(self):
+		self.saved = arbitrage.XSpec, arbitrage.Computus
+		arbitrage.XSpec, arbitrage.Computus = Specs, Computus
+		
+	def tearDown(self):
+		arbitrage.XSpec, arbitrage.Computus = self.saved
+		
+	def test_midcurve_groups(self):
+		# the midcurve sits between the standard months, so their group numbers run past the 
+		# number of standard groups
+		fopt, ffut = history([('U3', 'U3', 100.0), ('2EU3', 'U5', 100.0), ('Z3', 'Z3', 100.0)])
+		flags = arbitrage.scan('TEST', fopt, ffut)
+		self.assertEqual(len(flags), len(fopt))
+		self.assertTrue((flags == 0).all())
+		
+	def test_calendar_with_midcurves(self):
+		fopt, ffut = history([('U3', 'U3', 100.0), ('2EU3', 'U5', 100.0), ('Z3', 'Z3', 100.0)])
+		bad = (fopt.index.get_level_values('month') == 'Z3') & (fopt.index.get_level_values('strike') == 100)
+		fopt.loc[bad, 'SETTLE_VOL'] = 0.1
+		flags = arbitrage.scan('TEST', fopt, ffut)
+		self.assertTrue((flags[bad] & arbitrage.CALENDAR).all())
+		self.assertFalse((flags[fopt.index.get_level_values('month') == '2EU3'] & arbitrage.CALENDAR).any())
+		
+	def test_calendar_below_first_expiry(self):
+		# U3, the first group, has nothing quoted below 95, so the low Z3 90 vol has nothing to 
+		# be compared with (rather than U3's 95 vol extrapolated flat)
+		fopt, ffut = history([('U3', 'U3', 100.0), ('Z3', 'Z3', 100.0)], days=1)
+		month, strike = fopt.index.get_level_values('month'), fopt.index.get_level_values('strike')
+		fopt = fopt[~((month == 'U3') & (strike < 95))].copy()
+		low = (fopt.index.get_level_values('month') == 'Z3') & (fopt.index.get_level_values('strike') == 90)
+		fopt.loc[low, 'SETTLE_VOL'] = 0.14
+		flags = arbitrage.scan('TEST', fopt, ffut)
+		self.assertFalse((flags & arbitrage.CALENDAR).any())
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,120 @@
+
+
+import os, sys, shutil, sqlite3, tempfile, unittest
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mrmarket'))
+from backends import Backend, CachingBackend
+
+
+class Counting(Backend):
+	"""Historical single date data from a dict of security: {field: value}, counting the
+	requests and securities asked for. Securities not in it have no data."""
+	def __init__(self, data):
+		self.data = data
+		self.requests = []
+		
+	def fetch(self, securities, fields, d0=None, d1=None, interval=0, periodicity=None):
+		self.requests.append(list(securities))
+		bdata = {}
+		for sec in securities:
+			values = [(ff, self.data[sec][ff]) for ff in fields if ff in self.data.get(sec, {})]
+			bdata[sec] = [[('date', d0)] + values] if values and d0 else values
+		return bdata
+
+
+class CachingTest(unittest.TestCase):
+	
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.fname = os.path.join(self.dir, 'cache.sql')
+		self.backend = Counting({'A Comdty': {'PX_SETTLE': 99.0, 'OPEN_INT': 10.0}, \
+			'B Comdty': {'PX_SETTLE': 98.0}})
+		self.cache = CachingBackend(self.fname, self.backend, settled=5)
+		today = datetime.combine(datetime.now().date(), datetime.min.time())
+		self.old = today - timedelta(days=30)
+		self.recent = today - timedelta(days=2)
+		
+	def tearDown(self):
+		self.cache.conn.close()
+		shutil.rmtree(self.dir)
+		
+	def fetch(self, securities, fields=('PX_SETTLE',), day=None, cache=None):
+		day = self.old if day is None else day
+		return (cache or self.cache).fetch(list(securities), list(fields), day, day)
+		
+	def test_hits_and_misses(self):
+		first = self.fetch(['A Comdty', 'B Comdty'])
+		self.assertEqual(first['A Comdty'], [[('date', self.old), ('PX_SETTLE', 99.0)]])
+		self.assertEqual((self.cache.hits, self.cache.misses), (0, 2))
+		self.assertEqual(self.fetch(['A Comdty', 'B Comdty']), first)
+		self.assertEqual((self.cache.hits, self.cache.misses), (2, 2))
+		self.assertEqual(len(self.backend.requests), 1)
+		# only what isn't cached is asked for
+		self.fetch(['A Comdty', 'B Comdty', 'C Comdty'])
+		self.assertEqual(self.backend.requests[-1], ['C Comdty'])
+		self.assertEqual((self.cache.hits, self.cache.misses), (4, 3))
+		self.fetch(['A Comdty'], ['PX_SETTLE', 'OPEN_INT'])
+		self.assertEqual(self.backend.requests[-1], ['A Comdty'])
+		self.assertEqual(self.fetch(['A Comdty'], ['OPEN_INT', 'PX_SETTLE'])['A Comdty'], \
+			[[('date', self.old), ('OPEN_INT', 10.0), ('PX_SETTLE', 99.0)]])
+		self.assertEqual(len(self.backend.requests), 3)
+		
+	def test_kept_in_file(self):
+		self.fetch(['A Comdty', 'B Comdty'])
+		cache = CachingBackend(self.fname, self.backend)
+		self.fetch(['A Comdty', 'B Comdty'], cache=cache)
+		self.assertEqual((cache.hits, cache.misses), (2, 0))
+		self.assertEqual(len(self.backend.requests), 1)
+		cache.conn.close()
+		
+	def test_settled_missing(self):
+		# no data 30 days on is believed, but not 2 days on, when it may not be published yet
+		self.assertEqual(self.fetch(['C Comdty'])['C Comdty'], [])
+		self.assertEqual(self.fetch(['C Comdty'])['C Comdty'], [])
+		self.assertEqual(self.fetch(['B Comdty'], ['PX_SETTLE', 'OPEN_INT'])['B Comdty'], \
+			[[('date', self.old), ('PX_SETTLE', 98.0)]])
+		self.fetch(['B Comdty'], ['PX_SETTLE', 'OPEN_INT'])
+		self.assertEqual(len(self.backend.requests), 2)
+		
+		self.assertEqual(self.fetch(['C Comdty'], day=self.recent)['C Comdty'], [])
+		self.fetch(['B Comdty'], ['PX_SETTLE', 'OPEN_INT'], day=self.recent)
+		self.assertEqual(len(self.backend.requests), 4)
+		self.backend.data['C Comdty'] = {'PX_SETTLE': 97.0}
+		self.assertEqual(self.fetch(['C Comdty', 'B Comdty'], day=self.recent)['C Comdty'], \
+			[[('date', self.recent), ('PX_SETTLE', 97.0)]])
+		self.assertEqual(self.backend.requests[-1], ['C Comdty'])
+		# values that did come back are kept however recent
+		self.fetch(['C Comdty', 'B Comdty'], day=self.recent)
+		self.assertEqual(len(self.backend.requests), 5)
+		
+	def test_unfetched_missing_of_old_files(self):
+		conn = sqlite3.connect(self.fname)
+		conn.execute('DROP TABLE history')
+		conn.execute('CREATE TABLE history (ticker TEXT, field TEXT, date TEXT, value, ' \
+			'PRIMARY KEY (ticker, field, date))')
+		conn.execute('INSERT INTO history VALUES (?, ?, ?, ?)', ('C Comdty', 'PX_SETTLE', \
+			self.old.strftime('%Y-%m-%d'), None))
+		conn.execute('INSERT INTO history VALUES (?, ?, ?, ?)', ('A Comdty', 'PX_SETTLE', \
+			self.old.strftime('%Y-%m-%d'), 99.0))
+		conn.commit()
+		conn.close()
+		cache = CachingBackend(self.fname, self.backend)
+		self.fetch(['A Comdty', 'C Comdty'], cache=cache)
+		self.assertEqual(self.backend.requests, [['C Comdty']])
+		cache.conn.close()
+		
+	def test_passed_through(self):
+		# realtime, date ranges, today, intraday and weekly requests aren't cached
+		today = datetime.now()
+		for args in ((), (self.old, self.old + timedelta(days=1)), (today, today), \
+				(self.old, self.old, 60), (self.old, self.old, 0, 'WEEKLY')):
+			for ii in range(2):
+				self.cache.fetch(['A Comdty'], ['PX_SETTLE'], *args)
+		self.assertEqual(len(self.backend.requests), 10)
+		self.assertEqual((self.cache.hits, self.cache.misses), (0, 0))
+		self.assertEqual(self.cache.conn.execute('SELECT COUNT(*) FROM history').fetchone()[0], 0)
+
+
+if __name__ == '__main__':
+	unittest.main()
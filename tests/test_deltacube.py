@@ -0,0 +1,69 @@
+
+
+import os, sys, unittest
+from datetime import datetime
+from collections import namedtuple
+import pandas as pd
+from numpy import isnan
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mrmarket'))
+import deltacube
+
+Spec = namedtuple('Spec', 'model computus undlMonths')
+
+
+class Calendar(object):
+	def opt_expiry(self, mm, yy):
+		return datetime(yy, mm, 15, 16)
+	
+	def mc_expiry(self, mm, yy):
+		return datetime(yy, mm, 10, 16)
+
+
+class Specs(object):
+	def spec(self, product):
+		return Spec('lognormal', 'test', 'HMUZ')
+
+
+class Computus(object):
+	def make(self, computus):
+		return Calendar()
+
+
+def smiles(days, vol=0.2):
+	"""The same flat U3 smile, strikes 90 to 110 on a forward of 100, on each of 'days' days"""
+	opts = [(datetime(2013, 6, 3 + dd, 16), 'U3', kk, vol) for dd in range(days) \
+		for kk in range(90, 111, 5)]
+	futs = [('U3', datetime(2013, 6, 3 + dd, 16), 100.0) for dd in range(days)]
+	fopt = pd.DataFrame(opts, columns=['timestamp', 'month', 'strike', 'SETTLE_VOL'])
+	ffut = pd.DataFrame(futs, columns=['mon', 'timestamp', 'PX_SETTLE'])
+	return fopt.set_index(['timestamp', 'month', 'strike']), ffut.set_index(['mon', 'timestamp'])
+
+
+class CubeTest(unittest.TestCase):
+
+	def setUp(self):
+		self.saved = deltacube.XSpec, deltacube.Computus
+		deltacube.XSpec, deltacube.Computus = Specs, Computus
+	
+	def tearDown(self):
+		deltacube.XSpec, deltacube.Computus = self.saved
+	
+	def test_wings_not_extrapolated(self):
+		# the quoted strikes run from about 0.2 to 0.85 call delta, so the 5 and 10 deltas of
+		# either side are outside them, for the first and last smile as for those between
+		vc = deltacube.cube('TEST', *smiles(3))
+		self.assertEqual(len(vc), 3)
+		for col in ('C05', 'C10', 'P10', 'P05'):
+			self.assertTrue(isnan(vc[col].values).all(), col)
+		for col in ('C25', 'C40', 'ATM', 'P40', 'P25'):
+			self.assertTrue((abs(vc[col].values - 0.2) < 1e-12).all(), col)
+	
+	def test_single_smile(self):
+		vc = deltacube.cube('TEST', *smiles(1))
+		self.assertTrue(isnan(vc[['C05', 'C10', 'P10', 'P05']].values).all())
+		self.assertAlmostEqual(vc['ATM'].values[0], 0.2)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,45 @@
+
+
+import os, sys, unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mrmarket'))
+from metrics import Profile
+
+
+class EventTest(unittest.TestCase):
+	
+	def setUp(self):
+		self.profile = Profile(every=60.0)
+		self.saved = sys.stdout
+		sys.stdout = self.out = StringIO()
+	
+	def tearDown(self):
+		sys.stdout = self.saved
+	
+	def printed(self):
+		return self.out.getvalue().splitlines()
+	
+	def test_diagnostics_held_back(self):
+		for ii in range(3):
+			self.profile.event('vol_failed', 'failed %d' % ii, strike=ii)
+		self.profile.event('bad_ticker', 'XX')
+		self.assertEqual(self.printed(), ['failed 0', 'XX'])
+		# all kept though
+		self.assertEqual([ee['fields'] for ee in self.profile.events][:3], [{'strike': ii} for ii in range(3)])
+		self.profile.printed['vol_failed'] -= 60.0
+		self.profile.event('vol_failed', 'failed 3')
+		self.assertEqual(self.printed()[-1], 'failed 3 (2 more vol_failed held back)')
+	
+	def test_progress_every_call(self):
+		for ii in range(3):
+			self.profile.event('settle', 'Saving settle data for %d' % ii, every=0, date=ii)
+		self.assertEqual(self.printed(), ['Saving settle data for %d' % ii for ii in range(3)])
+		self.assertEqual(self.profile.events[-1]['fields'], {'date': 2})
+		# and the name's own limit still applies to calls without it
+		self.profile.event('settle', 'held')
+		self.assertEqual(len(self.printed()), 3)
+
+
+if __name__ == '__main__':
+	unittest.main()
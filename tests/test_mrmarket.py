@@ -0,0 +1,174 @@
+
+
+import os, sys, shutil, sqlite3, tempfile, unittest
+from datetime import datetime, timedelta
+from collections import namedtuple
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mrmarket'))
+import fograbber
+from mrmarket import MrMarket
+from snapstore import SnapWriter
+
+# a quarterly normal model product with midcurves, so the tests need no xspec file or 
+# exchange calendar
+Spec = namedtuple('Spec', 'model computus undlMonths suffix')
+
+
+class Specs(object):
+	def __init__(self, specfile=None):
+		pass
+		
+	def spec(self, product):
+		return Spec('normal', 'test', 'HMUZ', 'Comdty')
+		
+		
+class Calendar(object):
+	holidays = []
+	
+	def opt_expiry(self, mm, yy):
+		return datetime(yy, mm, 15, 16)
+		
+		
+class Computus(object):
+	def make(self, computus):
+		return Calendar()
+
+
+def store(fname, opts, futs):
+	writer = SnapWriter(fname)
+	with writer.snapshot():
+		writer.append('options', pd.DataFrame(opts, columns=['timestamp', 'month', 'strike', \
+			'SETTLE_VOL']))
+		writer.append('futures', pd.DataFrame(futs, columns=['timestamp', 'mon', 'PX_SETTLE']))
+	writer.close()
+
+
+class LoadTest(unittest.TestCase):
+
+	def setUp(self):
+		self.datadir = tempfile.mkdtemp() + os.sep
+		for ss in ('settle', 'live'):
+			os.mkdir(self.datadir + ss)
+		# Z3 options are on Z3 futures at 99, the 2EZ3 midcurve's on Z5 futures at 98
+		ts = datetime(2013, 6, 3, 16)
+		opts = [(ts, 'Z3', kk, 0.2) for kk in (98.0, 99.0, 100.0)] + \
+			[(ts, '2EZ3', kk, 0.3) for kk in (97.0, 98.0, 99.0)]
+		futs = [(ts, 'Z3', 99.0), (ts, 'Z5', 98.0), (ts, 'H4', 98.5)]
+		store(self.datadir + 'settle/test.sql', opts, futs)
+		
+		self.saved = fograbber.XSpec, fograbber.Computus
+		fograbber.XSpec, fograbber.Computus = Specs, Computus
+		self.mm = MrMarket(self.datadir, pb=object())
+		
+	def tearDown(self):
+		fograbber.XSpec, fograbber.Computus = self.saved
+		shutil.rmtree(self.datadir)
+	
+	def test_midcurve_months(self):
+		self.mm.load('TEST', months=['2EZ3'])
+		self.assertEqual(set(self.mm.opt_settle.index.get_level_values('month')), set(['2EZ3']))
+		self.assertEqual(list(self.mm.fut_settle.index.get_level_values('mon')), ['Z5'])
+		self.assertIsNone(self.mm.opt_live)
+	
+	def test_midcurve_moneyness(self):
+		# the 2EZ3 strikes are measured from Z5 at 98, not Z3 at 99
+		self.mm.load('TEST', months=['Z3', '2EZ3'], moneyness=(-0.5, 0.5))
+		strikes = dict((mm, kk) for ts, mm, kk in self.mm.opt_settle.index)
+		self.assertEqual(strikes, {'Z3': 99.0, '2EZ3': 98.0})
+		self.assertEqual(sorted(self.mm.fut_settle.index.get_level_values('mon')), ['Z3', 'Z5'])
+	
+	def test_moneyness_all_months(self):
+		# 2EZ3 sorts before Z3
+		self.mm.load('TEST', moneyness=(0.5, None))
+		self.assertEqual(list(self.mm.opt_settle.index.get_level_values('strike')), [99.0, 100.0])
+		
+	def test_no_snapshots(self):
+		# files with no tables yet, as for a product that's never been snapped
+		for kwargs in ({}, {'months': ['Z3']}, {'moneyness': (-0.5, 0.5)}):
+			self.mm.load('NEW', **kwargs)
+			self.assertIsNone(self.mm.opt_settle)
+			self.assertIsNone(self.mm.fut_settle)
+			self.assertIsNone(self.mm.opt_live)
+		
+	def test_nothing_new_in_fresh_live_file(self):
+		self.assertIsNone(self.mm.update_cube('TEST', 'live'))
+		self.assertIsNone(self.mm.calibrate('TEST', 'live'))
+
+
+def snapshot(ts, months, fwd=99.0):
+	"""Options and futures of one snap of (option month, futures month)s"""
+	opts = [(ts, mm, kk, 0.2) for mm, mon in months for kk in (98.0, 99.0, 100.0)]
+	futs = [(ts, mon, fwd) for mon in sorted(set(mon for mm, mon in months))]
+	return opts, futs
+	
+	
+class LoadRecentTest(unittest.TestCase):
+	
+	def setUp(self):
+		self.datadir = tempfile.mkdtemp() + os.sep
+		for ss in ('settle', 'live'):
+			os.mkdir(self.datadir + ss)
+		self.saved = fograbber.XSpec, fograbber.Computus
+		fograbber.XSpec, fograbber.Computus = Specs, Computus
+		self.mm = MrMarket(self.datadir, pb=object())
+		
+		self.today = datetime.combine(datetime.now().date(), datetime.min.time())
+		# before the window, then the day before today
+		self.snap('settle', self.today - timedelta(days=30), [('Z3', 'Z3')])
+		for source in ('settle', 'live'):
+			self.snap(source, self.today - timedelta(days=1, hours=-12), [('Z3', 'Z3'), ('H4', 'H4')])
+			
+	def tearDown(self):
+		fograbber.XSpec, fograbber.Computus = self.saved
+		shutil.rmtree(self.datadir)
+		
+	def snap(self, source, ts, months, fwd=99.0):
+		store(self.datadir + source + '/test.sql', *snapshot(ts, months, fwd))
+		
+	def check(self):
+		"""load_recent of the last 4 days (which starts no later than 6 days back) gives the 
+		same frames as a fresh load from 10 days back"""
+		self.mm.load_recent('TEST', days=4)
+		fresh = MrMarket(self.datadir, pb=object())
+		fresh.load('TEST', start=self.today - timedelta(days=10))
+		for name in ('opt_settle', 'fut_settle', 'opt_live', 'fut_live'):
+			got, want = getattr(self.mm, name), getattr(fresh, name)
+			self.assertEqual(list(got.index), list(want.index), name)
+			self.assertTrue(got.equals(want), name)
+			
+	def test_appended_snapshots(self):
+		self.check()
+		# a new futures month, which sorts between the ones already kept
+		self.snap('live', self.today + timedelta(hours=9), [('Z3', 'Z3'), ('2EZ3', 'Z5'), ('H4', 'H4')])
+		self.check()
+		self.snap('settle', self.today + timedelta(hours=16), [('Z3', 'Z3'), ('M4', 'M4')], 99.5)
+		self.snap('live', self.today + timedelta(hours=10), [('Z3', 'Z3'), ('U3', 'U3')], 99.5)
+		self.check()
+		self.check()
+		
+	def test_rewritten_rows(self):
+		self.check()
+		conn = sqlite3.connect(self.datadir + 'live/test.sql')
+		conn.execute('DELETE FROM options WHERE month = "H4"')
+		conn.commit()
+		conn.close()
+		self.check()
+		
+	def test_replaced_file(self):
+		self.check()
+		# a new file put in place of the old one, with the same number of rows
+		fname = self.datadir + 'live/new.sql'
+		store(fname, *snapshot(self.today - timedelta(days=1, hours=-12), [('Z3', 'Z3'), ('H4', 'H4')], 98.0))
+		os.rename(fname, self.datadir + 'live/test.sql')
+		self.check()
+		
+	def test_copies(self):
+		self.check()
+		self.mm.opt_live['SETTLE_VOL'] = 0.0
+		self.mm.fut_settle['PX_SETTLE'] = 0.0
+		self.check()
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,189 @@
+
+
+import os, sys, time, threading, unittest
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mrmarket'))
+import metrics
+from backends import Backend, BackendError
+from metrics import Metrics, tagged
+import pandaburger
+from pandaburger import PandaBurger
+
+
+class Flaky(Backend):
+	"""Realtime BIDs of 1.0, or intraday ticks, except that a request whose first security
+	is in 'fail' raises, or in 'stall' sleeps for 'stall_for' seconds, the given number of
+	times before it answers"""
+	def __init__(self, fail=None, stall=None, stall_for=0.5):
+		self.fail = dict(fail or {})
+		self.stall = dict(stall or {})
+		self.stall_for = stall_for
+		self.requests = []
+		self.lock = threading.Lock()
+		
+	def fetch(self, securities, fields, d0=None, d1=None, interval=0, periodicity=None):
+		key = securities[0]
+		with self.lock:
+			self.requests.append(list(securities))
+			failing = self.fail.get(key, 0) > 0
+			stalling = not failing and self.stall.get(key, 0) > 0
+			if failing:
+				self.fail[key] -= 1
+			if stalling:
+				self.stall[key] -= 1
+		if failing:
+			raise BackendError('no reply for %s' % key)
+		if stalling:
+			time.sleep(self.stall_for)
+		if interval:
+			return dict((ss, [[('time', d0), (fields[0], 1.0)]]) for ss in securities)
+		return dict((ss, [('BID', 1.0)]) for ss in securities)
+
+
+def tickers(n):
+	return ['T%d Comdty' % ii for ii in range(n)]
+
+
+class PipelineTest(unittest.TestCase):
+	
+	def setUp(self):
+		self.metrics = Metrics()
+		
+	def burger(self, **kwargs):
+		self.backend = Flaky(**kwargs)
+		return PandaBurger(self.backend, metrics=self.metrics)
+		
+	def requests(self, keys):
+		return [(kk, ([kk], ['BID'])) for kk in keys]
+		
+	def test_all_succeed(self):
+		pb = self.burger()
+		with tagged('test'):
+			res = pb.pipeline(self.requests('abcd'), workers=2, op='realtime')
+		self.assertEqual(sorted(res), list('abcd'))
+		self.assertEqual(res['c'], {'c': [('BID', 1.0)]})
+		self.assertEqual(sorted((kk, nn) for kk, ss, nn in pb.timings), [(kk, 1) for kk in 'abcd'])
+		calls = self.metrics.frame()
+		self.assertEqual(len(calls), 4)
+		self.assertEqual(set(calls['op']), set(['realtime']))
+		# tagged on the calling thread, not the workers
+		self.assertEqual(set(calls['tag']), set(['test']))
+		self.assertEqual(list(calls['rows']), [1] * 4)
+		self.assertEqual(list(calls['retries']), [0] * 4)
+		
+	def test_retries(self):
+		pb = self.burger(fail={'b': 2})
+		res = pb.pipeline(self.requests('abc'), retries=2)
+		self.assertEqual(sorted(res), list('abc'))
+		self.assertEqual(dict((kk, nn) for kk, ss, nn in pb.timings), {'a': 1, 'b': 3, 'c': 1})
+		self.assertEqual(len([rr for rr in self.backend.requests if rr == ['b']]), 3)
+		calls = self.metrics.frame()
+		bcall = calls[calls['retries'] > 0]
+		self.assertEqual(len(bcall), 1)
+		self.assertEqual((bcall['retries'].values[0], bcall['errors'].values[0]), (2, 2))
+		self.assertEqual(bcall['rows'].values[0], 1)
+		
+	def test_give_up(self):
+		pb = self.burger(fail={'b': 3})
+		metrics.PROFILE.clear()
+		res = pb.pipeline(self.requests('abc'), retries=2)
+		self.assertEqual(sorted(res), ['a', 'c'])
+		self.assertEqual(sorted(kk for kk, ss, nn in pb.timings), ['a', 'c'])
+		# one call for the given up request too, with the last error
+		calls = self.metrics.frame()
+		self.assertEqual(len(calls), 3)
+		failed = calls[calls['errors'] > 0]
+		self.assertEqual((failed['rows'].values[0], failed['retries'].values[0], failed['errors'].values[0]), (0, 2, 3))
+		self.assertEqual(failed['error'].values[0], 'no reply for b')
+		gave_up = [ee for ee in metrics.PROFILE.events if ee['name'] == 'gave_up']
+		self.assertEqual(len(gave_up), 1)
+		self.assertEqual(gave_up[0]['fields']['attempts'], 3)
+		
+	def test_no_retries(self):
+		pb = self.burger(fail={'a': 1})
+		self.assertEqual(pb.pipeline(self.requests('ab'), retries=0).keys(), ['b'])
+		self.assertEqual(len(self.backend.requests), 2)
+		
+	def test_timeout(self):
+		# the stalled request is resent, and its second attempt answers first
+		pb = self.burger(stall={'b': 1}, stall_for=1.0)
+		t0 = time.time()
+		res = pb.pipeline(self.requests('abc'), timeout=0.2, retries=1)
+		self.assertEqual(sorted(res), list('abc'))
+		self.assertEqual(dict((kk, nn) for kk, ss, nn in pb.timings)['b'], 2)
+		calls = self.metrics.frame()
+		bcall = calls[calls['errors'] > 0]
+		self.assertEqual((bcall['retries'].values[0], bcall['errors'].values[0]), (1, 1))
+		# from the first attempt's start
+		self.assertTrue(bcall['seconds'].values[0] >= 0.2)
+		
+	def test_timeout_give_up(self):
+		pb = self.burger(stall={'b': 2}, stall_for=0.5)
+		res = pb.pipeline(self.requests('abc'), timeout=0.1, retries=1)
+		self.assertEqual(sorted(res), ['a', 'c'])
+		failed = self.metrics.frame()
+		failed = failed[failed['errors'] > 0]
+		self.assertEqual(failed['error'].values[0], 'timed out after 0.1s')
+		
+	def test_intraday(self):
+		# fetch sends intraday requests one security each through the pipeline
+		pb = self.burger(fail={'T1 Comdty': 1})
+		d0, d1 = datetime(2013, 6, 3, 9), datetime(2013, 6, 3, 16)
+		panel = pb.fetch(tickers(3), ['TRADE'], d0, d1, interval=60, workers=3)
+		self.assertEqual(sorted(panel.items), tickers(3))
+		self.assertEqual(sorted(map(len, self.backend.requests)), [1] * 4)
+		calls = self.metrics.frame()
+		self.assertEqual(set(calls['op']), set(['intraday']))
+		self.assertEqual(sum(calls['rows']), 3)
+
+
+class DumpTest(unittest.TestCase):
+	
+	def test_plan(self):
+		sizes = lambda n, **kw: [len(cc) for cc in PandaBurger.plan(tickers(n), **kw)]
+		# spread evenly over the workers, but not below MIN_CHUNK or above MAX_CHUNK
+		self.assertEqual(sizes(40), [40])
+		self.assertEqual(sizes(120), [50, 50, 20])
+		self.assertEqual(sizes(1000), [125] * 8)
+		self.assertEqual(sizes(1001), [126] * 7 + [119])
+		self.assertEqual(sizes(1000, workers=4), [250] * 4)
+		self.assertEqual(sizes(5000), [500] * 10)
+		self.assertEqual(sizes(12, chunk=5), [5, 5, 2])
+		self.assertEqual(sizes(0), [])
+		secs = tickers(1001)
+		self.assertEqual(sum(PandaBurger.plan(secs), []), secs)
+		
+	def test_bounds(self):
+		saved = pandaburger.MIN_CHUNK, pandaburger.MAX_CHUNK
+		pandaburger.MIN_CHUNK, pandaburger.MAX_CHUNK = 2, 3
+		try:
+			self.assertEqual([len(cc) for cc in PandaBurger.plan(tickers(7), workers=8)], [2, 2, 2, 1])
+			self.assertEqual([len(cc) for cc in PandaBurger.plan(tickers(7), workers=1)], [3, 3, 1])
+		finally:
+			pandaburger.MIN_CHUNK, pandaburger.MAX_CHUNK = saved
+		
+	def test_dump(self):
+		secs = tickers(230)
+		backend = Flaky(fail={secs[100]: 3})
+		mm = Metrics()
+		pb = PandaBurger(backend, metrics=mm)
+		bdata = pb.dump(secs, ['BID'], chunk=50, retries=2)
+		# the chunk given up on still has (empty) entries
+		self.assertEqual(sorted(bdata), sorted(secs))
+		self.assertEqual([ss for ss in secs if not bdata[ss]], secs[100:150])
+		self.assertEqual(bdata[secs[0]], [('BID', 1.0)])
+		self.assertEqual(sorted(len(rr) for rr in backend.requests), [30] + [50] * 6)
+		self.assertEqual(sorted((kk, nn) for kk, ss, nn in pb.timings), [(0, 1), (1, 1), (3, 1), (4, 1)])
+		calls = mm.frame()
+		self.assertEqual(sorted(calls['securities']), [30] + [50] * 4)
+		self.assertEqual(sum(calls['rows']), 180)
+		
+	def test_history(self):
+		pb = PandaBurger(Flaky(), metrics=Metrics())
+		pb.dump(tickers(120), ['PX_SETTLE'], datetime(2013, 6, 3))
+		self.assertEqual(set(pb.metrics.frame()['op']), set(['history']))
+
+
+if __name__ == '__main__':
+	unittest.main()
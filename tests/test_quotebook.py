@@ -0,0 +1,57 @@
+
+
+import os, sys, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mrmarket'))
+from backends import Backend
+from quotebook import QuoteBookBackend
+from pandaburger import PandaBurger
+
+
+class Quotes(Backend):
+	"""Realtime quotes from a dict, with no subscribe, so the book polls (slowly here)"""
+	def __init__(self, bid):
+		self.bid = bid
+	
+	def fetch(self, securities, fields, d0=None, d1=None, interval=0, periodicity=None):
+		return dict((ss, [('BID', self.bid)]) for ss in securities)
+
+
+class FrozenTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tickers = ['T%d Comdty' % ii for ii in range(40)]
+		self.backend = QuoteBookBackend(Quotes(1.0), poll=3600)
+		self.pb = PandaBurger(self.backend)
+		self.pb.dump(self.tickers, ['BID'])
+	
+	def tearDown(self):
+		self.backend.stop()
+	
+	def bids(self):
+		# several chunks, read on the pipeline's worker threads
+		bdata = self.pb.dump(self.tickers, ['BID'], chunk=5, workers=4)
+		return set(dict(bdata[tt])['BID'] for tt in self.tickers)
+	
+	def tick(self, bid):
+		self.backend.book.update([(tt, [('BID', bid)]) for tt in self.tickers])
+	
+	def test_workers_read_frozen_view(self):
+		with self.backend.book.frozen():
+			self.tick(2.0)
+			self.assertEqual(self.bids(), set([1.0]))
+		self.assertEqual(self.bids(), set([2.0]))
+	
+	def test_overlapping_blocks_share_view(self):
+		book = self.backend.book
+		with book.frozen():
+			self.tick(2.0)
+			with book.frozen():
+				self.tick(3.0)
+				self.assertEqual(self.bids(), set([1.0]))
+			self.assertEqual(self.bids(), set([1.0]))
+		self.assertEqual(self.bids(), set([3.0]))
+
+
+if __name__ == '__main__':
+	unittest.main()
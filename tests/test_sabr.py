@@ -0,0 +1,162 @@
+
+
+import os, sys, unittest
+from datetime import datetime
+from collections import namedtuple
+import pandas as pd
+from numpy import array, linspace, zeros, isfinite, exp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mrmarket'))
+import sabr
+from sabr import SABR, SABR_Fitter
+
+
+def smile(fwd, t, alpha, beta, rho, nu, strikes):
+	"""(strike, vol) tuples of an exact Hagan smile"""
+	model = SABR(fwd, alpha, beta, rho, nu)
+	return [(kk, model(kk, t)) for kk in strikes]
+
+
+# (fwd, t, alpha, beta, rho, nu, strikes): a lognormal equity-like smile, a normal rates
+# smile in price terms and a steep one with rho near -1. Each has the ATM strike in it.
+CASES = [(100.0, 0.5, 0.25, 1.0, -0.3, 0.6, linspace(80.0, 120.0, 9)),
+	(98.5, 1.0, 0.6, 0.0, 0.2, 0.4, linspace(97.0, 100.0, 7)),
+	(100.0, 0.25, 0.2, 0.5, -0.95, 1.2, linspace(70.0, 130.0, 13))]
+
+
+Spec = namedtuple('Spec', 'model computus undlMonths')
+
+
+class Calendar(object):
+	def opt_expiry(self, mm, yy):
+		return datetime(yy, mm, 15, 16)
+	
+	def mc_expiry(self, mm, yy):
+		return datetime(yy, mm, 10, 16)
+
+
+class Specs(object):
+	def spec(self, product):
+		return Spec('lognormal', 'test', 'HMUZ')
+
+
+class Computus(object):
+	def make(self, computus):
+		return Calendar()
+
+
+class FitterTest(unittest.TestCase):
+	
+	def test_smile_matches_sabr(self):
+		for fwd, t, alpha, beta, rho, nu, strikes in CASES:
+			sf = SABR_Fitter(fwd, beta, t, smile(fwd, t, alpha, beta, rho, nu, strikes))
+			resid = sf.target([alpha, rho, nu])
+			self.assertTrue(abs(resid).max() < 1e-12, (fwd, beta))
+		
+	def test_jacobian(self):
+		# against central differences of target, at and away from the true parameters
+		for fwd, t, alpha, beta, rho, nu, strikes in CASES:
+			sf = SABR_Fitter(fwd, beta, t, smile(fwd, t, alpha, beta, rho, nu, strikes))
+			for xval in ([alpha, rho, nu], [alpha*1.2, rho*0.5, nu*2.0], [alpha, 0.0, 1e-8]):
+				jac = sf.jacobian(array(xval))
+				fd = zeros(jac.shape)
+				for jj in range(3):
+					hh = zeros(3)
+					hh[jj] = 1e-6 * max(abs(xval[jj]), 1e-2)
+					fd[:, jj] = (sf.target(array(xval) + hh) - sf.target(array(xval) - hh)) / (2*hh[jj])
+				self.assertEqual(jac.shape, (len(strikes), 3))
+				self.assertTrue(abs(jac - fd).max() < 1e-6 * max(1.0, abs(fd).max()), (fwd, beta, xval))
+		
+	def test_ujacobian(self):
+		fwd, t, alpha, beta, rho, nu, strikes = CASES[0]
+		sf = SABR_Fitter(fwd, beta, t, smile(fwd, t, alpha, beta, rho, nu, strikes))
+		uval = sf.to_unbounded([alpha, rho, nu])
+		jac = sf.ujacobian(uval)
+		for jj in range(3):
+			hh = zeros(3)
+			hh[jj] = 1e-6
+			fd = (sf.utarget(uval + hh) - sf.utarget(uval - hh)) / 2e-6
+			self.assertTrue(abs(jac[:, jj] - fd).max() < 1e-6)
+		
+	def test_no_overflow(self):
+		# far strikes give large |z|, and a large unbounded rho rounds to -1 in tanh
+		sf = SABR_Fitter(100.0, 1.0, 0.1, [(kk, 0.3) for kk in (1.0, 50.0, 100.0, 1000.0)])
+		resid = sf.utarget(array([0.0, -40.0, 1.0]))
+		self.assertTrue((resid + 0.3 > 0.0).all())
+		self.assertTrue(abs(resid - sf.target([1.0, -0.999999, exp(1.0)])).max() < 1e-12)
+		self.assertTrue(isfinite(sf.ujacobian(array([0.0, -40.0, 1.0]))).all())
+	
+	
+class FitTest(unittest.TestCase):
+	
+	def test_recover_parameters(self):
+		for fwd, t, alpha, beta, rho, nu, strikes in CASES:
+			pp = sabr._fit(fwd, t, beta, smile(fwd, t, alpha, beta, rho, nu, strikes))
+			self.assertTrue(pp.success, pp.message)
+			self.assertTrue(pp.residual < 1e-8, (fwd, beta, pp))
+			self.assertAlmostEqual(pp.alpha / alpha, 1.0, 5)
+			self.assertAlmostEqual(pp.rho, rho, 5)
+			self.assertAlmostEqual(pp.nu / nu, 1.0, 5)
+		
+	def test_warm_start(self):
+		fwd, t, alpha, beta, rho, nu, strikes = CASES[0]
+		strip = smile(fwd, t, alpha, beta, rho, nu, strikes)
+		cold = sabr._fit(fwd, t, beta, strip)
+		warm = sabr._fit(fwd, t, beta, strip, [alpha, rho, nu])
+		self.assertAlmostEqual(warm.rho, rho, 6)
+		self.assertTrue(warm.iterations <= cold.iterations)
+		
+	def test_fit_task_failures(self):
+		strip = smile(*CASES[0])
+		for fwd, t, strip, message in ((float('nan'), 0.5, strip, 'no forward'), \
+				(100.0, 0.0, strip, 'expired'), (100.0, 0.5, strip[:2], 'only 2 strikes')):
+			row = sabr._fit_task(('Z3', fwd, t, 1.0, strip, None))
+			self.assertEqual(row[0], 'Z3')
+			self.assertFalse(row[-2])
+			self.assertEqual(row[-1], message)
+
+
+class FitHistoryTest(unittest.TestCase):
+	
+	def setUp(self):
+		self.saved = sabr.XSpec, sabr.Computus
+		sabr.XSpec, sabr.Computus = Specs, Computus
+		# U3 and Z3 smiles on three days, with rho drifting from day to day
+		opts, futs = [], []
+		self.rho = {}
+		for dd in range(3):
+			ts = datetime(2013, 6, 3 + dd, 16)
+			for month, expiry in (('U3', datetime(2013, 9, 15, 16)), ('Z3', datetime(2013, 12, 15, 16))):
+				t = (expiry - ts).days / 365.0
+				self.rho[ts, month] = -0.5 + 0.1*dd
+				opts += [(ts, month, kk, vol) for kk, vol in smile(100.0, t, 0.25, 1.0, \
+					self.rho[ts, month], 0.6, linspace(80.0, 120.0, 9))]
+				futs.append((month, ts, 100.0))
+		# and a smile with too few strikes
+		opts += [(datetime(2013, 6, 5, 16), 'H4', kk, 0.2) for kk in (95.0, 100.0)]
+		futs.append(('H4', datetime(2013, 6, 5, 16), 100.0))
+		self.fopt = pd.DataFrame(opts, columns=['timestamp', 'month', 'strike', 'SETTLE_VOL']) \
+			.set_index(['timestamp', 'month', 'strike'])
+		self.ffut = pd.DataFrame(futs, columns=['mon', 'timestamp', 'PX_SETTLE']).set_index(['mon', 'timestamp'])
+	
+	def tearDown(self):
+		sabr.XSpec, sabr.Computus = self.saved
+	
+	def test_fit_history(self):
+		serial = sabr.fit_history('TEST', self.fopt, self.ffut, processes=1)
+		self.assertEqual(len(serial), 7)
+		for key, rho in self.rho.items():
+			self.assertTrue(serial['success'][key])
+			self.assertAlmostEqual(serial['rho'][key], rho, 5)
+			self.assertAlmostEqual(serial['alpha'][key], 0.25, 5)
+		failed = serial.loc[(datetime(2013, 6, 5, 16), 'H4')]
+		self.assertFalse(failed['success'])
+		self.assertEqual(failed['message'], 'only 2 strikes')
+		
+		pooled = sabr.fit_history('TEST', self.fopt, self.ffut, processes=2)
+		self.assertEqual(list(pooled.index), list(serial.index))
+		self.assertTrue(pooled.equals(serial))
+
+
+if __name__ == '__main__':
+	unittest.main()
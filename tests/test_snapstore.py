@@ -0,0 +1,155 @@
+
+
+import os, sys, shutil, sqlite3, tempfile, unittest
+from datetime import datetime
+import pandas as pd
+from pandas.io import sql
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mrmarket'))
+import snapstore
+from snapstore import SnapWriter
+
+
+def futures(ts, mons=('Z3', 'H4')):
+	return pd.DataFrame({'timestamp': [ts] * len(mons), 'mon': list(mons), \
+		'PX_SETTLE': [99.0 + ii for ii in range(len(mons))]})
+
+
+class MigrateTest(unittest.TestCase):
+	
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.fname = os.path.join(self.dir, 'legacy.sql')
+		# as pandas' write_frame left them, timestamps as text, but some written as integers
+		conn = sqlite3.connect(self.fname)
+		conn.execute('CREATE TABLE options (timestamp TIMESTAMP, month TEXT, strike REAL, SETTLE_VOL REAL)')
+		conn.executemany('INSERT INTO options VALUES (?, ?, ?, ?)', [('2013-06-03 16:00:00', 'Z3', \
+			99.0, 0.2), ('2013-06-03 16:00:00', 'Z3', 100.0, 0.25), (1370361600, 'Z3', 99.0, 0.21)])
+		conn.execute('CREATE TABLE futures (timestamp TIMESTAMP, mon TEXT, PX_SETTLE REAL)')
+		conn.execute('INSERT INTO futures VALUES ("2013-06-03 16:00:00", "Z3", 99.5)')
+		conn.commit()
+		conn.close()
+		
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+		
+	def test_migrate(self):
+		conn = snapstore.connect(self.fname)
+		info = dict((rr[1], rr[2:4]) for rr in conn.execute('PRAGMA table_info(options)'))
+		self.assertEqual(info['timestamp'], ('INTEGER', 1))
+		rows = conn.execute('SELECT timestamp, strike, SETTLE_VOL FROM options ORDER BY timestamp, strike').fetchall()
+		ts = snapstore.to_epoch(datetime(2013, 6, 3, 16))
+		self.assertEqual(rows, [(ts, 99.0, 0.2), (ts, 100.0, 0.25), (ts + 86400, 99.0, 0.21)])
+		self.assertEqual(conn.execute('SELECT timestamp FROM futures').fetchall(), [(ts,)])
+		indexes = [str(rr[1]) for rr in conn.execute('PRAGMA index_list(options)')]
+		self.assertTrue('options_timestamp_month_strike' in indexes)
+		# up to date now, so nothing more to do
+		self.assertEqual(snapstore.migrate(conn), [])
+		conn.close()
+		
+		
+class AppendTest(unittest.TestCase):
+	
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.conn = snapstore.connect(os.path.join(self.dir, 'test.sql'))
+		
+	def tearDown(self):
+		self.conn.close()
+		shutil.rmtree(self.dir)
+		
+	def read(self, table):
+		frame = sql.read_frame('SELECT * FROM %s ORDER BY rowid' % table, self.conn)
+		frame['timestamp'] = snapstore.from_epochs(frame['timestamp'].values)
+		return frame
+		
+	def test_round_trip(self):
+		stamps = [datetime(2013, 6, 3, 16), datetime(2013, 6, 3, 16, 0, 1), datetime(1999, 12, 31, 23, 59, 59)]
+		fut = futures(stamps[0], ('Z3', 'H4', 'M4'))
+		fut['timestamp'] = stamps
+		self.assertEqual(snapstore.append(self.conn, 'futures', fut), 3)
+		back = self.read('futures')
+		self.assertEqual(list(back['timestamp']), [pd.Timestamp(ss) for ss in stamps])
+		self.assertEqual(list(back['mon']), ['Z3', 'H4', 'M4'])
+		self.assertEqual(list(back['PX_SETTLE']), list(fut['PX_SETTLE']))
+		types = dict((rr[1], rr[2]) for rr in self.conn.execute('PRAGMA table_info(futures)'))
+		self.assertEqual(types['PX_SETTLE'], 'REAL')
+		
+	def test_new_columns(self):
+		# greeks appear in later snaps than the table was created by
+		snapstore.append(self.conn, 'futures', futures(datetime(2013, 6, 3, 16)))
+		fut = futures(datetime(2013, 6, 4, 16))
+		fut['DELTA'] = [0.5, 0.6]
+		snapstore.append(self.conn, 'futures', fut)
+		back = self.read('futures')
+		self.assertEqual(len(back), 4)
+		self.assertTrue(back['DELTA'][:2].isnull().all())
+		self.assertEqual(list(back['DELTA'][2:]), [0.5, 0.6])
+
+
+class WriterTest(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.fname = os.path.join(self.dir, 'test.sql')
+	
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+	
+	def count(self, table='futures'):
+		"""Rows committed to a table, as another connection sees them"""
+		conn = sqlite3.connect(self.fname)
+		try:
+			if not conn.execute('SELECT name FROM sqlite_master WHERE name = ?', (table,)).fetchall():
+				return 0
+			return conn.execute('SELECT COUNT(*) FROM %s' % table).fetchone()[0]
+		finally:
+			conn.close()
+	
+	def test_exception_commits_written(self):
+		# the with block closes the writer when it's left by an exception, committing the
+		# snapshot before it and releasing the write lock
+		try:
+			with SnapWriter(self.fname, batch=10) as writer:
+				with writer.snapshot():
+					writer.append('futures', futures(datetime(2013, 6, 3, 16)))
+				raise ValueError('failed snap')
+		except ValueError:
+			pass
+		self.assertEqual(self.count(), 2)
+		with SnapWriter(self.fname, timeout=0.1) as writer, writer.snapshot():
+			writer.append('futures', futures(datetime(2013, 6, 4, 16)))
+		self.assertEqual(self.count(), 4)
+		
+	def test_rollback(self):
+		with SnapWriter(self.fname, batch=10) as writer:
+			with writer.snapshot():
+				writer.append('futures', futures(datetime(2013, 6, 3, 16)))
+			try:
+				with writer.snapshot():
+					writer.append('options', pd.DataFrame({'timestamp': [datetime(2013, 6, 4, 16)], \
+						'month': ['Z3'], 'strike': [99.0]}))
+					writer.append('futures', futures(datetime(2013, 6, 4, 16)))
+					raise ValueError('failed snap')
+			except ValueError:
+				pass
+			self.assertEqual(writer.rows, 2)
+		# the failed snapshot left nothing in either table, the one before it was kept
+		self.assertEqual(self.count('options'), 0)
+		self.assertEqual(self.count(), 2)
+		
+	def test_batches(self):
+		writer = SnapWriter(self.fname, batch=3)
+		committed = []
+		for dd in range(7):
+			with writer.snapshot():
+				writer.append('futures', futures(datetime(2013, 6, 3 + dd, 16)))
+			committed.append(self.count() // 2)
+		writer.close()
+		self.assertEqual(committed, [0, 0, 3, 3, 3, 6, 6])
+		self.assertEqual(self.count() // 2, 7)
+		self.assertEqual(writer.rows, 14)
+
+
+if __name__ == '__main__':
+	unittest.main()
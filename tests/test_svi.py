@@ -0,0 +1,113 @@
+
+
+import os, sys, unittest
+from datetime import datetime
+from collections import namedtuple
+import pandas as pd
+from numpy import array, linspace, exp, sqrt, isnan
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mrmarket'))
+import svi
+from finutils import svi_var
+
+Spec = namedtuple('Spec', 'model computus undlMonths')
+
+
+class Calendar(object):
+	def opt_expiry(self, mm, yy):
+		return datetime(yy, mm, 15, 16)
+
+
+class Specs(object):
+	def spec(self, product):
+		return Spec('lognormal', 'test', 'HMUZ')
+
+
+class Computus(object):
+	def make(self, computus):
+		return Calendar()
+
+
+def smile(fwd, t, p, k, normal=False):
+	"""(strike, vol) tuples of an exact SVI smile at moneyness k"""
+	return [(fwd + kk if normal else fwd * exp(kk), sqrt(ww / t)) for kk, ww in zip(k, svi_var(p, k))]
+
+
+# (fwd, t, [a, b, sigma, rho, m]): a put skew and a steep call skew with small sigma
+CASES = [(100.0, 0.5, [0.02, 0.1, 0.15, -0.4, 0.05]), (100.0, 2.0, [0.01, 0.3, 0.05, 0.3, -0.1])]
+
+
+class SVITest(unittest.TestCase):
+	
+	def check(self, params, resid, p):
+		# the (m, sigma) grid search gets to within about 1e-4 of the true parameters
+		self.assertTrue(abs(params - array(p)).max() < 1e-3, (params, p))
+		self.assertTrue(resid < 1e-4, resid)
+
+
+class FitSmilesTest(SVITest):
+	
+	def test_recover_parameters(self):
+		smiles = [(fwd, t, smile(fwd, t, p, linspace(-0.6, 0.6, 13))) for fwd, t, p in CASES]
+		params, resid = svi.fit_smiles(smiles)
+		self.assertEqual(params.shape, (2, 5))
+		for ii, (fwd, t, p) in enumerate(CASES):
+			self.check(params[ii], resid[ii], p)
+	
+	def test_normal(self):
+		# Bachelier vols, moneyness K - F
+		p = [0.04, 0.2, 0.5, 0.2, 0.1]
+		params, resid = svi.fit_smiles([(98.5, 1.0, smile(98.5, 1.0, p, linspace(-1.5, 1.5, 11), True))], True)
+		self.check(params[0], resid[0], p)
+	
+	def test_unfittable(self):
+		fwd, t, p = CASES[0]
+		strip = smile(fwd, t, p, linspace(-0.6, 0.6, 13))
+		smiles = [(fwd, t, strip[:2]), (fwd, t, []), (float('nan'), t, strip), (fwd, 0.0, strip), \
+			(fwd, t, strip[:2] + [(110.0, float('nan'))]), (fwd, t, strip)]
+		params, resid = svi.fit_smiles(smiles)
+		self.assertTrue(isnan(params[:5]).all())
+		self.assertTrue(isnan(resid[:5]).all())
+		self.check(params[5], resid[5], p)
+	
+	def test_batches(self):
+		# batch boundaries, and unfittable smiles within a batch, don't change the fits
+		smiles = [(fwd, t, smile(fwd, t, p, linspace(-0.6, 0.6, 13))) for fwd, t, p in CASES] * 3
+		smiles.insert(3, (100.0, 1.0, smiles[0][2][:2]))
+		params, resid = svi.fit_smiles(smiles)
+		bparams, bresid = svi.fit_smiles(smiles, batch=2)
+		self.assertTrue(isnan(bparams[3]).all())
+		self.assertTrue(abs(bparams[~isnan(resid)] - params[~isnan(resid)]).max() < 1e-12)
+
+
+class FitHistoryTest(SVITest):
+	
+	def setUp(self):
+		self.saved = svi.XSpec, svi.Computus
+		svi.XSpec, svi.Computus = Specs, Computus
+	
+	def tearDown(self):
+		svi.XSpec, svi.Computus = self.saved
+	
+	def test_fit_history(self):
+		fwd, t, p = CASES[0]
+		# half a year before the U3 expiry
+		ts = datetime(2013, 3, 17, 16)
+		t = 182 / 365.0
+		opts = [(ts, 'U3', kk, vol) for kk, vol in smile(fwd, t, p, linspace(-0.6, 0.6, 13))] + \
+			[(ts, 'Z3', kk, 0.2) for kk in (95.0, 100.0)]
+		fopt = pd.DataFrame(opts, columns=['timestamp', 'month', 'strike', 'SETTLE_VOL']) \
+			.set_index(['timestamp', 'month', 'strike'])
+		ffut = pd.DataFrame([('U3', ts, fwd), ('Z3', ts, fwd)], columns=['mon', 'timestamp', \
+			'PX_SETTLE']).set_index(['mon', 'timestamp'])
+		
+		res = svi.fit_history('TEST', fopt, ffut)
+		self.assertEqual(list(res.index), [(ts, 'U3'), (ts, 'Z3')])
+		self.assertAlmostEqual(res['t'].values[0], t)
+		self.check(res[['a', 'b', 'sigma', 'rho', 'm']].values[0], res['residual'].values[0], p)
+		self.assertEqual(list(res['success']), [True, False])
+		self.assertEqual(res['message'].values[1], 'only 2 strikes')
+
+
+if __name__ == '__main__':
+	unittest.main()
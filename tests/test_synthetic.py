@@ -0,0 +1,69 @@
+
+
+import os, sys, unittest
+from datetime import datetime
+from collections import namedtuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mrmarket'))
+import synthetic
+from synthetic import SyntheticBackend
+
+Spec = namedtuple('Spec', 'model computus undlMonths strikeStep midcurves')
+
+
+class Calendar(object):
+	def fut_last_trade(self, mm, yy):
+		return datetime(yy, mm, 16, 11)
+	
+	def opt_expiry(self, mm, yy):
+		return datetime(yy, mm, 15, 16)
+	
+	def mc_expiry(self, mm, yy):
+		return datetime(yy, mm, 10, 16)
+
+
+class Specs(object):
+	"""ED with 2 and 3 year 'E' midcurves, and a product without midcurves"""
+	def __init__(self, specfile=None):
+		pass
+	
+	def spec(self, product):
+		return Spec('normal', 'test', 'HMUZ', 0.125, '3E' if product == 'ED' else float('nan'))
+
+
+class Computus(object):
+	def make(self, computus):
+		return Calendar()
+
+
+class QuotesTest(unittest.TestCase):
+	
+	def setUp(self):
+		self.saved = synthetic.XSpec, synthetic.Computus
+		synthetic.XSpec, synthetic.Computus = Specs, Computus
+		self.backend = SyntheticBackend(['ED', 'TY'], asof=datetime(2013, 6, 3, 16))
+	
+	def tearDown(self):
+		synthetic.XSpec, synthetic.Computus = self.saved
+	
+	def test_midcurves(self):
+		secs = ['EDZ5 COMB Comdty', '2EZ3C 97 COMB Comdty', '2EZ3P 97 COMB Comdty', '3EZ3C 97 COMB Comdty', \
+			'2XZ3C 97 COMB Comdty', '2TZ3C 97 COMB Comdty', '2EZ3 COMB Comdty', 'EDZ3C 98.5 COMB Comdty']
+		bdata = self.backend.fetch(secs, ['BID', 'ASK'])
+		for sec in secs[:4] + secs[-1:]:
+			self.assertEqual([ff for ff, vv in bdata[sec]], ['BID', 'ASK'], sec)
+		# not a midcurve code of ED, TY has none, and midcurves are options only
+		for sec in secs[4:7]:
+			self.assertEqual(bdata[sec], [], sec)
+		
+		# 2EZ3 is on Z5, priced off the same forward as the Z5 future
+		fwd = sum(vv for ff, vv in bdata['EDZ5 COMB Comdty']) / 2.0
+		call, put = [sum(vv for ff, vv in bdata['2EZ3%s 97 COMB Comdty' % cp]) / 2.0 for cp in 'CP']
+		self.assertTrue(call > 0.0 and put > 0.0)
+		self.assertTrue(abs(call - put - (fwd - 97.0)) < 0.01)
+		# and differs from the 3 year midcurve on Z6
+		self.assertNotEqual(bdata['2EZ3C 97 COMB Comdty'], bdata['3EZ3C 97 COMB Comdty'])
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,70 @@
+
+
+import os, sys, unittest
+from numpy import array, linspace, sqrt, diff, isfinite
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mrmarket'))
+from volsurface import VolSurface
+
+
+def smiles(fwds=(100.0, 100.0, 100.0)):
+	"""U3, Z3 and H4 with the vol falling with expiry (but not so fast the total variance
+	does) and a skew that flattens"""
+	out = []
+	for (month, t, atm, skew), fwd in zip((('U3', 0.25, 0.3, -0.2), ('Z3', 0.5, 0.25, -0.1), \
+			('H4', 0.75, 0.22, -0.05)), fwds):
+		strikes = linspace(80.0, 120.0, 9)
+		out.append((month, fwd, t, [(kk, atm + skew * (kk / fwd - 1.0)) for kk in strikes]))
+	return out
+
+
+class VolSurfaceTest(unittest.TestCase):
+	
+	def setUp(self):
+		self.vs = VolSurface(smiles())
+	
+	def test_nodes(self):
+		for month, fwd, t, strip in smiles():
+			kk, vv = array(strip).T
+			self.assertTrue(abs(self.vs(kk, t) - vv).max() < 1e-12, month)
+			self.assertTrue(abs(self.vs.smile(month, kk) - vv).max() < 1e-12, month)
+	
+	def test_total_variance_monotone(self):
+		# between, before and after the expiries, and for strikes outside the quoted ones
+		t = linspace(0.01, 1.5, 150)
+		for kk in (60.0, 80.0, 95.0, 100.0, 113.0, 150.0):
+			w = self.vs(kk, t)**2 * t
+			self.assertTrue((diff(w) > 0.0).all(), kk)
+	
+	def test_flat_vol_outside_expiries(self):
+		kk = array([90.0, 100.0, 110.0])
+		first, last = self.vs(kk, 0.25), self.vs(kk, 0.75)
+		for t in (0.1, 0.01, 1e-8):
+			self.assertTrue(abs(self.vs(kk, t) - first).max() < 1e-12)
+		self.assertTrue(abs(self.vs(kk, 2.0) - last).max() < 1e-12)
+	
+	def test_zero_time(self):
+		# the limit of the flat vol before the first expiry, not 0 / 0
+		vols = self.vs([90.0, 100.0, 110.0], 0.0)
+		self.assertTrue(isfinite(vols).all())
+		self.assertTrue(abs(vols - self.vs([90.0, 100.0, 110.0], 0.25)).max() < 1e-12)
+		self.assertAlmostEqual(float(self.vs(100.0, [0.0, 0.5])[0]), 0.3)
+	
+	def test_negative_time(self):
+		self.assertRaises(ValueError, self.vs, 100.0, -0.01)
+		self.assertRaises(ValueError, self.vs, [100.0, 110.0], [0.5, -1.0])
+	
+	def test_empty(self):
+		self.assertRaises(ValueError, VolSurface([('U3', 100.0, 0.0, [(100.0, 0.2)])]), 100.0, 0.5)
+	
+	def test_moneyness_per_expiry(self):
+		# each expiry's smile moves with its own forward
+		vs = VolSurface(smiles((100.0, 102.0, 104.0)))
+		zvol, hvol = 0.25 - 0.1 * (100.0 / 102.0 - 1.0), 0.22 - 0.05 * (100.0 / 104.0 - 1.0)
+		self.assertAlmostEqual(float(vs(100.0, 0.5)), zvol)
+		self.assertAlmostEqual(float(vs(100.0, 0.75)), hvol)
+		self.assertAlmostEqual(float(vs(100.0, 0.625)), sqrt((zvol**2 * 0.5 + hvol**2 * 0.75) / 2 / 0.625))
+
+
+if __name__ == '__main__':
+	unittest.main()